@@ -0,0 +1,394 @@
+"""Prefix autocomplete for restaurant and user names, ranked by popularity
+
+Names are held in in-memory tries. Each trie node caches the top TOP_K entries in its
+subtree, so a lookup is a walk down the prefix plus a read of that node's cached list,
+no matter how many names share the prefix.
+
+The tries are built in bulk (at startup, or on first use), updated incrementally when
+restaurants or users are added or renamed and when visits are added, and rebuilt in a
+background thread once they're older than MAX_AGE_SECONDS to pick up writes from other
+processes. Lookups keep using the old tries until the new ones are swapped in.
+"""
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, object_session
+
+from model import User, Restaurant, Visit
+from model import db
+
+import heapq
+import re
+import threading
+import time
+
+# Most suggestions cached per trie node, and so the most an autocomplete request can return
+TOP_K = 10
+
+# Rebuild the tries from the database once they're this old
+MAX_AGE_SECONDS = 900
+
+
+def tokenize(name):
+    """
+    Return the strings a name is indexed under: the whole name and each word in it.
+
+    e.g. "Miku Sushi" is indexed under "miku sushi", "miku" and "sushi".
+    """
+
+    words = re.findall(r"\w+", (name or "").lower(), re.UNICODE)
+
+    return set([" ".join(words)] + words) - set([""])
+
+
+def normalize_prefix(prefix):
+    """Normalize a typed prefix the same way names are tokenized."""
+
+    return " ".join(re.findall(r"\w+", (prefix or "").lower(), re.UNICODE))
+
+
+class TrieNode(object):
+    """A node in a prefix trie, with the ids of entries ending here and the top entries below it."""
+
+    __slots__ = ["children", "entry_ids", "top"]
+
+    def __init__(self):
+        self.children = {}
+        self.entry_ids = set()
+        # List of (-popularity, label, entry_id) for the best TOP_K entries in this subtree
+        self.top = []
+
+
+class PrefixIndex(object):
+    """Trie over entry names that answers top-k most popular entries for a prefix."""
+
+    def __init__(self):
+        self.root = TrieNode()
+        # entry_id -> (popularity, label, tokens)
+        self.entries = {}
+        self.lock = threading.RLock()
+
+    def rank(self, entry_id):
+        """Return the sort key for an entry: most popular first, then alphabetical."""
+
+        popularity, label, _ = self.entries[entry_id]
+
+        return (-popularity, label.lower(), entry_id)
+
+    def get_node(self, token, create=False):
+        """Return the node for token, or None if there isn't one and create is False."""
+
+        node = self.root
+
+        for char in token:
+            child = node.children.get(char)
+
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = TrieNode()
+
+            node = child
+
+        return node
+
+    def recompute(self, node):
+        """Recompute a node's top entries from its own entries and its children's top entries."""
+
+        # A set, as an entry indexed under several tokens can reach a node through more than one child
+        candidates = set(self.rank(entry_id) for entry_id in node.entry_ids)
+
+        for child in node.children.itervalues():
+            candidates.update(child.top)
+
+        node.top = heapq.nsmallest(TOP_K, candidates)
+
+    def recompute_path(self, token):
+        """Recompute the top entries for every node from token's node back up to the root."""
+
+        path = [self.root]
+
+        for char in token:
+            path.append(path[-1].children[char])
+
+        for node in reversed(path):
+            self.recompute(node)
+
+    def recompute_all(self, node=None):
+        """Recompute every node's top entries, children first."""
+
+        node = node or self.root
+
+        for child in node.children.itervalues():
+            self.recompute_all(child)
+
+        self.recompute(node)
+
+    def add_entries(self, entries):
+        """Bulk add (entry_id, label, popularity) entries, computing the top entries once at the end."""
+
+        with self.lock:
+            for entry_id, label, popularity in entries:
+                tokens = tokenize(label)
+                self.entries[entry_id] = (popularity, label, tokens)
+
+                for token in tokens:
+                    self.get_node(token, create=True).entry_ids.add(entry_id)
+
+            self.recompute_all()
+
+    def set_entry(self, entry_id, label, popularity=None):
+        """Add an entry, or update its label (and popularity, if given)."""
+
+        with self.lock:
+            old_tokens = set()
+
+            if entry_id in self.entries:
+                old_popularity, _, old_tokens = self.entries[entry_id]
+                popularity = old_popularity if popularity is None else popularity
+
+                for token in old_tokens:
+                    self.get_node(token).entry_ids.discard(entry_id)
+
+            tokens = tokenize(label)
+            self.entries[entry_id] = (popularity or 0, label, tokens)
+
+            for token in tokens:
+                self.get_node(token, create=True).entry_ids.add(entry_id)
+
+            for token in old_tokens | tokens:
+                self.recompute_path(token)
+
+    def add_popularity(self, entry_id, amount=1):
+        """Add to an entry's popularity, e.g. when someone leaves a breadcrumb for it."""
+
+        with self.lock:
+            if entry_id not in self.entries:
+                return
+
+            popularity, label, tokens = self.entries[entry_id]
+            self.entries[entry_id] = (popularity + amount, label, tokens)
+
+            for token in tokens:
+                self.recompute_path(token)
+
+    def complete(self, prefix, limit=TOP_K):
+        """Return up to limit (entry_id, label) pairs for the most popular entries starting with prefix."""
+
+        prefix = normalize_prefix(prefix)
+
+        if not prefix:
+            return []
+
+        with self.lock:
+            node = self.get_node(prefix)
+
+            if node is None:
+                return []
+
+            return [(entry_id, self.entries[entry_id][1]) for _, _, entry_id in node.top[:limit]]
+
+
+class Autocomplete(object):
+    """Prefix indexes over restaurant names and user names, built from the database."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Held while the indexes are being built, so only one thread builds them at a time
+        self.build_lock = threading.Lock()
+        self.built_at = None
+        self.restaurants = PrefixIndex()
+        self.users = PrefixIndex()
+        # Updates made while the indexes are being built, applied to them once they're swapped in
+        self.pending = None
+
+    @property
+    def built(self):
+        """Check if the indexes have been built."""
+
+        return self.built_at is not None
+
+    @property
+    def stale(self):
+        """Check if the indexes are due to be rebuilt."""
+
+        return self.built_at is not None and time.time() - self.built_at >= MAX_AGE_SECONDS
+
+    def build(self):
+        """Build both indexes in bulk, then swap them in."""
+
+        with self.lock:
+            self.pending = []
+            built_at = time.time()
+
+        try:
+            restaurants, users = self.build_indexes()
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+
+        with self.lock:
+            self.restaurants, self.users = restaurants, users
+            self.built_at = built_at
+
+            # Updates made while building may have been missed by its queries
+            for update in self.pending:
+                update()
+
+            self.pending = None
+
+    def build_indexes(self):
+        """Return new restaurant and user indexes, built in bulk from the database."""
+
+        visit_counts = db.session.query(Visit.restaurant_id,
+                                        func.count(Visit.visit_id).label("num_visits")).group_by(Visit.restaurant_id).subquery()
+
+        # Closed restaurants aren't suggested
+        open_restaurants = db.session.query(Restaurant.restaurant_id,
+                                            Restaurant.name,
+                                            func.coalesce(visit_counts.c.num_visits, 0)).outerjoin(
+            visit_counts, visit_counts.c.restaurant_id == Restaurant.restaurant_id).filter(Restaurant.is_closed == False)
+
+        restaurants = PrefixIndex()
+        restaurants.add_entries(open_restaurants)
+
+        users = PrefixIndex()
+        users.add_entries(db.session.query(User.user_id,
+                                           User.first_name + " " + User.last_name,
+                                           User.num_visits))
+
+        return restaurants, users
+
+    def ensure_built(self):
+        """Build the indexes if they haven't been built yet, or start rebuilding them in the background if stale."""
+
+        if not self.built:
+            with self.build_lock:
+                # Another request may have built them while this one waited
+                if not self.built:
+                    self.build()
+
+        elif self.stale and self.build_lock.acquire(False):
+            thread = threading.Thread(target=self.refresh, args=(db.get_app(),))
+            thread.daemon = True
+            thread.start()
+
+    def refresh(self, app):
+        """Rebuild the indexes in a background thread started by ensure_built, which holds build_lock for it."""
+
+        try:
+            with app.app_context():
+                try:
+                    self.build()
+                finally:
+                    db.session.remove()
+
+        except Exception:
+            app.logger.exception("Couldn't rebuild the autocomplete indexes")
+
+        finally:
+            self.build_lock.release()
+
+    def apply(self, update):
+        """
+        Apply an update to the indexes, and again to the new ones if they're being built.
+
+        Indexes that haven't been built yet don't need updating, as they'll be built from the database.
+        """
+
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(update)
+
+            if self.built_at is not None:
+                update()
+
+    def clear(self):
+        """Forget the indexes, so they're rebuilt the next time they're needed."""
+
+        with self.lock:
+            self.restaurants, self.users = PrefixIndex(), PrefixIndex()
+            self.built_at = None
+
+    def record_visit(self, user_id, restaurant_id):
+        """Count a new visit towards the restaurant's and the user's popularity."""
+
+        self.apply(lambda: (self.restaurants.add_popularity(int(restaurant_id)),
+                            self.users.add_popularity(int(user_id))))
+
+    def complete(self, prefix, limit=TOP_K, kinds=("restaurant", "user")):
+        """
+        Return up to limit suggestions for prefix, as dictionaries of type, id, name and url.
+
+        Restaurants are listed before users when both are asked for.
+        """
+
+        self.ensure_built()
+
+        suggestions = []
+
+        if "restaurant" in kinds:
+            suggestions.extend({"type": "restaurant",
+                                "id": restaurant_id,
+                                "name": name,
+                                "url": "/restaurants/%s" % restaurant_id}
+                               for restaurant_id, name in self.restaurants.complete(prefix, limit))
+
+        if "user" in kinds:
+            suggestions.extend({"type": "user",
+                                "id": user_id,
+                                "name": name,
+                                "url": "/users/%s" % user_id}
+                               for user_id, name in self.users.complete(prefix, limit))
+
+        return suggestions[:limit]
+
+
+autocomplete = Autocomplete()
+
+
+def mark_name_changed(mapper, connection, target):
+    """Queue a restaurant or user to be re-indexed once its change commits."""
+
+    # Read the name now, as the session can't load expired attributes after commit
+    if isinstance(target, Restaurant):
+        # Closed restaurants aren't suggested; one already indexed drops out when the indexes are rebuilt
+        if target.is_closed:
+            return
+
+        change = ("restaurant", target.restaurant_id, target.name)
+    else:
+        change = ("user", target.user_id, "%s %s" % (target.first_name, target.last_name))
+
+    session = object_session(target)
+    session.info.setdefault("autocomplete_changes", []).append(change)
+
+
+def apply_name_changes(session):
+    """Re-index the restaurants and users whose changes just committed."""
+
+    changes = session.info.pop("autocomplete_changes", [])
+
+    if not changes:
+        return
+
+    def apply_changes():
+        for kind, entry_id, name in changes:
+            if kind == "restaurant":
+                autocomplete.restaurants.set_entry(entry_id, name)
+            else:
+                autocomplete.users.set_entry(entry_id, name)
+
+    autocomplete.apply(apply_changes)
+
+
+for model_class in [Restaurant, User]:
+    for event_name in ["after_insert", "after_update"]:
+        event.listen(model_class, event_name, mark_name_changed)
+
+event.listen(Session, "after_commit", apply_name_changes)
+event.listen(Session, "after_soft_rollback",
+             lambda session, previous_transaction: session.info.pop("autocomplete_changes", None))
+
+# Freshly created tables (e.g. between tests) make the indexes stale
+event.listen(db.metadata, "after_create", lambda target, connection, **kw: autocomplete.clear())
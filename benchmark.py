@@ -0,0 +1,236 @@
+"""Per-route load benchmarks for Breadcrumbs
+
+Drives the app through Flask's test client against a scaled dataset, and reports
+throughput, p50/p95/p99 latency and SQL statements per request for each route.
+Results are saved as JSON (tagged with the git commit) so runs can be compared
+between commits.
+
+Benchmarks run against their own database, as populating it drops every table:
+    createdb benchmarkdb
+    python benchmark.py --populate --scale 10             # load the dataset, then benchmark
+    python benchmark.py --output before.json              # benchmark the loaded dataset
+    python benchmark.py --output after.json --compare before.json
+"""
+
+from sqlalchemy import func
+
+from model import User, Restaurant, Visit
+from model import connect_to_db, db
+
+from query_stats import count_queries
+
+import synthetic_data
+
+import argparse
+import datetime
+import json
+import math
+import subprocess
+import timeit
+
+BENCHMARK_DB_URI = "postgresql:///benchmarkdb"
+
+# Routes to benchmark, filled in from the dataset by get_route_params()
+BENCHMARK_ROUTES = [
+    ("user_profile", "/users/{user_id}"),
+    ("user_visits_json", "/users/{user_id}/visits.json"),
+    ("restaurant_list", "/restaurants"),
+    ("search_restaurants", "/restaurants/search?q={restaurant_query}"),
+    ("search_users", "/friends/search?q={user_query}"),
+    ("restaurant_profile", "/restaurants/{restaurant_id}"),
+]
+
+# Dataset size per unit of --scale
+CITIES_PER_SCALE = 1
+RESTAURANTS_PER_SCALE = 500
+USERS_PER_SCALE = 200
+VISITS_PER_SCALE = 4000
+FRIENDS_PER_USER = 10
+
+
+def populate(scale, seed=0):
+    """Drop every table and load a deterministic synthetic dataset scale times the size of a small city."""
+
+    db.session.close()
+    db.drop_all()
+    db.configure_mappers()
+    db.create_all()
+
+    synthetic_data.generate(CITIES_PER_SCALE * scale,
+                            RESTAURANTS_PER_SCALE * scale,
+                            USERS_PER_SCALE * scale,
+                            VISITS_PER_SCALE * scale,
+                            FRIENDS_PER_USER,
+                            seed)
+
+
+def get_route_params():
+    """Return the ids and queries to fill in BENCHMARK_ROUTES with, picking the busiest rows."""
+
+    user_id = db.session.query(User.user_id).order_by(User.num_visits.desc(), User.user_id).limit(1).scalar()
+
+    restaurant_id = db.session.query(Visit.restaurant_id).group_by(Visit.restaurant_id).order_by(
+        func.count(Visit.visit_id).desc(), Visit.restaurant_id).limit(1).scalar()
+
+    restaurant = db.session.query(Restaurant).get(restaurant_id)
+    user = db.session.query(User).get(user_id)
+
+    return {"user_id": user_id,
+            "restaurant_id": restaurant_id,
+            "restaurant_query": restaurant.name.split()[-1],
+            "user_query": user.last_name}
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a sorted list of values, by the nearest-rank method."""
+
+    if not values:
+        return None
+
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def benchmark_route(client, url, num_requests, warmup):
+    """Request url num_requests times after warmup requests, returning its timings and statement counts."""
+
+    for _ in xrange(warmup):
+        client.get(url).close()
+
+    latencies = []
+
+    with count_queries() as stats:
+        started = timeit.default_timer()
+
+        for _ in xrange(num_requests):
+            request_started = timeit.default_timer()
+            response = client.get(url)
+            # Read the body, so streamed responses are timed in full
+            response.data
+            latencies.append(timeit.default_timer() - request_started)
+
+            if response.status_code != 200:
+                raise AssertionError("GET %s returned %s" % (url, response.status_code))
+
+        elapsed = timeit.default_timer() - started
+
+    latencies.sort()
+
+    return {
+        "url": url,
+        "requests": num_requests,
+        "throughput_rps": num_requests / elapsed,
+        "mean_ms": 1000 * sum(latencies) / num_requests,
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+        "sql_statements_per_request": float(stats.count) / num_requests
+    }
+
+
+def run_benchmarks(app, num_requests=200, warmup=10, routes=None):
+    """Benchmark each route as a logged in user, returning a dictionary of results by route name."""
+
+    params = get_route_params()
+    user = db.session.query(User).get(params["user_id"])
+
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session["current_user"] = {"first_name": user.first_name,
+                                   "user_id": user.user_id}
+
+    db.session.remove()
+
+    results = {}
+
+    for name, url in BENCHMARK_ROUTES:
+        if not routes or name in routes:
+            results[name] = benchmark_route(client, url.format(**params), num_requests, warmup)
+
+    return results
+
+
+def get_git_commit():
+    """Return the current git commit, or None if it can't be found."""
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    """Print a table of results, with the change from baseline's results if given."""
+
+    print "%-20s %10s %10s %10s %10s %8s" % ("route", "req/s", "p50 ms", "p95 ms", "p99 ms", "sql/req")
+
+    for name, result in sorted(results["routes"].items()):
+        print "%-20s %10.1f %10.2f %10.2f %10.2f %8.1f" % (name,
+                                                         result["throughput_rps"],
+                                                         result["p50_ms"],
+                                                         result["p95_ms"],
+                                                         result["p99_ms"],
+                                                         result["sql_statements_per_request"])
+
+        before = baseline["routes"].get(name) if baseline else None
+
+        if before:
+            print "%-20s %9.0f%% %9.0f%% %9.0f%% %9.0f%% %+8.1f" % (
+                "  vs %s" % baseline.get("commit"),
+                100.0 * (result["throughput_rps"] / before["throughput_rps"] - 1),
+                100.0 * (result["p50_ms"] / before["p50_ms"] - 1),
+                100.0 * (result["p95_ms"] / before["p95_ms"] - 1),
+                100.0 * (result["p99_ms"] / before["p99_ms"] - 1),
+                result["sql_statements_per_request"] - before["sql_statements_per_request"])
+
+
+def parse_args():
+    """Parse command line arguments for the benchmarks."""
+
+    parser = argparse.ArgumentParser(description="Benchmark Breadcrumbs routes against a scaled dataset.")
+    parser.add_argument("--db", default=BENCHMARK_DB_URI, help="database to benchmark against")
+    parser.add_argument("--populate", action="store_true",
+                        help="drop every table in the database and load a fresh dataset first")
+    parser.add_argument("--scale", type=int, default=10, help="with --populate, how large a dataset to load")
+    parser.add_argument("--seed", type=int, default=0, help="with --populate, random seed for the dataset")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed requests per route before timing")
+    parser.add_argument("--route", action="append", dest="routes",
+                        help="only benchmark this route (can be given more than once)")
+    parser.add_argument("--output", help="save results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results from an earlier run to compare against")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from server import app
+
+    args = parse_args()
+
+    # Loading a dataset runs whole-table statements, so it can't be held to the web app's statement timeout
+    connect_to_db(app, args.db, batch=args.populate)
+
+    if args.populate:
+        populate(args.scale, args.seed)
+
+    results = {
+        "commit": get_git_commit(),
+        "ran_at": datetime.datetime.utcnow().isoformat(),
+        "db": args.db,
+        "routes": run_benchmarks(app, args.requests, args.warmup, args.routes)
+    }
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
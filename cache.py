@@ -0,0 +1,124 @@
+"""In-process cache with LRU eviction and TTL expiry"""
+
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    Thread-safe cache holding at most maxsize entries, each expiring ttl seconds after it was set.
+
+    When full, the least recently used entry is evicted. Hits, misses and evictions are
+    counted so the cache can be sized from its stats.
+    """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Bumped by clear() and delete(), so values computed from data older than them aren't cached
+        self.generation = 0
+        self.cleared_generation = 0
+        # Generation each recently deleted key was deleted at, oldest first
+        self.deleted = OrderedDict()
+
+    def get(self, key, default=None):
+        """Return the value for key if it's cached and hasn't expired, otherwise default."""
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return default
+
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key, value, generation=None):
+        """
+        Cache value for key, evicting the least recently used entry if the cache is full.
+
+        If generation is given and the cache has been cleared, or key deleted, since, the value is not cached.
+        """
+
+        with self.lock:
+            if generation is not None and (generation < self.cleared_generation or
+                                           generation < self.deleted.get(key, 0)):
+                return
+
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, get_value):
+        """Return the cached value for key, or call get_value() and cache its result."""
+
+        generation = self.generation
+        value = self.get(key)
+
+        if value is None:
+            value = get_value()
+            self.set(key, value, generation)
+
+        return value
+
+    def update(self, key, update_value):
+        """Replace key's cached value with update_value(value), if it's cached, keeping its expiry."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and entry[0] >= time.time():
+                self.entries[key] = (entry[0], update_value(entry[1]))
+
+    def delete(self, key):
+        """Remove key's entry, if there is one, e.g. when the data it was computed from changes."""
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+            self.generation += 1
+            self.deleted.pop(key, None)
+            self.deleted[key] = self.generation
+
+            # Forgetting old deletes is safe as long as values computed before them aren't cached
+            while len(self.deleted) > self.maxsize:
+                _, generation = self.deleted.popitem(last=False)
+                self.cleared_generation = max(self.cleared_generation, generation)
+
+    def clear(self):
+        """Remove every entry, e.g. when the data it was computed from changes."""
+
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+            self.cleared_generation = self.generation
+            self.deleted.clear()
+
+    def stats(self):
+        """Return a dictionary of the cache's size and hit/miss counters."""
+
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": float(self.hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,143 @@
+"""Server-side clustering of a user's breadcrumbs for the map
+
+Visits are grouped on a grid of CELL_PIXELS-wide squares laid over the Web Mercator
+map at the requested zoom level, the same projection Google Maps draws with. Each
+cell's visits become one cluster with a count, a centroid and the bounds of its
+restaurants, so the map draws at most one marker per cell on screen no matter how
+many visits the user has.
+
+Grouping is done by Postgres in a single GROUP BY. A user's clusters are cached per
+zoom level for the whole world, and each request is answered by picking the clusters
+inside its map bounds.
+"""
+
+from sqlalchemy import func
+
+from model import Restaurant, Visit, RESTAURANT_LATITUDE, RESTAURANT_LONGITUDE
+from model import db
+
+from cache import LRUCache
+from metrics import metrics
+
+import math
+
+# Width of a grid cell on screen, in pixels, and of a map tile at zoom 0
+CELL_PIXELS = 64
+TILE_PIXELS = 256
+
+# Google Maps' zoom levels, from the whole world to street level
+MIN_ZOOM = 0
+MAX_ZOOM = 21
+
+# Web Mercator can't show the poles, so latitudes are clamped to the map's edge
+MAX_LATITUDE = 85.05112878
+
+visit_clusters_cache = LRUCache(maxsize=5000, ttl=300)
+
+metrics.register_cache("visit_clusters", visit_clusters_cache)
+
+
+def get_zoom(zoom):
+    """Return the zoom level asked for, within the map's zoom levels."""
+
+    return min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+
+
+def get_cell_columns(zoom):
+    """Return SQL expressions for the grid cell column and row a restaurant falls in at zoom."""
+
+    cells = TILE_PIXELS * 2 ** zoom / float(CELL_PIXELS)
+
+    latitude = func.radians(func.least(func.greatest(RESTAURANT_LATITUDE, -MAX_LATITUDE), MAX_LATITUDE))
+
+    column = func.floor((RESTAURANT_LONGITUDE + 180) / 360 * cells)
+    row = func.floor((1 - func.ln(func.tan(latitude) + 1 / func.cos(latitude)) / math.pi) / 2 * cells)
+
+    return column, row
+
+
+def compute_clusters(user_id, zoom):
+    """
+    Group all of a user's visits into clusters at zoom.
+
+    Returns a list of dictionaries with each cluster's count, centroid and bounds. Clusters of
+    a single visit also have the restaurant's details, for the marker's info window.
+    """
+
+    column, row = get_cell_columns(zoom)
+
+    cells = db.session.query(func.count(Visit.visit_id),
+                             func.avg(RESTAURANT_LATITUDE),
+                             func.avg(RESTAURANT_LONGITUDE),
+                             func.min(RESTAURANT_LATITUDE),
+                             func.min(RESTAURANT_LONGITUDE),
+                             func.max(RESTAURANT_LATITUDE),
+                             func.max(RESTAURANT_LONGITUDE),
+                             func.min(Restaurant.restaurant_id)).join(
+                                 Restaurant, Visit.restaurant_id == Restaurant.restaurant_id).filter(
+                                 Visit.user_id == user_id).group_by(column, row)
+
+    clusters = []
+
+    for count, avg_lat, avg_lng, south, west, north, east, restaurant_id in cells:
+        clusters.append({"count": count,
+                         "latitude": avg_lat,
+                         "longitude": avg_lng,
+                         "bounds": {"south": south, "west": west, "north": north, "east": east},
+                         "restaurant_id": restaurant_id if count == 1 else None})
+
+    # Details for single-visit clusters, in one query
+    restaurant_ids = [cluster["restaurant_id"] for cluster in clusters if cluster["restaurant_id"]]
+    restaurants = {}
+
+    if restaurant_ids:
+        for restaurant in db.session.query(Restaurant.restaurant_id,
+                                           Restaurant.name,
+                                           Restaurant.address,
+                                           Restaurant.phone,
+                                           Restaurant.image_url).filter(Restaurant.restaurant_id.in_(restaurant_ids)):
+            restaurants[restaurant.restaurant_id] = {
+                "rest_id": restaurant.restaurant_id,
+                "restaurant": restaurant.name,
+                "address": restaurant.address,
+                "phone": restaurant.phone or "Not Available",
+                "image_url": restaurant.image_url or "/static/img/restaurant-avatar.png"
+            }
+
+    for cluster in clusters:
+        cluster["restaurant"] = restaurants.get(cluster.pop("restaurant_id"))
+
+    return clusters
+
+
+def is_in_bounds(cluster, bounds):
+    """Check if a cluster's centroid is inside map bounds, which may cross the antimeridian."""
+
+    south, west, north, east = bounds
+
+    if not south <= cluster["latitude"] <= north:
+        return False
+
+    if west <= east:
+        return west <= cluster["longitude"] <= east
+
+    return cluster["longitude"] >= west or cluster["longitude"] <= east
+
+
+def get_clusters(user_id, zoom, bounds=None):
+    """Return a user's visit clusters at zoom, only those inside bounds if given."""
+
+    zoom = get_zoom(zoom)
+    clusters = visit_clusters_cache.get_or_set((user_id, zoom), lambda: compute_clusters(user_id, zoom))
+
+    if bounds is None:
+        return clusters
+
+    return [cluster for cluster in clusters if is_in_bounds(cluster, bounds)]
+
+
+def clear_user_clusters(user_id):
+    """Forget a user's cached clusters at every zoom, e.g. after they add a visit."""
+
+    for zoom in xrange(MIN_ZOOM, MAX_ZOOM + 1):
+        visit_clusters_cache.delete((user_id, zoom))
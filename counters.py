@@ -0,0 +1,66 @@
+"""Denormalized counters on User for breadcrumbs, friends and friend requests
+
+The counters are kept current by the write paths (adding a visit, sending and
+accepting a friend request), so profile pages and badges can read them straight
+off the user row instead of loading every Visit or friend just to count them.
+
+To recompute every user's counters in bulk (e.g. after a backfill):
+    python counters.py
+"""
+
+from sqlalchemy import func, select
+
+from model import User, Visit, Connection
+from model import connect_to_db, db
+
+
+def increment_counters(user_id, **deltas):
+    """
+    Atomically add deltas to a user's counters, e.g. increment_counters(1, num_visits=1).
+
+    Note: This does not commit, so the counters change in the same transaction as the write.
+    """
+
+    values = dict((getattr(User, counter), getattr(User, counter) + delta)
+                  for counter, delta in deltas.items())
+
+    db.session.query(User).filter(User.user_id == user_id).update(values, synchronize_session=False)
+
+
+def get_request_counts(user_id):
+    """Return a dictionary of user's received, sent and total pending friend requests, from their counters."""
+
+    received, sent = db.session.query(User.num_received_requests,
+                                      User.num_sent_requests).filter(User.user_id == user_id).one()
+
+    return {"received": received, "sent": sent, "total": received + sent}
+
+
+def recompute_counters():
+    """Recompute every user's counters from the visits and connections tables in one UPDATE."""
+
+    users = User.__table__
+    visits = Visit.__table__
+    connections = Connection.__table__
+
+    def count_connections(user_column, status):
+        return select([func.count()]).where(user_column == users.c.user_id).where(connections.c.status == status).as_scalar()
+
+    # Each value is a subquery correlated to the row of users being updated
+    recount = users.update().values(
+        num_visits=select([func.count()]).where(visits.c.user_id == users.c.user_id).as_scalar(),
+        # Accepted friendships are stored in both directions, so count one side only
+        num_friends=count_connections(connections.c.user_a_id, "Accepted"),
+        num_received_requests=count_connections(connections.c.user_b_id, "Requested"),
+        num_sent_requests=count_connections(connections.c.user_a_id, "Requested"))
+
+    db.session.execute(recount)
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app, batch=True)
+
+    recompute_counters()
+    print "Recomputed counters for all users."
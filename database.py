@@ -0,0 +1,129 @@
+"""Engine profile and read-replica routing for the Flask-SQLAlchemy db object
+
+RoutingSQLAlchemy adds to the stock Flask-SQLAlchemy behaviour:
+
+    - a statement timeout on every PostgreSQL connection (DATABASE_STATEMENT_TIMEOUT_MS)
+    - a ping when a connection is checked out of the pool, so connections the server
+      dropped are replaced instead of failing the request (SQLALCHEMY_POOL_PRE_PING)
+    - a pool that records checkout waits for /metrics
+    - read-replica routing: while handling a view decorated with @read_replica, the
+      session reads from the "replica" bind in SQLALCHEMY_BINDS, if there is one.
+      Flushes, and every other view, go to the primary.
+
+Replicas lag the primary, so only routes that don't need to read their own writes
+(e.g. listings and searches) should be decorated. User profiles and their maps aren't,
+as signup, login and add_visit redirect straight to them.
+"""
+
+from functools import wraps
+
+from flask import request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, exc, select
+from sqlalchemy.pool import QueuePool
+
+from metrics import metrics
+
+import timeit
+
+# Key of the read replica's URI in SQLALCHEMY_BINDS
+REPLICA_BIND = "replica"
+
+
+def read_replica(view):
+    """Decorate a read-only view so its queries are sent to the read replica."""
+
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        # Flagged on the request rather than g, so it also covers streamed responses
+        request.use_read_replica = True
+        return view(*args, **kwargs)
+
+    return decorated
+
+
+def ping_connection(connection, branch):
+    """
+    Check a connection is alive before it's used, reconnecting once if it isn't.
+
+    Listens for engine_connect; this is SQLAlchemy's recipe for pessimistic disconnect handling.
+    """
+
+    if branch:
+        return
+
+    # Don't let the ping close the connection it's checking
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+
+    try:
+        connection.scalar(select([1]))
+
+    except exc.DBAPIError as error:
+        # The pool has been invalidated, so this second try gets a fresh connection
+        if error.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        started = timeit.default_timer()
+
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            metrics.observe("breadcrumbs_db_pool_checkout_seconds", timeit.default_timer() - started)
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends reads to the read replica during @read_replica views."""
+
+    def use_read_replica(self):
+        """Check if this session's queries should go to the read replica right now."""
+
+        binds = self.app.config.get("SQLALCHEMY_BINDS") or {}
+
+        return (REPLICA_BIND in binds and
+                not self._flushing and
+                has_request_context() and
+                getattr(request, "use_read_replica", False))
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.use_read_replica():
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with timed pools, pool pings, statement timeouts and read-replica routing."""
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+        # Pools set for SQLite above are kept
+        options.setdefault("poolclass", TimedQueuePool)
+
+        statement_timeout = app.config.get("DATABASE_STATEMENT_TIMEOUT_MS")
+
+        if statement_timeout and info.drivername.startswith("postgresql"):
+            connect_args = options.setdefault("connect_args", {})
+            connect_args["options"] = "-c statement_timeout=%d" % statement_timeout
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+
+        if app.config.get("SQLALCHEMY_POOL_PRE_PING") and not event.contains(engine, "engine_connect", ping_connection):
+            event.listen(engine, "engine_connect", ping_connection)
+
+        return engine
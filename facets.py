@@ -0,0 +1,157 @@
+"""Category facets for the restaurant listing and search results
+
+Restaurants can be narrowed to those in any (OR) or all (AND) of a set of categories,
+passed in the query string as ?category=1&category=2&match=all. Each page also shows
+how many of the matching restaurants are in each category, computed by one aggregate
+over restaurantcategories rather than by loading the matches. Counts are cached per
+search and filter, as they don't change from page to page.
+"""
+
+from sqlalchemy import event, func
+
+from model import Category, RestaurantCategory, Restaurant
+from model import db
+
+from cache import LRUCache
+from metrics import metrics
+
+import urllib
+
+# Most categories shown as facets, the most common first
+FACET_LIMIT = 30
+
+facet_cache = LRUCache(maxsize=1000, ttl=300)
+
+metrics.register_cache("restaurant_facets", facet_cache)
+
+
+def parse_category_filter(args):
+    """Return the category ids to filter by, and whether restaurants must be in all of them, from request args."""
+
+    category_ids = tuple(sorted(set(args.getlist("category", type=int))))
+
+    return category_ids, args.get("match") == "all"
+
+
+def get_category_restaurant_ids(category_ids, match_all=False):
+    """
+    Return a query for the ids of restaurants in any (or all) of the categories.
+
+    Both are one scan of the (category_id, restaurant_id) index.
+    """
+
+    restaurant_ids = db.session.query(RestaurantCategory.restaurant_id).filter(
+        RestaurantCategory.category_id.in_(category_ids))
+
+    if match_all:
+        # A restaurant is only linked to each category once, so it's in all of them if it has a row for each
+        return restaurant_ids.group_by(RestaurantCategory.restaurant_id).having(
+            func.count() == len(category_ids))
+
+    return restaurant_ids.distinct()
+
+
+def filter_by_categories(query, category_ids, match_all=False):
+    """Narrow a query of restaurants to those in any (or all) of the categories, if there are any."""
+
+    if not category_ids:
+        return query
+
+    return query.filter(Restaurant.restaurant_id.in_(get_category_restaurant_ids(category_ids, match_all).subquery()))
+
+
+def count_categories(restaurant_ids=None, selected_ids=()):
+    """
+    Return how many open restaurants are in each category, of those in restaurant_ids if given.
+
+    restaurant_ids is a query for the ids of the restaurants to count. Returns a list of
+    dictionaries with each category's id, name and count, the most common first. The
+    FACET_LIMIT most common are listed, and the selected categories always are, with a
+    count of 0 if none of the restaurants are in them, so they can be unselected.
+    """
+
+    num_restaurants = func.count(RestaurantCategory.restaurant_id)
+
+    # Closed restaurants aren't listed, so they aren't counted
+    counts = db.session.query(Category.category_id,
+                              Category.name,
+                              num_restaurants.label("count")).join(
+                                  RestaurantCategory, RestaurantCategory.category_id == Category.category_id).join(
+                                  Restaurant, Restaurant.restaurant_id == RestaurantCategory.restaurant_id).filter(
+                                  Restaurant.is_closed == False)
+
+    if restaurant_ids is not None:
+        counts = counts.filter(RestaurantCategory.restaurant_id.in_(restaurant_ids.subquery()))
+
+    counts = counts.group_by(Category.category_id, Category.name)
+
+    if selected_ids:
+        # Selected categories sort first, so the limit can't cut them off
+        counts = counts.order_by(Category.category_id.in_(selected_ids).desc())
+
+    counts = counts.order_by(num_restaurants.desc(), Category.name).limit(FACET_LIMIT + len(selected_ids))
+
+    facets = [count._asdict() for count in counts]
+
+    missing_ids = set(selected_ids) - set(facet["category_id"] for facet in facets)
+
+    if missing_ids:
+        facets.extend({"category_id": category_id, "name": name, "count": 0}
+                      for category_id, name in db.session.query(Category.category_id,
+                                                                Category.name).filter(
+                                                                    Category.category_id.in_(missing_ids)))
+
+    return sorted(facets, key=lambda facet: (-facet["count"], facet["name"]))
+
+
+def get_facets(key, category_ids, match_all=False, get_restaurant_ids=None):
+    """
+    Return the category counts for the restaurants matched by get_restaurant_ids(), narrowed by the category filter.
+
+    get_restaurant_ids returns a query for the ids of the restaurants to count, or None for
+    every restaurant; leave it out to count every restaurant. Counts are cached under key
+    and the filter.
+    """
+
+    def get_counts():
+        restaurant_ids = get_restaurant_ids() if get_restaurant_ids else None
+
+        if category_ids:
+            filtered_ids = get_category_restaurant_ids(category_ids, match_all)
+
+            if restaurant_ids is None:
+                restaurant_ids = filtered_ids
+            else:
+                restaurant_ids = restaurant_ids.filter(
+                    Restaurant.restaurant_id.in_(filtered_ids.subquery()))
+
+        return count_categories(restaurant_ids, category_ids)
+
+    facets = facet_cache.get_or_set((key, category_ids, match_all), get_counts)
+
+    return [dict(facet, selected=facet["category_id"] in category_ids) for facet in facets]
+
+
+def get_filter_url(path, category_ids, match_all=False, toggle=None, **params):
+    """
+    Return the URL of path with a category filter, toggling the category with id toggle in or out of it.
+
+    Other query string parameters (e.g. q) can be passed as keyword arguments.
+    """
+
+    category_ids = set(category_ids)
+
+    if toggle is not None:
+        category_ids ^= set([toggle])
+
+    args = [(name, value) for name, value in sorted(params.items()) if value]
+    args.extend(("category", category_id) for category_id in sorted(category_ids))
+
+    if match_all:
+        args.append(("match", "all"))
+
+    return "%s?%s" % (path, urllib.urlencode([(name, unicode(value).encode("utf-8")) for name, value in args]))
+
+
+# Freshly created tables (e.g. between tests) make the cached counts stale
+event.listen(db.metadata, "after_create", lambda target, connection, **kw: facet_cache.clear())
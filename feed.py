@@ -0,0 +1,243 @@
+"""Friends' activity feed, fanned out on write
+
+When a user adds a visit, it's copied into the feed_items of each of their friends in
+a single INSERT ... SELECT over their friendships. Reading a feed page is then one
+range scan of the reader's feed_items, newest first, continuing from a cursor.
+
+Users with FANOUT_MAX_FRIENDS or more friends would write that many rows per visit,
+so their visits aren't fanned out. Instead, feed reads pull the visits of any such
+friends straight from the visits table (fan-out on read) and merge them in.
+
+Feeds only keep the newest FEED_MAX_ITEMS items each. Older items are deleted by:
+    python feed.py
+
+and every feed can be rebuilt from the visits and connections tables (e.g. after a
+bulk load) with:
+    python feed.py --rebuild
+"""
+
+from sqlalchemy import func, text, union
+
+from model import User, Restaurant, Visit, FeedItem, Connection
+from model import connect_to_db, db
+
+from cache import LRUCache
+from metrics import metrics
+from pagination import encode_cursor, decode_cursor, get_page_size, InvalidCursor, DEFAULT_PAGE_SIZE
+
+import argparse
+
+# Users with this many friends or more are fanned out on read instead of on write
+FANOUT_MAX_FRIENDS = 1000
+
+# Items kept in each user's feed
+FEED_MAX_ITEMS = 500
+
+# Recent visits copied into each user's feed when they become friends
+FRIEND_BACKFILL_ITEMS = 20
+
+# Users whose feeds are rebuilt per statement
+REBUILD_BATCH_USERS = 1000
+
+# The ids of users fanned out on read are looked up at most this often
+POPULAR_USERS_TTL_SECONDS = 60
+
+popular_users_cache = LRUCache(maxsize=1, ttl=POPULAR_USERS_TTL_SECONDS)
+
+metrics.register_cache("popular_users", popular_users_cache)
+
+
+def get_popular_user_ids():
+    """Return the ids of users whose visits are fanned out on read."""
+
+    return popular_users_cache.get_or_set("ids", lambda: frozenset(
+        user_id for user_id, in db.session.query(User.user_id).filter(User.num_friends >= FANOUT_MAX_FRIENDS)))
+
+
+def fan_out_visit(visit):
+    """
+    Add a visit to the feeds of its user's friends, unless the user has too many friends.
+
+    The visit must have been flushed, so it has an id. Returns the number of feeds it was added to.
+
+    Note: This does not commit, so the feeds change in the same transaction as the visit.
+    """
+
+    result = db.session.execute(text("""
+        INSERT INTO feed_items (user_id, visit_id, author_id, restaurant_id, "visited_At")
+        SELECT friendship.user_b_id, :visit_id, :author_id, :restaurant_id, :visited_at
+        FROM connections AS friendship
+        WHERE friendship.user_a_id = :author_id
+        AND friendship.status = 'Accepted'
+        AND (SELECT num_friends FROM users WHERE user_id = :author_id) < :max_friends
+        """), {"visit_id": visit.visit_id,
+               "author_id": visit.user_id,
+               "restaurant_id": visit.restaurant_id,
+               "visited_at": visit.visited_At,
+               "max_friends": FANOUT_MAX_FRIENDS})
+
+    return result.rowcount
+
+
+def backfill_feed(user_id, friend_id, limit=FRIEND_BACKFILL_ITEMS):
+    """
+    Add a new friend's most recent visits to a user's feed.
+
+    Note: This does not commit, so the feed changes in the same transaction as the friendship.
+    """
+
+    db.session.execute(text("""
+        INSERT INTO feed_items (user_id, visit_id, author_id, restaurant_id, "visited_At")
+        SELECT :user_id, visit.visit_id, visit.user_id, visit.restaurant_id, visit."visited_At"
+        FROM visits AS visit
+        WHERE visit.user_id = :friend_id
+        AND (SELECT num_friends FROM users WHERE user_id = :friend_id) < :max_friends
+        AND NOT EXISTS (SELECT 1 FROM feed_items AS item
+                        WHERE item.user_id = :user_id
+                        AND item.visit_id = visit.visit_id)
+        ORDER BY visit.visit_id DESC
+        LIMIT :limit
+        """), {"user_id": user_id, "friend_id": friend_id, "max_friends": FANOUT_MAX_FRIENDS, "limit": limit})
+
+
+def get_feed(user_id, before=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Return a page of user's feed, newest first, and the cursor for the next page.
+
+    Each item has the visit's id and time, the friend who left it and the restaurant.
+    Pages continue from visits older than before, a visit id. The next cursor is None
+    when this is the last page.
+    """
+
+    items = db.session.query(FeedItem.visit_id,
+                             FeedItem.author_id,
+                             FeedItem.restaurant_id,
+                             FeedItem.visited_At).filter(FeedItem.user_id == user_id)
+
+    if before is not None:
+        items = items.filter(FeedItem.visit_id < before)
+
+    items = items.order_by(FeedItem.visit_id.desc()).limit(page_size + 1).subquery()
+
+    popular_user_ids = get_popular_user_ids()
+
+    if popular_user_ids:
+        # Friends with too many friends to fan out, found by probing the (user_a_id, user_b_id) index
+        popular_friend_ids = db.session.query(Connection.user_b_id).filter(
+            Connection.user_a_id == user_id,
+            Connection.status == "Accepted",
+            Connection.user_b_id.in_(popular_user_ids))
+
+        pulled = db.session.query(Visit.visit_id,
+                                  Visit.user_id,
+                                  Visit.restaurant_id,
+                                  Visit.visited_At).filter(Visit.user_id.in_(popular_friend_ids.subquery()))
+
+        if before is not None:
+            pulled = pulled.filter(Visit.visit_id < before)
+
+        pulled = pulled.order_by(Visit.visit_id.desc()).limit(page_size + 1)
+
+        # UNION drops visits fanned out before their user became popular, which are in both
+        items = union(items.select(), pulled.subquery().select()).alias()
+
+    page = db.session.query(items.c.visit_id,
+                            items.c.visited_At,
+                            User.user_id,
+                            User.first_name,
+                            User.last_name,
+                            Restaurant.restaurant_id,
+                            Restaurant.name,
+                            Restaurant.image_url).join(
+                                User, User.user_id == items.c.author_id).join(
+                                Restaurant, Restaurant.restaurant_id == items.c.restaurant_id).order_by(
+                                items.c.visit_id.desc()).limit(page_size + 1).all()
+
+    if len(page) <= page_size:
+        return page, None
+
+    page = page[:page_size]
+
+    return page, encode_cursor([page[-1].visit_id])
+
+
+def paginate_feed_request(user_id, args):
+    """Return a page of user's feed using the cursor and per_page arguments of a request."""
+
+    cursor = decode_cursor(args.get("cursor"))
+
+    if cursor is not None and (len(cursor) != 1 or not isinstance(cursor[0], (int, long))):
+        raise InvalidCursor("Invalid cursor: %s" % args.get("cursor"))
+
+    return get_feed(user_id, cursor[0] if cursor else None, get_page_size(args.get("per_page")))
+
+
+def trim_feeds(max_items=FEED_MAX_ITEMS):
+    """Delete all but the newest max_items of every user's feed. Returns the number of items deleted."""
+
+    result = db.session.execute(text("""
+        DELETE FROM feed_items
+        USING (SELECT user_id, visit_id
+               FROM (SELECT user_id, visit_id,
+                            row_number() OVER (PARTITION BY user_id ORDER BY visit_id DESC) AS position
+                     FROM feed_items) AS ranked
+               WHERE position > :max_items) AS old
+        WHERE feed_items.user_id = old.user_id
+        AND feed_items.visit_id = old.visit_id
+        """), {"max_items": max_items})
+
+    db.session.commit()
+
+    return result.rowcount
+
+
+def rebuild_feeds(max_items=FEED_MAX_ITEMS, batch_size=REBUILD_BATCH_USERS):
+    """
+    Rebuild every user's feed from the visits and connections tables. Returns the number of items added.
+
+    Feeds are filled batch_size user ids at a time, so no one statement runs over every
+    friendship's visits at once.
+    """
+
+    db.session.execute(text("DELETE FROM feed_items"))
+
+    min_user_id, max_user_id = db.session.query(func.min(User.user_id), func.max(User.user_id)).one()
+    num_items = 0
+
+    for start in xrange(min_user_id or 0, (max_user_id or 0) + 1, batch_size):
+        result = db.session.execute(text("""
+            INSERT INTO feed_items (user_id, visit_id, author_id, restaurant_id, "visited_At")
+            SELECT user_id, visit_id, author_id, restaurant_id, "visited_At"
+            FROM (SELECT friendship.user_a_id AS user_id, visit.visit_id, visit.user_id AS author_id,
+                         visit.restaurant_id, visit."visited_At",
+                         row_number() OVER (PARTITION BY friendship.user_a_id ORDER BY visit.visit_id DESC) AS position
+                  FROM connections AS friendship
+                  JOIN visits AS visit ON visit.user_id = friendship.user_b_id
+                  JOIN users AS author ON author.user_id = visit.user_id
+                  WHERE friendship.status = 'Accepted'
+                  AND friendship.user_a_id >= :start AND friendship.user_a_id < :stop
+                  AND author.num_friends < :max_friends) AS ranked
+            WHERE position <= :max_items
+            """), {"start": start, "stop": start + batch_size,
+                   "max_friends": FANOUT_MAX_FRIENDS, "max_items": max_items})
+
+        num_items += result.rowcount
+
+    db.session.commit()
+
+    return num_items
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app, batch=True)
+
+    parser = argparse.ArgumentParser(description="Trim or rebuild friends' activity feeds.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="rebuild every feed from the visits and connections tables")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print "Added %s feed items." % rebuild_feeds()
+    else:
+        print "Deleted %s old feed items." % trim_feeds()
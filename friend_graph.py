@@ -0,0 +1,230 @@
+"""In-process cache of the friend graph, for fast friend checks and suggestions
+
+The graph holds every accepted friendship and pending friend request as adjacency
+sets of user ids. It is built in bulk from the connections table (or at startup), kept
+current by the friend request write paths in friends.py, and rebuilt in a background
+thread once it is older than MAX_AGE_SECONDS so changes made by other server processes
+show up. It is only a read cache: friends.py answers from the database while the graph
+is being built or rebuilt, and always checks the database before writing.
+"""
+
+from collections import defaultdict, Counter
+
+from sqlalchemy import event
+
+from model import Connection
+from model import db
+
+import heapq
+import threading
+import time
+
+# Rebuild the graph from the database once it's this old
+MAX_AGE_SECONDS = 300
+
+# Rows fetched per round trip when building the graph
+LOAD_BATCH_SIZE = 10000
+
+
+class FriendGraph(object):
+    """Adjacency sets of accepted friendships and pending friend requests between users."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Held while the graph is being built, so only one thread builds it at a time
+        self.load_lock = threading.Lock()
+        self.loaded_at = None
+        self.friends = defaultdict(set)
+        # Users a user has sent pending friend requests to, and received them from
+        self.sent = defaultdict(set)
+        self.received = defaultdict(set)
+        # Changes made while the graph is being built, replayed onto it once it's swapped in
+        self.pending = None
+
+    @property
+    def loaded(self):
+        """Check if the graph has been built."""
+
+        return self.loaded_at is not None
+
+    @property
+    def stale(self):
+        """Check if the graph is due to be rebuilt."""
+
+        return self.loaded_at is not None and time.time() - self.loaded_at >= MAX_AGE_SECONDS
+
+    def load(self):
+        """Build the graph from every connection in one streamed query, then swap it in."""
+
+        with self.lock:
+            self.pending = []
+            loaded_at = time.time()
+
+        friends = defaultdict(set)
+        sent = defaultdict(set)
+        received = defaultdict(set)
+
+        try:
+            connections = db.session.query(Connection.user_a_id,
+                                           Connection.user_b_id,
+                                           Connection.status).yield_per(LOAD_BATCH_SIZE)
+
+            for user_a_id, user_b_id, status in connections:
+                if status == "Accepted":
+                    friends[user_a_id].add(user_b_id)
+                    friends[user_b_id].add(user_a_id)
+                elif status == "Requested":
+                    sent[user_a_id].add(user_b_id)
+                    received[user_b_id].add(user_a_id)
+
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+
+        with self.lock:
+            # The graph was cleared while loading (e.g. the tables were recreated), so this one's out of date
+            if self.pending is None:
+                return
+
+            self.friends, self.sent, self.received = friends, sent, received
+            self.loaded_at = loaded_at
+
+            # Changes committed while loading may have been missed by the query; replaying is idempotent
+            pending, self.pending = self.pending, None
+
+            for change, user_a_id, user_b_id in pending:
+                change(user_a_id, user_b_id)
+
+    def ensure_loaded(self):
+        """Build the graph if it hasn't been built yet, or start rebuilding it in the background if it's stale."""
+
+        if not self.loaded:
+            with self.load_lock:
+                # Another request may have built it while this one waited
+                if not self.loaded:
+                    self.load()
+
+        elif self.stale:
+            self.start_refresh()
+
+    def is_current(self):
+        """
+        Check if the graph is built and not stale, starting to build it in the background if not.
+
+        Unlike ensure_loaded, this never waits for a build, so callers can read from the database instead.
+        """
+
+        if self.loaded and not self.stale:
+            return True
+
+        self.start_refresh()
+
+        return False
+
+    def start_refresh(self):
+        """Start building the graph in a background thread, unless it's already being built."""
+
+        if self.load_lock.acquire(False):
+            thread = threading.Thread(target=self.refresh, args=(db.get_app(),))
+            thread.daemon = True
+            thread.start()
+
+    def refresh(self, app):
+        """Build the graph in a background thread started by start_refresh, which holds load_lock for it."""
+
+        try:
+            with app.app_context():
+                try:
+                    self.load()
+                finally:
+                    db.session.remove()
+
+        except Exception:
+            app.logger.exception("Couldn't rebuild the friend graph")
+
+        finally:
+            self.load_lock.release()
+
+    def clear(self):
+        """Forget the graph, so it's rebuilt the next time it's needed."""
+
+        with self.lock:
+            self.friends, self.sent, self.received = defaultdict(set), defaultdict(set), defaultdict(set)
+            self.loaded_at = None
+            # A graph being built now is thrown away once it's loaded
+            self.pending = None
+
+    def add_request(self, user_a_id, user_b_id):
+        """Record a pending friend request from user_a to user_b."""
+
+        with self.lock:
+            self.sent[user_a_id].add(user_b_id)
+            self.received[user_b_id].add(user_a_id)
+
+            if self.pending is not None:
+                self.pending.append((self.add_request, user_a_id, user_b_id))
+
+    def accept_request(self, user_a_id, user_b_id):
+        """Record that user_b accepted user_a's friend request, and any request user_b sent user_a."""
+
+        with self.lock:
+            self.sent[user_a_id].discard(user_b_id)
+            self.received[user_b_id].discard(user_a_id)
+            self.sent[user_b_id].discard(user_a_id)
+            self.received[user_a_id].discard(user_b_id)
+            self.friends[user_a_id].add(user_b_id)
+            self.friends[user_b_id].add(user_a_id)
+
+            if self.pending is not None:
+                self.pending.append((self.accept_request, user_a_id, user_b_id))
+
+    def get_friend_ids(self, user_id):
+        """Return the set of user's friends' ids."""
+
+        with self.lock:
+            return set(self.friends.get(user_id, ()))
+
+    def get_request_ids(self, user_id):
+        """Return the sets of user ids that user received and sent pending friend requests from/to."""
+
+        with self.lock:
+            return set(self.received.get(user_id, ())), set(self.sent.get(user_id, ()))
+
+    def is_friends_or_pending(self, user_a_id, user_b_id):
+        """Check if user_a and user_b are friends, and if there is a pending friend request between them."""
+
+        with self.lock:
+            is_pending = user_b_id in self.sent.get(user_a_id, ()) or user_b_id in self.received.get(user_a_id, ())
+
+            return user_b_id in self.friends.get(user_a_id, ()), is_pending
+
+    def suggest_friends(self, user_id, limit=10):
+        """
+        Return "people you may know" for user, ranked by number of mutual friends.
+
+        Returns a list of (user_id, mutual_friends) tuples, excluding the user's friends and
+        anyone they have a pending request with.
+        """
+
+        with self.lock:
+            friend_ids = self.friends.get(user_id, set())
+            excluded = friend_ids | self.sent.get(user_id, set()) | self.received.get(user_id, set())
+            excluded.add(user_id)
+
+            mutual_friends = Counter()
+
+            for friend_id in friend_ids:
+                mutual_friends.update(self.friends.get(friend_id, ()))
+
+        for excluded_id in excluded:
+            mutual_friends.pop(excluded_id, None)
+
+        # Most mutual friends first, ties broken by lowest user_id for a stable order
+        return heapq.nsmallest(limit, mutual_friends.items(), key=lambda item: (-item[1], item[0]))
+
+
+friend_graph = FriendGraph()
+
+# Freshly created tables (e.g. between tests) make the cached graph stale
+event.listen(db.metadata, "after_create", lambda target, connection, **kw: friend_graph.clear())
@@ -3,22 +3,52 @@
 from model import Connection, User
 from model import db
 
+from counters import increment_counters
+from friend_graph import friend_graph
+from feed import backfill_feed
+
+from sqlalchemy import and_, false, or_, text
+from sqlalchemy.exc import IntegrityError
+
+# Relationship statuses returned by get_relationship_statuses
+ACCEPTED = "accepted"
+PENDING_OUT = "pending_out"
+PENDING_IN = "pending_in"
+NONE = "none"
+
 
 def is_friends_or_pending(user_a_id, user_b_id):
     """
     Checks the friend status between user_a and user_b.
 
     Checks if user_a and user_b are friends.
-    Checks if there is a pending friend request from user_a to user_b.
+    Checks if there is a pending friend request between user_a and user_b, sent by either user.
+
+    Answered from the in-memory friend graph when it's current, otherwise from the database.
+    """
+
+    if friend_graph.is_current():
+        return friend_graph.is_friends_or_pending(int(user_a_id), int(user_b_id))
+
+    return get_connection_status(user_a_id, user_b_id)
+
+
+def get_connection_status(user_a_id, user_b_id):
+    """
+    Check if user_a and user_b are friends, and if there is a pending friend request between them, in one indexed query.
+
+    Unlike is_friends_or_pending, this always reads the database, for checks before a write.
     """
 
-    is_friends = db.session.query(Connection).filter(Connection.user_a_id == user_a_id,
-                                                     Connection.user_b_id == user_b_id,
-                                                     Connection.status == "Accepted").first()
+    connections = db.session.query(Connection.status).filter(or_(and_(Connection.user_a_id == user_a_id,
+                                                                      Connection.user_b_id == user_b_id),
+                                                                 and_(Connection.user_a_id == user_b_id,
+                                                                      Connection.user_b_id == user_a_id)))
 
-    is_pending = db.session.query(Connection).filter(Connection.user_a_id == user_a_id,
-                                                     Connection.user_b_id == user_b_id,
-                                                     Connection.status == "Requested").first()
+    statuses = set(connection.status for connection in connections)
+
+    is_friends = "Accepted" in statuses
+    is_pending = "Requested" in statuses
 
     return is_friends, is_pending
 
@@ -31,26 +61,241 @@ def get_friend_requests(user_id):
     Returns users that user sent friend requests to.
     """
 
-    received_friend_requests = db.session.query(User).filter(Connection.user_b_id == user_id,
-                                                             Connection.status == "Requested").join(Connection,
-                                                                                                    Connection.user_a_id == User.user_id).all()
+    if friend_graph.is_current():
+        received_ids, sent_ids = friend_graph.get_request_ids(int(user_id))
+        users = get_users_by_id(received_ids | sent_ids).all()
+
+        return ([user for user in users if user.user_id in received_ids],
+                [user for user in users if user.user_id in sent_ids])
+
+    # Get both directions in one query, noting who sent each request
+    friend_requests = db.session.query(User, Connection.user_a_id).join(Connection,
+                                                                        or_(and_(Connection.user_a_id == User.user_id,
+                                                                                 Connection.user_b_id == user_id),
+                                                                            and_(Connection.user_b_id == User.user_id,
+                                                                                 Connection.user_a_id == user_id)))
+    friend_requests = friend_requests.filter(Connection.status == "Requested").all()
 
-    sent_friend_requests = db.session.query(User).filter(Connection.user_a_id == user_id,
-                                                         Connection.status == "Requested").join(Connection,
-                                                                                                Connection.user_b_id == User.user_id).all()
+    received_friend_requests = [user for user, sender_id in friend_requests if sender_id == user.user_id]
+    sent_friend_requests = [user for user, sender_id in friend_requests if sender_id != user.user_id]
 
     return received_friend_requests, sent_friend_requests
 
 
+def get_relationship_statuses(user_id, other_user_ids):
+    """
+    Get user's relationship with each of a list of other users, from the friend graph when it's current or in one query.
+
+    Returns a dictionary of each other user's id to ACCEPTED (friends), PENDING_OUT (user sent
+    them a friend request), PENDING_IN (they sent user a friend request) or NONE.
+    """
+
+    user_id = int(user_id)
+    other_user_ids = set(int(other_user_id) for other_user_id in other_user_ids)
+    statuses = dict((other_user_id, NONE) for other_user_id in other_user_ids)
+
+    if not other_user_ids:
+        return statuses
+
+    if friend_graph.is_current():
+        friend_ids = friend_graph.get_friend_ids(user_id)
+        received_ids, sent_ids = friend_graph.get_request_ids(user_id)
+
+        for other_user_id in other_user_ids:
+            if other_user_id in friend_ids:
+                statuses[other_user_id] = ACCEPTED
+            elif other_user_id in sent_ids:
+                statuses[other_user_id] = PENDING_OUT
+            elif other_user_id in received_ids:
+                statuses[other_user_id] = PENDING_IN
+
+        return statuses
+
+    # Both directions are read in one query, each side using one of the composite indexes
+    connections = db.session.query(Connection.user_a_id,
+                                   Connection.user_b_id,
+                                   Connection.status).filter(or_(and_(Connection.user_a_id == user_id,
+                                                                      Connection.user_b_id.in_(other_user_ids)),
+                                                                 and_(Connection.user_b_id == user_id,
+                                                                      Connection.user_a_id.in_(other_user_ids))))
+
+    for connection in connections:
+        if connection.status == "Accepted":
+            statuses[connection.user_b_id if connection.user_a_id == user_id else connection.user_a_id] = ACCEPTED
+        elif connection.user_a_id == user_id and statuses[connection.user_b_id] != ACCEPTED:
+            statuses[connection.user_b_id] = PENDING_OUT
+        elif connection.user_b_id == user_id and statuses[connection.user_a_id] != ACCEPTED:
+            statuses[connection.user_a_id] = PENDING_IN
+
+    return statuses
+
+
+def get_users_by_id(user_ids):
+    """Return a query for the users with the given ids."""
+
+    if not user_ids:
+        # An empty IN () isn't valid SQL, so match nothing instead
+        return db.session.query(User).filter(false())
+
+    return db.session.query(User).filter(User.user_id.in_(user_ids))
+
+
 def get_friends(user_id):
     """
     Return a query for user's friends
 
+    Accepted friendships are stored in both directions, so when the friend graph isn't
+    current this finds friends whichever user sent the request, in one scan of the
+    (user_a_id, status) index.
+
     Note: This does not return User objects, just the query
     """
 
+    if friend_graph.is_current():
+        return get_users_by_id(friend_graph.get_friend_ids(int(user_id)))
+
     friends = db.session.query(User).filter(Connection.user_a_id == user_id,
                                             Connection.status == "Accepted").join(Connection,
                                                                                   Connection.user_b_id == User.user_id)
 
     return friends
+
+
+def get_friend_ids(user_id):
+    """Return the set of user's friends' ids, from the friend graph or one index-only scan."""
+
+    if friend_graph.is_current():
+        return friend_graph.get_friend_ids(int(user_id))
+
+    return set(friend_id for friend_id, in db.session.query(Connection.user_b_id).filter(
+        Connection.user_a_id == user_id,
+        Connection.status == "Accepted"))
+
+
+def send_friend_request(user_a_id, user_b_id):
+    """
+    Add a friend request from user_a to user_b and update both users' request counters.
+
+    Check get_connection_status first, in the same transaction. Returns False, without
+    adding the request, if one from user_a to user_b was committed since.
+    """
+
+    requested_connection = Connection(user_a_id=user_a_id,
+                                      user_b_id=user_b_id,
+                                      status="Requested")
+    db.session.add(requested_connection)
+
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # Another server process added it first
+        db.session.rollback()
+        return False
+
+    increment_counters(user_a_id, num_sent_requests=1)
+    increment_counters(user_b_id, num_received_requests=1)
+
+    db.session.commit()
+
+    # Applied even to a stale graph, which keeps serving reads while it's rebuilt
+    friend_graph.add_request(int(user_a_id), int(user_b_id))
+
+    return True
+
+
+def accept_friend_request(user_a_id, user_b_id):
+    """
+    Accept the friend request user_a sent to user_b.
+
+    Accepted friendships are stored in both directions, so a connection from
+    user_b to user_a is added alongside the accepted request. If user_b had also
+    sent user_a a request, that request becomes the connection instead.
+
+    Returns False if there is no pending request to accept.
+    """
+
+    accepted = db.session.query(Connection).filter(Connection.user_a_id == user_a_id,
+                                                   Connection.user_b_id == user_b_id,
+                                                   Connection.status == "Requested").update({"status": "Accepted"},
+                                                                                            synchronize_session=False)
+
+    if not accepted:
+        return False
+
+    reverse_accepted = db.session.query(Connection).filter(Connection.user_a_id == user_b_id,
+                                                           Connection.user_b_id == user_a_id,
+                                                           Connection.status == "Requested").update(
+                                                               {"status": "Accepted"}, synchronize_session=False)
+
+    if not reverse_accepted:
+        db.session.add(Connection(user_a_id=user_b_id,
+                                  user_b_id=user_a_id,
+                                  status="Accepted"))
+
+        try:
+            db.session.flush()
+        except IntegrityError:
+            # The reverse connection was added by another server process since it was checked
+            db.session.rollback()
+            return False
+
+    increment_counters(user_a_id, num_sent_requests=-1, num_received_requests=-reverse_accepted, num_friends=1)
+    increment_counters(user_b_id, num_received_requests=-1, num_sent_requests=-reverse_accepted, num_friends=1)
+
+    # New friends see each other's recent visits in their feeds straight away
+    backfill_feed(user_a_id, user_b_id)
+    backfill_feed(user_b_id, user_a_id)
+
+    db.session.commit()
+
+    friend_graph.accept_request(int(user_a_id), int(user_b_id))
+
+    return True
+
+
+def suggest_friends(user_id, limit=10):
+    """
+    Get "people you may know" for user, ranked by number of mutual friends.
+
+    Suggestions are computed from the in-memory friend graph, which is built if needed.
+    Returns a list of (User, number of mutual friends) tuples.
+    """
+
+    friend_graph.ensure_loaded()
+
+    suggestions = friend_graph.suggest_friends(int(user_id), limit)
+    users = dict((user.user_id, user) for user in get_users_by_id([suggested_id for suggested_id, _ in suggestions]))
+
+    return [(users[suggested_id], mutual_friends) for suggested_id, mutual_friends in suggestions
+            if suggested_id in users]
+
+
+def add_missing_reverse_friendships():
+    """
+    Add the reverse row for any accepted friendship stored in only one direction.
+
+    Returns the number of rows added.
+    """
+
+    result = db.session.execute(text("""
+        INSERT INTO connections (user_a_id, user_b_id, status)
+        SELECT accepted.user_b_id, accepted.user_a_id, 'Accepted'
+        FROM connections AS accepted
+        WHERE accepted.status = 'Accepted'
+        AND NOT EXISTS (SELECT 1 FROM connections AS reverse
+                        WHERE reverse.user_a_id = accepted.user_b_id
+                        AND reverse.user_b_id = accepted.user_a_id)
+        """))
+
+    db.session.commit()
+
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    # Running this module backfills friendships stored in only one direction
+    from model import connect_to_db
+    from server import app
+    connect_to_db(app, batch=True)
+
+    print "Added %s reverse friendships." % add_missing_reverse_friendships()
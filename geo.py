@@ -0,0 +1,148 @@
+"""Restaurants in a map viewport, and nearest to a point
+
+Both searches use the GiST index on each restaurant's location as a point on the
+earth (RESTAURANT_EARTH_POINT, from PostgreSQL's cube and earthdistance extensions):
+
+    - A viewport is covered by a circle around its center, and earth_box() turns that
+      circle into a cube the index can search. Restaurants in the cube are then
+      filtered to the viewport's exact latitudes and longitudes.
+    - Nearest restaurants are found with cube's <-> distance operator, which the index
+      can return in order, so finding the k nearest only reads about k rows.
+"""
+
+from sqlalchemy import func, or_
+
+from model import Restaurant, RESTAURANT_LATITUDE, RESTAURANT_LONGITUDE, RESTAURANT_EARTH_POINT
+from model import db
+
+DEFAULT_NEARBY_LIMIT = 20
+MAX_NEARBY_LIMIT = 100
+
+# Most restaurants returned for a viewport, nearest its center first
+MAX_VIEWPORT_RESULTS = 500
+
+
+class InvalidBounds(ValueError):
+    """Raised when map bounds aren't "south,west,north,east" in degrees."""
+
+
+class InvalidLocation(ValueError):
+    """Raised when a point isn't a latitude and longitude in degrees."""
+
+
+def parse_bounds(bounds):
+    """
+    Parse map bounds given as "south,west,north,east", as LatLngBounds.toUrlValue() formats them.
+
+    Returns None if bounds is empty. The west edge may be east of the east edge, when the
+    bounds cross the antimeridian.
+    """
+
+    if not bounds:
+        return None
+
+    try:
+        south, west, north, east = [float(value) for value in bounds.split(",")]
+    except ValueError:
+        raise InvalidBounds("Bounds must be south,west,north,east in degrees.")
+
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        raise InvalidBounds("Bounds must be south,west,north,east in degrees.")
+
+    return south, west, north, east
+
+
+def parse_location(latitude, longitude):
+    """Return a latitude and longitude from the query string as floats."""
+
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise InvalidLocation("Location must be a lat and lng in degrees.")
+
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise InvalidLocation("Location must be a lat and lng in degrees.")
+
+    return latitude, longitude
+
+
+def get_nearby_limit(limit):
+    """Return the number of nearest restaurants asked for, capped at MAX_NEARBY_LIMIT."""
+
+    return max(1, min(limit or DEFAULT_NEARBY_LIMIT, MAX_NEARBY_LIMIT))
+
+
+def get_viewport_center(bounds):
+    """Return the latitude and longitude at the center of bounds."""
+
+    south, west, north, east = bounds
+
+    # Bounds crossing the antimeridian are wider than east - west suggests
+    if west > east:
+        east += 360
+
+    longitude = (west + east) / 2.0
+
+    return (south + north) / 2.0, longitude - 360 if longitude > 180 else longitude
+
+
+def query_restaurants():
+    """Return a query for the open restaurants, with the columns map markers need and coordinates as floats."""
+
+    return db.session.query(Restaurant.restaurant_id,
+                            Restaurant.name,
+                            Restaurant.address,
+                            Restaurant.phone,
+                            Restaurant.image_url,
+                            RESTAURANT_LATITUDE.label("latitude"),
+                            RESTAURANT_LONGITUDE.label("longitude")).filter(Restaurant.is_closed == False)
+
+
+def find_restaurants_in_viewport(bounds, limit=MAX_VIEWPORT_RESULTS):
+    """Return restaurants inside map bounds, nearest the center first."""
+
+    south, west, north, east = bounds
+    center = func.ll_to_earth(*get_viewport_center(bounds))
+
+    # The circle through the viewport's corners covers all of it
+    radius = func.greatest(func.earth_distance(center, func.ll_to_earth(south, west)),
+                           func.earth_distance(center, func.ll_to_earth(south, east)),
+                           func.earth_distance(center, func.ll_to_earth(north, west)),
+                           func.earth_distance(center, func.ll_to_earth(north, east)))
+
+    if west <= east:
+        in_longitudes = RESTAURANT_LONGITUDE.between(west, east)
+    else:
+        in_longitudes = or_(RESTAURANT_LONGITUDE >= west, RESTAURANT_LONGITUDE <= east)
+
+    return query_restaurants().filter(func.earth_box(center, radius).op("@>")(RESTAURANT_EARTH_POINT),
+                                      RESTAURANT_LATITUDE.between(south, north),
+                                      in_longitudes).order_by(
+                                          RESTAURANT_EARTH_POINT.op("<->")(center)).limit(limit).all()
+
+
+def find_nearest_restaurants(latitude, longitude, limit=DEFAULT_NEARBY_LIMIT):
+    """Return the restaurants nearest a point, nearest first, with their distance from it in meters."""
+
+    point = func.ll_to_earth(latitude, longitude)
+
+    return query_restaurants().add_columns(
+        func.earth_distance(RESTAURANT_EARTH_POINT, point).label("distance")).order_by(
+            RESTAURANT_EARTH_POINT.op("<->")(point)).limit(limit).all()
+
+
+def serialize_restaurant(restaurant):
+    """Return a restaurant row from query_restaurants() as a dictionary for JSON."""
+
+    serialized = {"restaurant_id": restaurant.restaurant_id,
+                  "name": restaurant.name,
+                  "address": restaurant.address,
+                  "phone": restaurant.phone,
+                  "image_url": restaurant.image_url,
+                  "latitude": restaurant.latitude,
+                  "longitude": restaurant.longitude}
+
+    if "distance" in restaurant.keys():
+        serialized["distance"] = restaurant.distance
+
+    return serialized
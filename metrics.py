@@ -0,0 +1,326 @@
+"""Operational metrics, served at /metrics in Prometheus text format
+
+Request counts and latencies, in-flight requests, database pool checkout waits and
+cache stats are collected in process. Recording a sample only touches a dictionary
+owned by the current thread, so it takes no locks; the per-thread dictionaries are
+only summed when metrics are scraped.
+
+Multi-process WSGI servers (e.g. gunicorn with several workers) serve each scrape from
+one worker, so set METRICS_DIR to a directory shared by the workers. Each worker then
+writes a snapshot of its metrics there at most every FLUSH_INTERVAL_SECONDS, and a
+scrape sums every worker's snapshot. Counters from workers that have exited are kept,
+so totals never go backwards; gauges are only counted for workers still running.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import g, request
+
+import json
+import os
+import threading
+import time
+import timeit
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POOL_CHECKOUT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# How often each process writes its snapshot to METRICS_DIR
+FLUSH_INTERVAL_SECONDS = 5
+
+# Metric name -> (type, help text)
+METRICS = {
+    "breadcrumbs_http_requests_total": ("counter", "HTTP requests handled, by endpoint, method and status."),
+    "breadcrumbs_http_request_duration_seconds": ("histogram", "Time taken to handle HTTP requests, by endpoint."),
+    "breadcrumbs_http_requests_in_progress": ("gauge", "HTTP requests being handled right now."),
+    "breadcrumbs_db_pool_checkout_seconds": ("histogram",
+                                             "Time spent waiting to check a connection out of the database pool."),
+    "breadcrumbs_cache_hits_total": ("counter", "Cache lookups that found a value, by cache."),
+    "breadcrumbs_cache_misses_total": ("counter", "Cache lookups that found nothing, by cache."),
+    "breadcrumbs_cache_evictions_total": ("counter", "Entries evicted from a full cache, by cache."),
+    "breadcrumbs_cache_entries": ("gauge", "Entries held in a cache, by cache."),
+    "breadcrumbs_cache_hit_ratio": ("gauge", "Share of cache lookups that found a value, by cache."),
+}
+
+
+def format_labels(labels):
+    """Format a tuple of (name, value) label pairs in Prometheus' {name="value"} syntax."""
+
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def format_bound(bound):
+    """Format a histogram bucket's upper bound."""
+
+    return "+Inf" if bound is None else repr(float(bound))
+
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and histograms, recorded into per-thread dictionaries.
+
+    Samples are keyed by (metric name, label pairs, histogram bucket). Histogram
+    observations are counted in the one bucket they fall in; buckets are made
+    cumulative, as Prometheus expects, when rendered.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # (thread, samples) for every thread that has recorded something
+        self.thread_samples = []
+        # Samples from threads that have finished
+        self.retired_samples = defaultdict(float)
+        # name -> LRUCache-like object with a stats() method
+        self.caches = {}
+        self.histogram_buckets = {"breadcrumbs_http_request_duration_seconds": LATENCY_BUCKETS,
+                                  "breadcrumbs_db_pool_checkout_seconds": POOL_CHECKOUT_BUCKETS}
+        self.metrics_dir = None
+        self.flushed_at = 0
+
+    def get_samples(self):
+        """Return the current thread's samples, which only this thread writes to."""
+
+        samples = getattr(self.local, "samples", None)
+
+        if samples is None:
+            samples = self.local.samples = defaultdict(float)
+
+            with self.lock:
+                self.thread_samples.append((threading.current_thread(), samples))
+
+        return samples
+
+    def inc(self, name, labels=(), amount=1):
+        """Add amount to a counter or gauge."""
+
+        self.get_samples()[(name, labels, None)] += amount
+
+    def observe(self, name, value, labels=()):
+        """Record a histogram observation."""
+
+        buckets = self.histogram_buckets[name]
+        index = bisect_left(buckets, value)
+        bound = buckets[index] if index < len(buckets) else None
+
+        samples = self.get_samples()
+        samples[(name, labels, bound)] += 1
+        samples[(name + "_sum", labels, None)] += value
+
+    def register_cache(self, name, cache):
+        """Report a cache's stats() as metrics labelled with name."""
+
+        self.caches[name] = cache
+
+    def snapshot(self):
+        """Return this process' samples summed across threads, including cache stats."""
+
+        totals = defaultdict(float)
+
+        with self.lock:
+            # Fold finished threads' samples in, so the list doesn't grow with every thread ever started
+            running = []
+
+            for thread, samples in self.thread_samples:
+                if thread.is_alive():
+                    running.append((thread, samples))
+                else:
+                    for key, value in samples.items():
+                        self.retired_samples[key] += value
+
+            self.thread_samples = running
+
+            for key, value in self.retired_samples.items():
+                totals[key] += value
+
+            for _, samples in running:
+                # items() copies the samples, as their owning thread may add keys while we read
+                for key, value in samples.items():
+                    totals[key] += value
+
+        for name, cache in self.caches.items():
+            stats = cache.stats()
+            labels = (("cache", name),)
+            totals[("breadcrumbs_cache_hits_total", labels, None)] += stats["hits"]
+            totals[("breadcrumbs_cache_misses_total", labels, None)] += stats["misses"]
+            totals[("breadcrumbs_cache_evictions_total", labels, None)] += stats["evictions"]
+            totals[("breadcrumbs_cache_entries", labels, None)] += stats["size"]
+
+        return totals
+
+    def get_snapshot_path(self, pid):
+        """Return the path of a process' snapshot in the metrics directory."""
+
+        return os.path.join(self.metrics_dir, "metrics-%s.json" % pid)
+
+    def flush(self, force=False):
+        """Write this process' snapshot to the metrics directory, if it's due (or forced)."""
+
+        if not self.metrics_dir or (not force and time.time() - self.flushed_at < FLUSH_INTERVAL_SECONDS):
+            return
+
+        self.flushed_at = time.time()
+
+        path = self.get_snapshot_path(os.getpid())
+        temp_path = "%s.%s.tmp" % (path, threading.current_thread().ident)
+
+        with open(temp_path, "w") as snapshot_file:
+            json.dump([[name, labels, bound, value] for (name, labels, bound), value in self.snapshot().items()],
+                      snapshot_file)
+
+        # Rename is atomic, so a scrape never reads a half-written snapshot
+        os.rename(temp_path, path)
+
+    def collect(self):
+        """Return samples summed across every process sharing the metrics directory (or just this one)."""
+
+        if not self.metrics_dir:
+            return self.snapshot()
+
+        self.flush(force=True)
+
+        totals = defaultdict(float)
+
+        for filename in os.listdir(self.metrics_dir):
+            if not (filename.startswith("metrics-") and filename.endswith(".json")):
+                continue
+
+            pid = int(filename[len("metrics-"):-len(".json")])
+            is_running = is_process_running(pid)
+
+            try:
+                with open(os.path.join(self.metrics_dir, filename)) as snapshot_file:
+                    samples = json.load(snapshot_file)
+            except (IOError, ValueError):
+                continue
+
+            for name, labels, bound, value in samples:
+                if is_running or METRICS.get(name, ("counter",))[0] != "gauge":
+                    totals[(name, tuple(tuple(label) for label in labels), bound)] += value
+
+        return totals
+
+    def render(self):
+        """Return every metric in Prometheus text exposition format."""
+
+        samples = self.collect()
+
+        # Hit ratios are worked out from the summed hits and misses, so they're right across processes
+        for (name, labels, _), hits in samples.items():
+            if name == "breadcrumbs_cache_hits_total":
+                lookups = hits + samples.get(("breadcrumbs_cache_misses_total", labels, None), 0)
+                samples[("breadcrumbs_cache_hit_ratio", labels, None)] = hits / lookups if lookups else 0.0
+
+        by_metric = defaultdict(list)
+
+        for (name, labels, bound), value in samples.items():
+            metric = name[:-len("_sum")] if name.endswith("_sum") and name[:-len("_sum")] in METRICS else name
+            by_metric[metric].append((name, labels, bound, value))
+
+        lines = []
+
+        for metric in sorted(by_metric):
+            metric_type, help_text = METRICS.get(metric, ("untyped", ""))
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s %s" % (metric, metric_type))
+
+            if metric_type == "histogram":
+                lines.extend(self.render_histogram(metric, by_metric[metric]))
+            else:
+                for name, labels, _, value in sorted(by_metric[metric]):
+                    lines.append("%s%s %r" % (name, format_labels(labels), value))
+
+        return "\n".join(lines) + "\n"
+
+    def render_histogram(self, metric, samples):
+        """Return the cumulative bucket, sum and count lines for a histogram's samples."""
+
+        bucket_counts = defaultdict(dict)
+        sums = {}
+
+        for name, labels, bound, value in samples:
+            if name == metric:
+                bucket_counts[labels][bound] = value
+            else:
+                sums[labels] = value
+
+        lines = []
+
+        for labels in sorted(bucket_counts):
+            cumulative = 0
+
+            for bound in self.histogram_buckets[metric] + (None,):
+                cumulative += bucket_counts[labels].get(bound, 0)
+                lines.append("%s_bucket%s %r" % (metric, format_labels(labels + (("le", format_bound(bound)),)),
+                                                 float(cumulative)))
+
+            lines.append("%s_sum%s %r" % (metric, format_labels(labels), sums.get(labels, 0.0)))
+            lines.append("%s_count%s %r" % (metric, format_labels(labels), float(cumulative)))
+
+        return lines
+
+
+def is_process_running(pid):
+    """Check if a process with this pid is still running."""
+
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        # EPERM means it's running, but as another user
+        return error.errno == 1
+
+    return True
+
+
+metrics = MetricsRegistry()
+
+
+def init_metrics(app, metrics_dir=None):
+    """Record request counts, latencies and in-flight requests for app, and share them through metrics_dir."""
+
+    metrics.metrics_dir = metrics_dir
+
+    if metrics_dir and not os.path.isdir(metrics_dir):
+        os.makedirs(metrics_dir)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = timeit.default_timer()
+        metrics.inc("breadcrumbs_http_requests_in_progress")
+
+    def record_request(status):
+        endpoint = request.endpoint or "unmatched"
+        metrics.inc("breadcrumbs_http_requests_total",
+                    (("endpoint", endpoint), ("method", request.method), ("status", status)))
+        metrics.observe("breadcrumbs_http_request_duration_seconds",
+                        timeit.default_timer() - g.metrics_started,
+                        (("endpoint", endpoint),))
+        g.metrics_recorded = True
+
+    @app.after_request
+    def finish_request_metrics(response):
+        if getattr(g, "metrics_started", None) is not None:
+            record_request(response.status_code)
+
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(error=None):
+        if getattr(g, "metrics_started", None) is None:
+            return
+
+        # Unhandled exceptions skip after_request, and become 500s
+        if not getattr(g, "metrics_recorded", False):
+            record_request(500)
+
+        metrics.inc("breadcrumbs_http_requests_in_progress", amount=-1)
+        g.metrics_started = None
+        g.metrics_recorded = False
+
+        metrics.flush()
@@ -1,16 +1,19 @@
 """Models and database functions for Hackbright project (Breadcrumbs)."""
 
-from flask_sqlalchemy import SQLAlchemy
-
 import datetime
+import os
 
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy_searchable import make_searchable
 from sqlalchemy_utils.types import TSVectorType
 
+from database import RoutingSQLAlchemy, REPLICA_BIND
+
 # This is the connection to the PostgreSQL database; we're getting this through
 # the Flask-SQLAlchemy helper library. On this, we can find the `session`
 # object, where we do most of our interactions (like committing, etc.)
-db = SQLAlchemy()
+# RoutingSQLAlchemy adds statement timeouts, pool pings and read-replica routing.
+db = RoutingSQLAlchemy()
 
 make_searchable()
 
@@ -31,9 +34,17 @@ class User(db.Model):
     last_name = db.Column(db.String(100), nullable=False)
     # Put name inside TSVectorType definition for it to be fulltext-indexed (searchable)
     search_vector = db.Column(TSVectorType('first_name', 'last_name'))
+    # Denormalized counters, kept current by the write paths (see counters.py)
+    num_visits = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    num_friends = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    num_received_requests = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    num_sent_requests = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     city = db.relationship("City", backref=db.backref("users"))
 
+    # Composite index for keyset pagination of the users listing
+    __table_args__ = (db.Index("ix_users_name_user_id", "first_name", "last_name", "user_id"),)
+
     def __repr__(self):
         """Provide helpful representation when printed."""
 
@@ -48,6 +59,8 @@ class Restaurant(db.Model):
 
     restaurant_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     city_id = db.Column(db.Integer, db.ForeignKey('cities.city_id'), nullable=False)
+    # Yelp's business id, so re-seeding a city updates restaurants instead of duplicating them
+    yelp_id = db.Column(db.String(200), unique=True, nullable=True)
     name = db.Column(db.String(150), nullable=False)
     address = db.Column(db.String(150), nullable=False)
     phone = db.Column(db.String(20), nullable=True)
@@ -55,13 +68,20 @@ class Restaurant(db.Model):
     # Latitude and Longitude need to be Numeric, not Integer to have decimal places
     latitude = db.Column(db.Numeric, nullable=False)
     longitude = db.Column(db.Numeric, nullable=False)
-    # Put restaurant name and address inside definition of TSVectorType to be fulltext-indexed (searchable)
-    search_vector = db.Column(TSVectorType('name', 'address'))
+    # Set when the restaurant is closed on Yelp or drops out of its city's listing
+    is_closed = db.Column(db.Boolean, nullable=False, default=False, server_default="false")
+    # Full-text search document of the name, category names and address, kept current by
+    # triggers on restaurants, restaurantcategories and categories (see SEARCH_DOCUMENT_DDL)
+    search_document = db.Column(TSVECTOR)
 
     city = db.relationship("City", backref=db.backref("restaurants"))
     categories = db.relationship("Category", secondary="restaurantcategories", backref="restaurants")
     users = db.relationship("User", secondary="visits", backref="restaurants")
 
+    # Composite index for keyset pagination of the restaurants listing
+    __table_args__ = (db.Index("ix_restaurants_name_restaurant_id", "name", "restaurant_id"),
+                      db.Index("ix_restaurants_search_document", "search_document", postgresql_using="gin"))
+
     def __repr__(self):
         """Provide helpful representation when printed."""
 
@@ -79,10 +99,16 @@ class Visit(db.Model):
     visit_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
     restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.restaurant_id'), nullable=False)
+    visited_At = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
     user = db.relationship("User", backref=db.backref("visits"))
     restaurant = db.relationship("Restaurant", backref=db.backref("visits"))
 
+    # A user's visits, newest first, in one index range scan (e.g. for feeds, see feed.py),
+    # and a restaurant's visitors in one index-only scan (see visitors.py)
+    __table_args__ = (db.Index("ix_visits_user_id_visit_id", "user_id", "visit_id"),
+                      db.Index("ix_visits_restaurant_id_user_id", "restaurant_id", "user_id"))
+
     def __repr__(self):
         """Provide helpful representation when printed."""
 
@@ -90,6 +116,50 @@ class Visit(db.Model):
                                                          self.restaurant_id)
 
 
+class FeedItem(db.Model):
+    """A friend's restaurant visit in a user's activity feed, added when the visit is (see feed.py)."""
+
+    __tablename__ = "feed_items"
+
+    # The primary key index serves a user's feed, newest first, as one range scan
+    user_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), primary_key=True)
+    visit_id = db.Column(db.Integer, db.ForeignKey('visits.visit_id'), primary_key=True)
+    # Copied from the visit, so reading a feed doesn't need to look visits up
+    author_id = db.Column(db.Integer, db.ForeignKey('users.user_id'), nullable=False)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.restaurant_id'), nullable=False)
+    visited_At = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<FeedItem user_id=%s visit_id=%s>" % (self.user_id,
+                                                      self.visit_id)
+
+
+class RestaurantPopularity(db.Model):
+    """Rollup of a restaurant's breadcrumbs, for ranking a city's popular restaurants (see popular.py)."""
+
+    __tablename__ = "restaurant_popularity"
+
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.restaurant_id'), primary_key=True)
+    # Copied from the restaurant, so a city's ranking is one index scan
+    city_id = db.Column(db.Integer, db.ForeignKey('cities.city_id'), nullable=False)
+    num_visits = db.Column(db.Integer, nullable=False, default=0)
+    # Each visit's weight doubles every half-life after a fixed epoch, so adding a visit never
+    # rescales the others (see popular.get_trending_weight)
+    trending_score = db.Column(db.Float, nullable=False, default=0)
+    last_visited_At = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index("ix_restaurant_popularity_city_id_num_visits", "city_id", "num_visits"),
+                      db.Index("ix_restaurant_popularity_city_id_trending_score", "city_id", "trending_score"))
+
+    def __repr__(self):
+        """Provide helpful representation when printed."""
+
+        return "<RestaurantPopularity restaurant_id=%s num_visits=%s>" % (self.restaurant_id,
+                                                                         self.num_visits)
+
+
 class City(db.Model):
     """City where the restaurant is in."""
 
@@ -98,6 +168,7 @@ class City(db.Model):
     city_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     # Set default for timestamp of current time at UTC time zone
+    # Also records when the city's restaurants were last synced with Yelp
     updated_At = db.Column(db.DateTime, default=datetime.datetime.utcnow)
 
     def __repr__(self):
@@ -131,6 +202,10 @@ class RestaurantCategory(db.Model):
     restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurants.restaurant_id'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('categories.category_id'), nullable=False)
 
+    # The unique constraint's index finds a restaurant's categories, and this one a category's restaurants
+    __table_args__ = (db.UniqueConstraint("restaurant_id", "category_id"),
+                      db.Index("ix_restaurantcategories_category_id_restaurant_id", "category_id", "restaurant_id"))
+
     def __repr__(self):
         """Provide helpful representation when printed."""
 
@@ -147,8 +222,12 @@ class Image(db.Model):
     image_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     visit_id = db.Column(db.Integer, db.ForeignKey('visits.visit_id'), nullable=False)
     url = db.Column(db.String(200), nullable=False)
+    # SHA-256 of the original file, which names it and its thumbnails in storage (see photos.py)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
     uploaded_At = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     taken_At = db.Column(db.DateTime, nullable=True)
+    # Set once the photo's thumbnails have been made
+    processed_At = db.Column(db.DateTime, nullable=True)
     rating = db.Column(db.String(100), nullable=True)
 
     visit = db.relationship("Visit", backref=db.backref("images"))
@@ -175,6 +254,12 @@ class Connection(db.Model):
     user_a = db.relationship("User", foreign_keys=[user_a_id], backref=db.backref("sent_connections"))
     user_b = db.relationship("User", foreign_keys=[user_b_id], backref=db.backref("received_connections"))
 
+    # Accepted friendships are stored as two rows, one in each direction, so lookups by either
+    # user are a single index range scan. Pending requests are one row from sender to receiver.
+    __table_args__ = (db.UniqueConstraint("user_a_id", "user_b_id"),
+                      db.Index("ix_connections_user_a_id_status", "user_a_id", "status", "user_b_id"),
+                      db.Index("ix_connections_user_b_id_status", "user_b_id", "status", "user_a_id"))
+
     def __repr__(self):
         """Provide helpful representation when printed."""
 
@@ -184,15 +269,127 @@ class Connection(db.Model):
                                                                                       self.status)
 
 
+# Keyset sort keys for listing and search pages, each backed by a composite index above
+USER_SORT_KEY = [User.first_name, User.last_name, User.user_id]
+RESTAURANT_SORT_KEY = [Restaurant.name, Restaurant.restaurant_id]
+
+# Restaurant coordinates as double precision, which psycopg2 returns as floats instead of Decimals
+RESTAURANT_LATITUDE = db.cast(Restaurant.latitude, db.Float)
+RESTAURANT_LONGITUDE = db.cast(Restaurant.longitude, db.Float)
+
+# Restaurant's location as a point on the earth (earthdistance), with a GiST index for
+# radius and nearest-neighbour searches (see geo.py). Queries must use this exact expression.
+RESTAURANT_EARTH_POINT = db.func.ll_to_earth(RESTAURANT_LATITUDE, RESTAURANT_LONGITUDE)
+
+db.Index("ix_restaurants_earth_point", RESTAURANT_EARTH_POINT, postgresql_using="gist")
+
+# Restaurants' search documents weigh the name (A) above category names (B) above the
+# address (C). Symbols are stripped the same way SQLAlchemy-Searchable strips them. The
+# functions are replaced rather than created, as they outlive drop_all().
+SEARCH_DOCUMENT_DDL = """
+CREATE OR REPLACE FUNCTION restaurant_search_document(restaurant_name text, address text, restaurant_id integer)
+RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('pg_catalog.english', regexp_replace(coalesce($1, ''), '[-@.]', ' ', 'g')), 'A') ||
+           setweight(to_tsvector('pg_catalog.english', coalesce((SELECT string_agg(categories.name, ' ')
+                                                                 FROM restaurantcategories
+                                                                 JOIN categories USING (category_id)
+                                                                 WHERE restaurantcategories.restaurant_id = $3), '')), 'B') ||
+           setweight(to_tsvector('pg_catalog.english', regexp_replace(coalesce($2, ''), '[-@.]', ' ', 'g')), 'C')
+$$ LANGUAGE SQL STABLE;
+
+CREATE OR REPLACE FUNCTION restaurants_search_document_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_document := restaurant_search_document(NEW.name, NEW.address, NEW.restaurant_id);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION restaurantcategories_search_document_update() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE restaurants SET search_document = restaurant_search_document(name, address, restaurant_id)
+        WHERE restaurants.restaurant_id = OLD.restaurant_id;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        UPDATE restaurants SET search_document = restaurant_search_document(name, address, restaurant_id)
+        WHERE restaurants.restaurant_id = NEW.restaurant_id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION categories_search_document_update() RETURNS trigger AS $$
+BEGIN
+    UPDATE restaurants SET search_document = restaurant_search_document(name, address, restaurant_id)
+    WHERE restaurants.restaurant_id IN (SELECT restaurantcategories.restaurant_id FROM restaurantcategories
+                                        WHERE restaurantcategories.category_id = NEW.category_id);
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER restaurants_search_document_trigger
+BEFORE INSERT OR UPDATE OF name, address ON restaurants
+FOR EACH ROW EXECUTE PROCEDURE restaurants_search_document_update();
+
+CREATE TRIGGER restaurantcategories_search_document_trigger
+AFTER INSERT OR UPDATE OR DELETE ON restaurantcategories
+FOR EACH ROW EXECUTE PROCEDURE restaurantcategories_search_document_update();
+
+CREATE TRIGGER categories_search_document_trigger
+AFTER UPDATE OF name ON categories
+FOR EACH ROW EXECUTE PROCEDURE categories_search_document_update();
+"""
+
+
+def is_creating_restaurants(ddl, target, bind, tables=None, **kw):
+    """Check if create_all() is creating the restaurants table in PostgreSQL, for DDL that goes with it."""
+
+    return bind.dialect.name == "postgresql" and Restaurant.__table__ in (tables or [])
+
+
+db.event.listen(db.metadata, "after_create", db.DDL(SEARCH_DOCUMENT_DDL).execute_if(
+    callable_=is_creating_restaurants))
+
+# The index needs the earthdistance extension, which needs cube
+db.event.listen(db.metadata, "before_create", db.DDL("CREATE EXTENSION IF NOT EXISTS cube; "
+                                                     "CREATE EXTENSION IF NOT EXISTS earthdistance").execute_if(
+                                                         callable_=is_creating_restaurants))
+
+
 ##############################################################################
 # Helper functions
 
-def connect_to_db(app, db_uri=None):
-    """Connect the database to our Flask app."""
+def connect_to_db(app, db_uri=None, replica_uri=None, batch=False):
+    """Connect the database to our Flask app.
+
+    If replica_uri is given, views decorated with @read_replica read from it.
+    The engine profile can be tuned with environment variables (see below);
+    settings already in app.config take precedence.
+
+    Batch jobs (seeding, rebuilds, recounts) pass batch=True. Their statements run over
+    whole tables, so they aren't cancelled by the web app's statement timeout.
+    """
 
     # Configure to use our PostgreSQL database
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri or 'postgresql:///breadcrumbs'
-    app.config['SQLALCHEMY_ECHO'] = True
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: replica_uri} if replica_uri else None
+
+    # Logging every statement is slow, so only echo SQL when asked to
+    app.config.setdefault('SQLALCHEMY_ECHO', "SQLALCHEMY_ECHO" in os.environ)
+
+    app.config.setdefault('SQLALCHEMY_POOL_SIZE', int(os.environ.get("DATABASE_POOL_SIZE", 10)))
+    app.config.setdefault('SQLALCHEMY_MAX_OVERFLOW', int(os.environ.get("DATABASE_MAX_OVERFLOW", 20)))
+    app.config.setdefault('SQLALCHEMY_POOL_TIMEOUT', int(os.environ.get("DATABASE_POOL_TIMEOUT", 10)))
+    # Recycle connections before server-side idle timeouts or load balancers drop them
+    app.config.setdefault('SQLALCHEMY_POOL_RECYCLE', int(os.environ.get("DATABASE_POOL_RECYCLE", 1800)))
+    app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', "DATABASE_NO_PRE_PING" not in os.environ)
+    # Runaway queries are cancelled after this long; 0 turns the timeout off
+    if batch:
+        app.config['DATABASE_STATEMENT_TIMEOUT_MS'] = 0
+    else:
+        app.config.setdefault('DATABASE_STATEMENT_TIMEOUT_MS',
+                              int(os.environ.get("DATABASE_STATEMENT_TIMEOUT_MS", 30000)))
+
     db.app = app
     db.init_app(app)
 
@@ -222,11 +419,13 @@ def example_data():
                        latitude=49.2679389,
                        longitude=-123.2190482)
 
+    # Ashley's counter accounts for her visit to Chambar below
     ashley = User(city_id=1,
                   email="ashley@test.com",
                   password="ashley",
                   first_name="Ashley",
-                  last_name="Test")
+                  last_name="Test",
+                  num_visits=1)
 
     bob = User(city_id=1,
                email="bob@test.com",
@@ -243,6 +442,11 @@ def example_data():
     db.session.add_all([van, chambar, miku, fable, ashley, bob, cat])
     db.session.commit()
 
+    ashley_chambar = Visit(user_id=ashley.user_id, restaurant_id=chambar.restaurant_id)
+
+    db.session.add(ashley_chambar)
+    db.session.commit()
+
 
 if __name__ == "__main__":
     # As a convenience, if we run this module interactively, it will leave
@@ -0,0 +1,86 @@
+"""Keyset (cursor-based) pagination for listing pages
+
+Instead of OFFSET, each page continues from the sort key of the last row on the
+previous page, so every page is one index range scan no matter how deep it is.
+"""
+
+import base64
+import json
+
+from sqlalchemy import tuple_
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor from the query string can't be decoded."""
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row on a page into an opaque, URL-safe cursor."""
+
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor):
+    """Decode a cursor back into its sort key values, or None if there is no cursor."""
+
+    if not cursor:
+        return None
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise InvalidCursor("Invalid cursor: %s" % cursor)
+
+    if not isinstance(values, list):
+        raise InvalidCursor("Invalid cursor: %s" % cursor)
+
+    return values
+
+
+def get_page_size(per_page):
+    """Return the requested page size, capped at MAX_PAGE_SIZE."""
+
+    try:
+        page_size = int(per_page)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def paginate(query, columns, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Return a page of results for query ordered by columns, and the cursor for the next page.
+
+    The columns must end with a unique column (e.g. the primary key) so the sort key
+    is unique, and should be covered by a composite index in the same order.
+    The next cursor is None when this is the last page.
+    """
+
+    if cursor is not None:
+        if len(cursor) != len(columns):
+            raise InvalidCursor("Cursor does not match sort columns")
+        query = query.filter(tuple_(*columns) > tuple_(*cursor))
+
+    # Fetch one extra row to find out if there is another page
+    results = query.order_by(*columns).limit(page_size + 1).all()
+
+    if len(results) <= page_size:
+        return results, None
+
+    results = results[:page_size]
+    last = results[-1]
+
+    return results, encode_cursor([getattr(last, column.key) for column in columns])
+
+
+def paginate_request(query, columns, args):
+    """Paginate query using the cursor and per_page arguments of a request."""
+
+    cursor = decode_cursor(args.get("cursor"))
+    page_size = get_page_size(args.get("per_page"))
+
+    return paginate(query, columns, cursor, page_size)
@@ -0,0 +1,254 @@
+"""Photo uploads for restaurant visits, with thumbnails made in the background
+
+Originals are stored under the SHA-256 of their contents, so a file uploaded more than
+once is only stored, and only processed, once:
+
+    static/uploads/originals/ab/ab12...ef.jpg
+    static/uploads/thumbnails/small/ab/ab12...ef.jpg
+
+An upload request only streams the file to disk while hashing it and adds the Image row.
+Reading the date it was taken from its EXIF data and re-encoding it as JPEG thumbnails
+in THUMBNAIL_SIZES happen in a pool of worker threads, which then set Image.processed_At.
+Until then, pages show the original.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+from PIL import Image as PILImage
+
+from model import Image
+from model import db
+
+import datetime
+import hashlib
+import os
+import tempfile
+import threading
+
+UPLOAD_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "uploads")
+UPLOAD_URL = "/static/uploads"
+
+# Longest side, in pixels, of each thumbnail size
+THUMBNAIL_SIZES = {"small": 100, "medium": 320, "large": 1024}
+THUMBNAIL_QUALITY = 85
+
+# Image formats accepted, and the file extension each is stored with
+ALLOWED_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif"}
+
+# Worker threads making thumbnails; Pillow releases the GIL while resizing and encoding
+PHOTO_WORKERS = 2
+
+# Bytes read at a time while hashing and saving an upload
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# EXIF tags for when the photo was taken and which way up the camera was
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_ORIENTATION = 274
+
+# Transpositions that turn a photo with each EXIF orientation the right way up
+ORIENTATION_TRANSPOSES = {
+    2: [PILImage.FLIP_LEFT_RIGHT],
+    3: [PILImage.ROTATE_180],
+    4: [PILImage.FLIP_TOP_BOTTOM],
+    5: [PILImage.ROTATE_270, PILImage.FLIP_LEFT_RIGHT],
+    6: [PILImage.ROTATE_270],
+    7: [PILImage.ROTATE_90, PILImage.FLIP_LEFT_RIGHT],
+    8: [PILImage.ROTATE_90],
+}
+
+
+class InvalidPhoto(ValueError):
+    """Raised when an upload isn't an image in one of ALLOWED_FORMATS."""
+
+
+def get_original_path(content_hash, extension):
+    """Return where the original with this hash is stored, fanned out by its first two characters."""
+
+    return os.path.join(UPLOAD_ROOT, "originals", content_hash[:2], "%s.%s" % (content_hash, extension))
+
+
+def get_thumbnail_path(content_hash, size):
+    """Return where the thumbnail of this size is stored for the original with this hash."""
+
+    return os.path.join(UPLOAD_ROOT, "thumbnails", size, content_hash[:2], "%s.jpg" % content_hash)
+
+
+def get_thumbnail_url(image, size="small"):
+    """Return the URL of an Image's thumbnail, or of its original if thumbnails haven't been made yet."""
+
+    if image.processed_At is None or image.content_hash is None:
+        return image.url
+
+    return "%s/thumbnails/%s/%s/%s.jpg" % (UPLOAD_URL, size, image.content_hash[:2], image.content_hash)
+
+
+def make_dirs(path):
+    """Create the directory path will be written to, if it doesn't exist."""
+
+    directory = os.path.dirname(path)
+
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another thread or process created it first
+            if not os.path.isdir(directory):
+                raise
+
+
+def store_original(upload):
+    """
+    Save an uploaded file (a werkzeug FileStorage) under the hash of its contents.
+
+    Returns the content hash and the original's URL. Raises InvalidPhoto if it isn't an image.
+    """
+
+    staging_dir = os.path.join(UPLOAD_ROOT, "staging")
+    make_dirs(os.path.join(staging_dir, "upload"))
+
+    sha256 = hashlib.sha256()
+
+    with tempfile.NamedTemporaryFile(dir=staging_dir, delete=False) as staged:
+        for chunk in iter(lambda: upload.stream.read(UPLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+            staged.write(chunk)
+
+    try:
+        # Only reads the header, to find the format
+        image_format = PILImage.open(staged.name).format
+    except IOError:
+        image_format = None
+
+    if image_format not in ALLOWED_FORMATS:
+        os.remove(staged.name)
+        raise InvalidPhoto("Photos must be JPEG, PNG or GIF images.")
+
+    content_hash = sha256.hexdigest()
+    extension = ALLOWED_FORMATS[image_format]
+    path = get_original_path(content_hash, extension)
+
+    if os.path.exists(path):
+        os.remove(staged.name)
+    else:
+        make_dirs(path)
+        os.rename(staged.name, path)
+
+    return content_hash, "%s/originals/%s/%s.%s" % (UPLOAD_URL, content_hash[:2], content_hash, extension)
+
+
+def read_taken_at(photo):
+    """Return when a photo was taken from its EXIF data, or None if it doesn't say."""
+
+    try:
+        exif = photo._getexif() or {}
+        return datetime.datetime.strptime(exif[EXIF_DATETIME_ORIGINAL], "%Y:%m:%d %H:%M:%S")
+    except (AttributeError, KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+def make_thumbnails(content_hash, original_path):
+    """
+    Re-encode the original as a JPEG thumbnail in each of THUMBNAIL_SIZES, the right way up.
+
+    Returns when the photo was taken, from its EXIF data.
+    """
+
+    photo = PILImage.open(original_path)
+    taken_at = read_taken_at(photo)
+
+    try:
+        orientation = (photo._getexif() or {}).get(EXIF_ORIENTATION)
+    except (AttributeError, IndexError, TypeError):
+        orientation = None
+
+    # Converting drops the EXIF data, along with any location it holds
+    photo = photo.convert("RGB")
+
+    for transpose in ORIENTATION_TRANSPOSES.get(orientation, []):
+        photo = photo.transpose(transpose)
+
+    for size, max_side in THUMBNAIL_SIZES.items():
+        path = get_thumbnail_path(content_hash, size)
+
+        if os.path.exists(path):
+            continue
+
+        thumbnail = photo.copy()
+        thumbnail.thumbnail((max_side, max_side), PILImage.ANTIALIAS)
+
+        make_dirs(path)
+        temp_path = "%s.%s.tmp" % (path, threading.current_thread().ident)
+        thumbnail.save(temp_path, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+        os.rename(temp_path, path)
+
+    return taken_at
+
+
+def process_photo(app, image_id):
+    """Make an Image's thumbnails and record when it was taken. Runs in a worker thread."""
+
+    with app.app_context():
+        try:
+            image = db.session.query(Image).get(image_id)
+            extension = image.url.rsplit(".", 1)[-1]
+            taken_at = make_thumbnails(image.content_hash, get_original_path(image.content_hash, extension))
+
+            # Every upload of the same file shares the thumbnails
+            db.session.query(Image).filter(Image.content_hash == image.content_hash,
+                                           Image.processed_At == None).update(
+                {"processed_At": datetime.datetime.utcnow(), "taken_At": taken_at}, synchronize_session=False)
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Couldn't process photo for image %s", image_id)
+            raise
+
+
+class PhotoProcessor(object):
+    """Pool of worker threads that process uploaded photos, started on first use."""
+
+    def __init__(self, workers=PHOTO_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def submit(self, app, image_id):
+        """Queue an Image to be processed, returning an AsyncResult for it."""
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+
+        return self.pool.apply_async(process_photo, (app, image_id))
+
+
+photo_processor = PhotoProcessor()
+
+
+def add_photo(app, visit, upload, rating=None):
+    """
+    Store an uploaded photo for a visit and queue it to be processed.
+
+    Returns the new Image. Raises InvalidPhoto if the upload isn't an image.
+    """
+
+    content_hash, url = store_original(upload)
+
+    image = Image(visit_id=visit.visit_id, url=url, content_hash=content_hash, rating=rating)
+
+    # The same file uploaded before has thumbnails already
+    processed = db.session.query(Image).filter(Image.content_hash == content_hash,
+                                               Image.processed_At != None).first()
+
+    if processed:
+        image.processed_At = processed.processed_At
+        image.taken_At = processed.taken_At
+
+    db.session.add(image)
+    db.session.commit()
+
+    if not processed:
+        photo_processor.submit(app, image.image_id)
+
+    return image
@@ -0,0 +1,207 @@
+"""Popular and trending restaurants in each city
+
+Ranking a city's restaurants live would mean a GROUP BY over every visit, so visit
+counts are rolled up into restaurant_popularity instead. add_visit upserts one row
+in the same transaction as the visit, and the whole table can be rebuilt from the
+visits table (e.g. nightly, or after a bulk load) without holding up new visits with:
+    python popular.py
+
+Trending restaurants are ranked with time decay: a visit counts half as much every
+TRENDING_HALF_LIFE_DAYS. Rather than decaying every score as time passes, each visit
+is weighted 2 ** (half-lives since DECAY_EPOCH), so newer visits weigh more and
+adding one never changes the weight of the others. Scores are only scaled back to
+the present when they're shown.
+"""
+
+from sqlalchemy import event, func, text
+
+from model import Restaurant, City, Visit, RestaurantPopularity
+from model import connect_to_db, db
+
+from cache import LRUCache
+from metrics import metrics
+
+import datetime
+
+# A visit's weight in the trending score halves every this many days
+TRENDING_HALF_LIFE_DAYS = 14
+
+# Visits are weighted relative to this time; a double can hold the weights for about 40 years after
+DECAY_EPOCH = datetime.datetime(2016, 1, 1)
+
+# Largest visit id, as visit_id is an integer column
+MAX_VISIT_ID = 2 ** 31 - 1
+
+DEFAULT_POPULAR_LIMIT = 10
+MAX_POPULAR_LIMIT = 50
+
+# Rankings are cached this long, so they can trail new visits by up to a minute
+POPULAR_TTL_SECONDS = 60
+
+popular_restaurants_cache = LRUCache(maxsize=1000, ttl=POPULAR_TTL_SECONDS)
+
+metrics.register_cache("popular_restaurants", popular_restaurants_cache)
+
+
+def get_popular_limit(limit):
+    """Return the number of popular restaurants asked for, capped at MAX_POPULAR_LIMIT."""
+
+    return max(1, min(limit or DEFAULT_POPULAR_LIMIT, MAX_POPULAR_LIMIT))
+
+
+def get_half_lives(when):
+    """Return how many trending half-lives after DECAY_EPOCH a time is."""
+
+    return (when - DECAY_EPOCH).total_seconds() / datetime.timedelta(days=TRENDING_HALF_LIFE_DAYS).total_seconds()
+
+
+def get_trending_weight(visited_at):
+    """Return what a visit at visited_at adds to its restaurant's trending score."""
+
+    return 2.0 ** get_half_lives(visited_at)
+
+
+def record_popular_visit(visit):
+    """
+    Count a visit in its restaurant's popularity.
+
+    The visit must have been flushed, so it has its time.
+
+    Note: This does not commit, so the count changes in the same transaction as the visit.
+    """
+
+    db.session.execute(text("""
+        INSERT INTO restaurant_popularity (restaurant_id, city_id, num_visits, trending_score, "last_visited_At")
+        SELECT restaurant_id, city_id, 1, :weight, :visited_at
+        FROM restaurants
+        WHERE restaurant_id = :restaurant_id
+        ON CONFLICT (restaurant_id) DO UPDATE
+        SET num_visits = restaurant_popularity.num_visits + 1,
+            trending_score = restaurant_popularity.trending_score + EXCLUDED.trending_score,
+            "last_visited_At" = greatest(restaurant_popularity."last_visited_At", EXCLUDED."last_visited_At")
+        """), {"restaurant_id": visit.restaurant_id,
+               "weight": get_trending_weight(visit.visited_At),
+               "visited_at": visit.visited_At})
+
+
+# Sums each restaurant's visits in a range of visit ids, as restaurant_popularity rows. Visits
+# from before visit times were recorded count as made at the epoch.
+POPULARITY_ROLLUP_SQL = """
+    SELECT restaurant.restaurant_id, restaurant.city_id, count(*),
+           sum(power(CAST(2 AS double precision),
+                     extract(epoch FROM coalesce(visit."visited_At", :epoch) - :epoch) / :half_life_seconds)),
+           max(visit."visited_At")
+    FROM visits AS visit
+    JOIN restaurants AS restaurant ON restaurant.restaurant_id = visit.restaurant_id
+    WHERE visit.visit_id > :after_visit_id AND visit.visit_id <= :until_visit_id
+    GROUP BY restaurant.restaurant_id, restaurant.city_id
+    """
+
+
+def rebuild_popular_restaurants():
+    """
+    Rebuild every restaurant's popularity from the visits table. Returns the number of restaurants counted.
+
+    Visits are counted into a staging table while the live table keeps serving reads and
+    taking new visits. The live table is then locked only long enough to count the visits
+    added since, and to replace its rows with the staging table's.
+    """
+
+    params = {"epoch": DECAY_EPOCH,
+              "half_life_seconds": datetime.timedelta(days=TRENDING_HALF_LIFE_DAYS).total_seconds()}
+
+    # Visits up to here are counted into staging. One given its id but still committing as this
+    # runs could be missed, until the next rebuild.
+    counted_visit_id = db.session.query(func.max(Visit.visit_id)).scalar() or 0
+
+    db.session.execute(text("""
+        CREATE TEMPORARY TABLE restaurant_popularity_staging
+        (LIKE restaurant_popularity INCLUDING DEFAULTS INCLUDING INDEXES)
+        ON COMMIT DROP
+        """))
+
+    db.session.execute(text("""
+        INSERT INTO restaurant_popularity_staging (restaurant_id, city_id, num_visits, trending_score,
+                                                   "last_visited_At")
+        """ + POPULARITY_ROLLUP_SQL), dict(params, after_visit_id=0, until_visit_id=counted_visit_id))
+
+    # Visits already counted in the live table hold a conflicting lock until they commit, so
+    # once this is granted they're all in visits. Later ones wait to be counted after the swap.
+    db.session.execute(text("LOCK TABLE restaurant_popularity IN SHARE ROW EXCLUSIVE MODE"))
+
+    db.session.execute(text("""
+        INSERT INTO restaurant_popularity_staging (restaurant_id, city_id, num_visits, trending_score,
+                                                   "last_visited_At")
+        """ + POPULARITY_ROLLUP_SQL + """
+        ON CONFLICT (restaurant_id) DO UPDATE
+        SET num_visits = restaurant_popularity_staging.num_visits + EXCLUDED.num_visits,
+            trending_score = restaurant_popularity_staging.trending_score + EXCLUDED.trending_score,
+            "last_visited_At" = greatest(restaurant_popularity_staging."last_visited_At",
+                                         EXCLUDED."last_visited_At")
+        """), dict(params, after_visit_id=counted_visit_id, until_visit_id=MAX_VISIT_ID))
+
+    db.session.execute(text("DELETE FROM restaurant_popularity"))
+
+    result = db.session.execute(text("""
+        INSERT INTO restaurant_popularity (restaurant_id, city_id, num_visits, trending_score, "last_visited_At")
+        SELECT restaurant_id, city_id, num_visits, trending_score, "last_visited_At"
+        FROM restaurant_popularity_staging
+        """))
+
+    db.session.commit()
+
+    return result.rowcount
+
+
+def get_popular_restaurants(city_id, trending=False, limit=DEFAULT_POPULAR_LIMIT):
+    """
+    Return a city's open restaurants with the most breadcrumbs, or the most recent breadcrumbs if trending.
+
+    Each is a dictionary with the restaurant's details, its number of visits and its
+    trending score: how many visits it's had, each counted less the older it is.
+    """
+
+    def get_ranking():
+        score = RestaurantPopularity.trending_score if trending else RestaurantPopularity.num_visits
+
+        restaurants = db.session.query(Restaurant.restaurant_id,
+                                       Restaurant.name,
+                                       Restaurant.address,
+                                       Restaurant.image_url,
+                                       RestaurantPopularity.num_visits,
+                                       RestaurantPopularity.trending_score).join(
+                                           RestaurantPopularity,
+                                           RestaurantPopularity.restaurant_id == Restaurant.restaurant_id).filter(
+                                           RestaurantPopularity.city_id == city_id,
+                                           Restaurant.is_closed == False).order_by(
+                                           score.desc(), Restaurant.restaurant_id).limit(limit)
+
+        # Scores are weighted from the epoch, so they're scaled back to now
+        decay = 2.0 ** -get_half_lives(datetime.datetime.utcnow())
+
+        return [dict(restaurant._asdict(), trending_score=restaurant.trending_score * decay)
+                for restaurant in restaurants]
+
+    return popular_restaurants_cache.get_or_set((city_id, trending, limit), get_ranking)
+
+
+def get_busiest_city():
+    """Return the city with the most breadcrumbs, or None if there aren't any."""
+
+    def get_city():
+        return db.session.query(City.city_id, City.name).join(
+            RestaurantPopularity, RestaurantPopularity.city_id == City.city_id).group_by(
+                City.city_id, City.name).order_by(func.sum(RestaurantPopularity.num_visits).desc()).first()
+
+    return popular_restaurants_cache.get_or_set("busiest_city", get_city)
+
+
+# Freshly created tables (e.g. between tests) make the cached rankings stale
+event.listen(db.metadata, "after_create", lambda target, connection, **kw: popular_restaurants_cache.clear())
+
+
+if __name__ == "__main__":
+    from server import app
+    connect_to_db(app, batch=True)
+
+    print "Counted breadcrumbs at %s restaurants." % rebuild_popular_restaurants()
@@ -0,0 +1,157 @@
+"""Per-request SQL statement counts and timings, with an N+1 query detector
+
+Every statement executed on any engine is counted against the current request, along
+with the time spent in the database. Statements are grouped by shape (the SQL with
+literals and IN lists collapsed), so a statement run once per row, the classic N+1,
+shows up as a shape repeated many times.
+
+In debug and test modes the numbers are added to every response as headers:
+
+    X-SQL-Queries       statements executed
+    X-SQL-Time-Ms       total time spent executing them
+    X-SQL-Repeated      most times a single statement shape was executed
+
+and any request repeating a shape N_PLUS_ONE_THRESHOLD or more times is logged as a
+warning. Statements run while a streamed response is being sent come too late to be
+counted in its headers, but are still counted by count_queries().
+
+Tests can also count the statements run inside a block, e.g.
+
+    with count_queries() as stats:
+        client.get("/users/1")
+    assert stats.count <= 5
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import re
+import threading
+import timeit
+
+# A statement shape executed this many times in one request is reported as a likely N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+# Collapse literals and IN lists, so statements differing only by parameters share a shape
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+# Bind parameters look like %(name)s, so their brackets are allowed inside an IN list
+IN_LIST_PATTERN = re.compile(r"\bIN \((?:%\([^)]*\)s|[^()])+\)", re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def get_statement_shape(statement):
+    """Return statement with its literals, IN lists and whitespace normalized."""
+
+    shape = LITERAL_PATTERN.sub("?", statement)
+    shape = IN_LIST_PATTERN.sub("IN (?)", shape)
+
+    return WHITESPACE_PATTERN.sub(" ", shape).strip()
+
+
+class QueryStats(object):
+    """Statements executed, time spent executing them, and how often each statement shape ran."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, seconds):
+        """Count a statement that took seconds to execute."""
+
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[get_statement_shape(statement)] += 1
+
+    @property
+    def max_repeated(self):
+        """Most times a single statement shape was executed."""
+
+        return max(self.shapes.values()) if self.shapes else 0
+
+    def get_repeated_shapes(self, threshold=N_PLUS_ONE_THRESHOLD):
+        """Return (shape, count) for every shape executed at least threshold times, most repeated first."""
+
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+# QueryStats collecting statements for count_queries() blocks, per thread
+collectors = threading.local()
+
+
+@contextmanager
+def count_queries():
+    """Count the statements executed in this thread inside a with block."""
+
+    stats = QueryStats()
+    active = collectors.__dict__.setdefault("active", [])
+    active.append(stats)
+
+    try:
+        yield stats
+    finally:
+        active.remove(stats)
+
+
+def get_active_stats():
+    """Return the QueryStats that statements are being counted against right now."""
+
+    active = list(getattr(collectors, "active", []))
+
+    if has_app_context() and getattr(g, "query_stats", None) is not None:
+        active.append(g.query_stats)
+
+    return active
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(timeit.default_timer())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = timeit.default_timer() - conn.info["query_started"].pop()
+
+    for stats in get_active_stats():
+        stats.record(statement, seconds)
+
+
+def handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute, so drop its start time here
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+
+    if started:
+        started.pop()
+
+
+event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+event.listen(Engine, "handle_error", handle_error)
+
+
+def init_query_stats(app):
+    """Count each request's statements, adding them as response headers in debug and test modes."""
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def add_query_stats_headers(response):
+        stats = getattr(g, "query_stats", None)
+
+        if stats is None:
+            return response
+
+        for shape, count in stats.get_repeated_shapes():
+            app.logger.warning("Possible N+1 query: %s statements shaped %r", count, shape)
+
+        if app.debug or app.testing:
+            response.headers["X-SQL-Queries"] = str(stats.count)
+            response.headers["X-SQL-Time-Ms"] = "%.2f" % (1000 * stats.seconds)
+            response.headers["X-SQL-Repeated"] = str(stats.max_repeated)
+
+        return response
@@ -0,0 +1,231 @@
+"""Cached full-text searches for restaurants and users
+
+Restaurants are searched by their search document, which covers their name, category
+names and address (see SEARCH_DOCUMENT_DDL in model.py), so a search for "sushi" finds
+sushi restaurants whatever they're called. Matches are ranked, best first, and only
+the top SEARCH_RESULT_LIMIT get highlighted snippets.
+
+Restaurant searches can be narrowed by category (see facets.py), and the categories of
+every match, not just the top results, are counted for the search's facets.
+
+Search results are cached by normalized query in bounded LRU caches with a TTL.
+The caches are cleared whenever a Restaurant (or its categories) or User row is inserted,
+updated or deleted through the ORM in this process; the TTL bounds how long results can be
+stale after writes made elsewhere (e.g. seed.py, or another server process).
+"""
+
+from jinja2 import Markup, escape
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy_searchable import search, parse_search_query
+
+from model import User, Restaurant, City, Category, RestaurantCategory
+from model import db
+from model import USER_SORT_KEY, RESTAURANT_SORT_KEY
+
+from cache import LRUCache
+from metrics import metrics
+from pagination import paginate, DEFAULT_PAGE_SIZE
+from facets import filter_by_categories, get_facets, facet_cache
+
+# Most results returned for a search
+SEARCH_RESULT_LIMIT = 100
+
+# Text search configuration the search documents are built with
+SEARCH_REGCONFIG = "pg_catalog.english"
+
+# Highlighted words are marked with characters that can't be in the text, then escaped
+# and marked up in Python, so names and addresses can't inject HTML
+HIGHLIGHT_START = u"\u0002"
+HIGHLIGHT_STOP = u"\u0003"
+HEADLINE_OPTIONS = "StartSel=%s, StopSel=%s, MaxWords=25, MinWords=10" % (HIGHLIGHT_START, HIGHLIGHT_STOP)
+
+restaurant_search_cache = LRUCache(maxsize=1000, ttl=300)
+user_search_cache = LRUCache(maxsize=1000, ttl=300)
+
+metrics.register_cache("restaurant_search", restaurant_search_cache)
+metrics.register_cache("user_search", user_search_cache)
+
+
+def normalize_query(user_input):
+    """Normalize a search query so searches that differ only by case or spacing share a cache entry."""
+
+    return " ".join((user_input or "").lower().split())
+
+
+def highlight(headline):
+    """Return a headline from ts_headline() as HTML, with its highlighted words in <mark> tags."""
+
+    if headline is None:
+        return None
+
+    return Markup(unicode(escape(headline)).replace(HIGHLIGHT_START, u"<mark>").replace(HIGHLIGHT_STOP, u"</mark>"))
+
+
+def rank_restaurants(search_query, category_ids=(), match_all=False):
+    """
+    Return a subquery of the ids and ranks of the SEARCH_RESULT_LIMIT restaurants best matching a parsed query.
+
+    This is one scan of the search document's GIN index, narrowed by category if any are given.
+    """
+
+    tsquery = func.to_tsquery(SEARCH_REGCONFIG, search_query)
+    rank = func.ts_rank_cd(Restaurant.search_document, tsquery)
+
+    ranked = db.session.query(Restaurant.restaurant_id, rank.label("rank")).filter(
+        Restaurant.search_document.op("@@")(tsquery), Restaurant.is_closed == False)
+
+    return filter_by_categories(ranked, category_ids, match_all).order_by(
+        rank.desc(), Restaurant.restaurant_id).limit(SEARCH_RESULT_LIMIT).subquery()
+
+
+def match_restaurants(search_query):
+    """Return a query for the ids of every restaurant matching a parsed query, or None if it matches them all."""
+
+    if not search_query:
+        return None
+
+    return db.session.query(Restaurant.restaurant_id).filter(
+        Restaurant.search_document.op("@@")(func.to_tsquery(SEARCH_REGCONFIG, search_query)))
+
+
+def find_restaurants(user_input, category_ids=(), match_all=False):
+    """
+    Search open restaurants by name, category or address, best matches first.
+
+    Returns a list of dictionaries with the restaurant details shown in search results,
+    including a snippet of their categories and address with the matching words highlighted.
+    With no query, returns the first restaurants by name. Results can be narrowed to
+    restaurants in any (or all) of category_ids.
+    """
+
+    query = normalize_query(user_input)
+
+    def get_results():
+        search_query = parse_search_query(query)
+
+        if not search_query:
+            restaurants = db.session.query(Restaurant.restaurant_id,
+                                           Restaurant.name,
+                                           Restaurant.address,
+                                           Restaurant.phone,
+                                           Restaurant.image_url).filter(Restaurant.is_closed == False)
+
+            restaurants = filter_by_categories(restaurants, category_ids, match_all)
+
+            return [dict(restaurant._asdict(), name_headline=None, headline=None)
+                    for restaurant in restaurants.order_by(*RESTAURANT_SORT_KEY).limit(SEARCH_RESULT_LIMIT)]
+
+        tsquery = func.to_tsquery(SEARCH_REGCONFIG, search_query)
+        ranked = rank_restaurants(search_query, category_ids, match_all)
+
+        # Category names of each ranked restaurant, for its snippet
+        category_names = db.session.query(func.string_agg(Category.name, ", ")).join(
+            RestaurantCategory, RestaurantCategory.category_id == Category.category_id).filter(
+                RestaurantCategory.restaurant_id == Restaurant.restaurant_id).as_scalar()
+
+        snippet_text = func.concat_ws(" - ", category_names, Restaurant.address)
+
+        # Headlines are slow to make, so they're only made for the ranked page of results
+        restaurants = db.session.query(Restaurant.restaurant_id,
+                                       Restaurant.name,
+                                       Restaurant.address,
+                                       Restaurant.phone,
+                                       Restaurant.image_url,
+                                       func.ts_headline(SEARCH_REGCONFIG, Restaurant.name, tsquery,
+                                                        HEADLINE_OPTIONS + ", HighlightAll=TRUE").label("name_headline"),
+                                       func.ts_headline(SEARCH_REGCONFIG, snippet_text, tsquery,
+                                                        HEADLINE_OPTIONS).label("headline")).join(
+                                           ranked, ranked.c.restaurant_id == Restaurant.restaurant_id).order_by(
+                                           ranked.c.rank.desc(), Restaurant.restaurant_id)
+
+        return [dict(restaurant._asdict(),
+                     name_headline=highlight(restaurant.name_headline),
+                     headline=highlight(restaurant.headline)) for restaurant in restaurants]
+
+    return restaurant_search_cache.get_or_set((query, tuple(category_ids), match_all), get_results)
+
+
+def find_restaurant_facets(user_input, category_ids=(), match_all=False):
+    """Return how many restaurants matching a search, narrowed by category, are in each category."""
+
+    query = normalize_query(user_input)
+
+    return get_facets(("search", query), category_ids, match_all,
+                      get_restaurant_ids=lambda: match_restaurants(parse_search_query(query)))
+
+
+def find_users(user_input, cursor=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Search users by first or last name, a page at a time in order of name.
+
+    Returns a list of dictionaries with the user details shown in search results,
+    and the cursor for the next page (None if this is the last page).
+    """
+
+    query = normalize_query(user_input)
+
+    def get_results():
+        users = db.session.query(User.user_id,
+                                 User.first_name,
+                                 User.last_name,
+                                 City.name.label("city_name")).join(City, User.city_id == City.city_id)
+
+        users, next_cursor = paginate(search(users, query), USER_SORT_KEY, cursor, page_size)
+
+        return [user._asdict() for user in users], next_cursor
+
+    # Each page is cached separately, keyed by where it starts
+    return user_search_cache.get_or_set((query, tuple(cursor or ()), page_size), get_results)
+
+
+def get_search_cache_stats():
+    """Return hit/miss stats for the search caches."""
+
+    return {
+        "restaurants": restaurant_search_cache.stats(),
+        "users": user_search_cache.stats()
+    }
+
+
+def mark_search_cache_stale(search_cache):
+    """Return a mapper event listener that marks search_cache to be cleared when the change commits."""
+
+    def listener(mapper, connection, target):
+        session = object_session(target)
+        session.info.setdefault("stale_search_caches", set()).add(search_cache)
+
+    return listener
+
+
+def clear_stale_search_caches(session):
+    """Clear the search caches marked stale by the session's committed changes."""
+
+    for search_cache in session.info.pop("stale_search_caches", set()):
+        search_cache.clear()
+
+
+def forget_stale_search_caches(session):
+    """Rolled back changes never happened, so nothing needs clearing."""
+
+    session.info.pop("stale_search_caches", None)
+
+
+# Invalidate cached results whenever the rows they were searched from change. Caches are
+# cleared after commit, so a search running mid-transaction can't re-cache old results.
+for model_class, search_cache in [(Restaurant, restaurant_search_cache),
+                                  (RestaurantCategory, restaurant_search_cache),
+                                  (Category, restaurant_search_cache),
+                                  (Restaurant, facet_cache),
+                                  (RestaurantCategory, facet_cache),
+                                  (Category, facet_cache),
+                                  (User, user_search_cache)]:
+    for event_name in ["after_insert", "after_update", "after_delete"]:
+        event.listen(model_class, event_name, mark_search_cache_stale(search_cache))
+
+event.listen(Session, "after_commit", clear_stale_search_caches)
+event.listen(Session, "after_soft_rollback", lambda session, previous_transaction: forget_stale_search_caches(session))
+
+# Freshly created tables (e.g. between tests) make every cached result stale
+event.listen(db.metadata, "after_create", lambda target, connection, **kw: [restaurant_search_cache.clear(),
+                                                                            user_search_cache.clear()])
@@ -1,30 +1,59 @@
-"""Utility file to seed info from Yelp API into the breadcrumbs database"""
+"""Utility file to seed info from Yelp API into the breadcrumbs database
 
-from sqlalchemy import func
+To seed one or more cities (defaults to Sunnyvale):
+    python seed.py Sunnyvale Vancouver
+
+Restaurants are upserted by Yelp business id, so seeding a city again updates it in place.
+
+To re-sync cities with Yelp, writing only what changed (e.g. from a nightly cron job):
+    python seed.py --sync                     # every city last synced over 24 hours ago
+    python seed.py --sync --max-age-hours 6   # every city last synced over 6 hours ago
+    python seed.py --sync Sunnyvale           # just these cities
+
+To load a synthetic production-scale dataset instead, without calling Yelp (see synthetic_data.py):
+    python seed.py --synthetic                                   # 1M visits
+    python seed.py --synthetic --num-visits 100000 --num-users 10000 --seed 42
+"""
+
+import argparse
+import datetime
 
-from model import Restaurant
 from model import connect_to_db, db
 
 from server import app
 
-from yelp_api_call import load_restaurants
+from yelp_api_call import load_restaurants, sync_city, sync_stale_cities
+
+import synthetic_data
 
 
-def set_val_restaurant_id():
-    """Set value for the next restaurant_id after seeding database"""
+def parse_args():
+    """Parse command line arguments for seeding or syncing cities."""
 
-    # Get the Max restaurant_id in the database
-    result = db.session.query(func.max(Restaurant.restaurant_id)).one()
-    max_id = int(result[0])
+    parser = argparse.ArgumentParser(description="Seed the breadcrumbs database from Yelp.")
+    parser.add_argument("cities", nargs="*", help="names of cities to seed or sync")
+    parser.add_argument("--sync", action="store_true",
+                        help="re-sync cities with Yelp, writing only what changed")
+    parser.add_argument("--max-age-hours", type=float, default=24,
+                        help="with --sync and no cities, sync cities last synced longer ago than this")
 
-    # Set the value for the next restaurant_id to be max_id + 1
-    query = "SELECT setval('restaurants_restaurant_id_seq', :new_id)"
-    db.session.execute(query, {'new_id': max_id + 1})
-    db.session.commit()
+    synthetic = parser.add_argument_group("synthetic data")
+    synthetic.add_argument("--synthetic", action="store_true",
+                           help="load a generated dataset instead of seeding from Yelp")
+    synthetic.add_argument("--num-cities", type=int, default=10, help="cities to generate")
+    synthetic.add_argument("--num-restaurants", type=int, default=20000, help="restaurants to generate")
+    synthetic.add_argument("--num-users", type=int, default=50000, help="users to generate")
+    synthetic.add_argument("--num-visits", type=int, default=1000000, help="visits to generate")
+    synthetic.add_argument("--friends-per-user", type=int, default=20, help="average friends per generated user")
+    synthetic.add_argument("--seed", type=int, default=0, help="the same seed always generates the same data")
+
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    connect_to_db(app)
+    args = parse_args()
+
+    connect_to_db(app, batch=True)
 
     # Configure mappers before creating tables in order for search trigger in
     # SQLAlchemy-Searchable to work properly
@@ -33,6 +62,21 @@ if __name__ == "__main__":
     # In case tables haven't been created, create them
     db.create_all()
 
-    # Import different types of data
-    load_restaurants("Sunnyvale")
-    set_val_restaurant_id()
+    if args.synthetic:
+        loaded = synthetic_data.generate(args.num_cities, args.num_restaurants, args.num_users, args.num_visits,
+                                         args.friends_per_user, args.seed)
+        print "Loaded synthetic data: %s" % loaded
+
+    elif args.sync and args.cities:
+        for city in args.cities:
+            print "Synced %s: %s" % (city, sync_city(city))
+
+    elif args.sync:
+        synced = sync_stale_cities(datetime.timedelta(hours=args.max_age_hours))
+        for city, counts in synced.items():
+            print "Synced %s: %s" % (city, counts)
+
+    else:
+        # Import different types of data
+        for city in args.cities or ["Sunnyvale"]:
+            load_restaurants(city)
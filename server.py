@@ -1,26 +1,108 @@
 """Breadcrumbs: Tracking a user's restaurant history"""
 
 import os
+import json
+import time
 
 from jinja2 import StrictUndefined
 
-from flask import Flask, render_template, redirect, request, flash, session, jsonify
+from flask import Flask, render_template, redirect, request, flash, session, jsonify, g
+from flask import Response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
 
-from model import User, Restaurant, Visit, Category, City, RestaurantCategory, Image, Connection
+from model import User, Restaurant, Visit, Category, City, RestaurantCategory, Image
 from model import connect_to_db, db
+from model import USER_SORT_KEY, RESTAURANT_SORT_KEY, RESTAURANT_LATITUDE, RESTAURANT_LONGITUDE
+from database import read_replica
 from friends import is_friends_or_pending, get_friend_requests, get_friends
-
+from friends import send_friend_request, accept_friend_request, suggest_friends
+from friends import get_relationship_statuses, get_connection_status
+from friend_graph import friend_graph
+from autocomplete import autocomplete
+from counters import increment_counters, get_request_counts
+from pagination import paginate_request, decode_cursor, get_page_size, InvalidCursor
+
+from searches import find_restaurants, find_restaurant_facets, find_users, get_search_cache_stats
+from facets import parse_category_filter, filter_by_categories, get_facets, get_filter_url
+from query_stats import init_query_stats
+from metrics import metrics, init_metrics
+from photos import add_photo, get_thumbnail_url, InvalidPhoto
+from clusters import get_clusters, clear_user_clusters
+from feed import fan_out_visit, paginate_feed_request
+from visitors import get_friends_who_visited, record_visitor
+from popular import record_popular_visit, get_popular_restaurants, get_popular_limit, get_busiest_city
+from geo import parse_bounds, parse_location, get_nearby_limit, InvalidBounds, InvalidLocation
+from geo import find_restaurants_in_viewport, find_nearest_restaurants, query_restaurants, serialize_restaurant
+
+from sqlalchemy.orm import joinedload, subqueryload
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy_searchable import search
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("FLASK_SECRET_KEY", "abcdef")
 app.jinja_env.undefined = StrictUndefined
+# Server-Sent Events for friend request badges hold a worker per open page, so they're opt-in
+app.config['REQUEST_STREAM_ENABLED'] = "REQUEST_STREAM_ENABLED" in os.environ
+# Largest photo upload accepted, in bytes
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+# Templates show photo thumbnails by URL
+app.jinja_env.globals['thumbnail_url'] = get_thumbnail_url
+# Facet links add or remove a category from the current filter
+app.jinja_env.globals['filter_url'] = get_filter_url
 
 from raven.contrib.flask import Sentry
 sentry = Sentry(app)
 
+# Count each request's SQL statements, flagging likely N+1 queries
+init_query_stats(app)
+
+# Request metrics for /metrics; multi-process servers share them through METRICS_DIR
+init_metrics(app, os.environ.get("METRICS_DIR"))
+
+# Number of rows fetched per round trip when streaming a user's visits
+VISITS_BATCH_SIZE = 500
+
+# Most suggestions returned by /autocomplete
+AUTOCOMPLETE_MAX_RESULTS = 10
+
+# How often the friend request stream checks for changes, and how long before the browser reconnects
+REQUEST_STREAM_INTERVAL_SECONDS = 5
+REQUEST_STREAM_DURATION_SECONDS = 60
+
+
+@app.context_processor
+def inject_request_counts():
+    """Let templates render the friend request badges from the current user's live counters."""
+
+    def request_counts():
+        # Read once per request, however many badges the page has
+        if getattr(g, "request_counts", None) is None:
+            g.request_counts = get_request_counts(session["current_user"]["user_id"])
+
+        return g.request_counts
+
+    return {"request_counts": request_counts}
+
+
+@app.errorhandler(InvalidCursor)
+def invalid_cursor(error):
+    """Respond with Bad Request when a listing page is asked for with a bad cursor."""
+
+    return str(error), 400
+
+
+@app.errorhandler(InvalidBounds)
+def invalid_bounds(error):
+    """Respond with Bad Request when map clusters or restaurants are asked for with bad bounds."""
+
+    return str(error), 400
+
+
+@app.errorhandler(InvalidLocation)
+def invalid_location(error):
+    """Respond with Bad Request when nearby restaurants are asked for with a bad location."""
+
+    return str(error), 400
+
 
 @app.route('/')
 def index():
@@ -50,19 +132,11 @@ def login():
         flash("The email or password you have entered did not match our records. Please try again.", "danger")
         return redirect("/login")
 
-    # Get current user's friend requests and number of requests to display in badges
-    received_friend_requests, sent_friend_requests = get_friend_requests(current_user.user_id)
-    num_received_requests = len(received_friend_requests)
-    num_sent_requests = len(sent_friend_requests)
-    num_total_requests = num_received_requests + num_sent_requests
-
     # Use a nested dictionary for session["current_user"] to store more than just user_id
+    # Badges read the number of requests from the user's counters on each page, so they aren't kept here
     session["current_user"] = {
         "first_name": current_user.first_name,
-        "user_id": current_user.user_id,
-        "num_received_requests": num_received_requests,
-        "num_sent_requests": num_sent_requests,
-        "num_total_requests": num_total_requests
+        "user_id": current_user.user_id
     }
 
     flash("Welcome {}. You have successfully logged in.".format(current_user.first_name), "success")
@@ -115,10 +189,7 @@ def signup():
         # Add same info to session for new user as per /login route
         session["current_user"] = {
             "first_name": new_user.first_name,
-            "user_id": new_user.user_id,
-            "num_received_requests": 0,
-            "num_sent_requests": 0,
-            "num_total_requests": 0
+            "user_id": new_user.user_id
         }
 
         flash("You have succesfully signed up for an account, and you are now logged in.", "success")
@@ -131,28 +202,47 @@ def signup():
 
 
 @app.route("/users")
+@read_replica
 def user_list():
-    """Show list of users."""
+    """Show a page of users, ordered by name."""
 
-    users = db.session.query(User).all()
+    users, next_cursor = paginate_request(db.session.query(User), USER_SORT_KEY, request.args)
 
     return render_template("user_list.html",
-                           users=users)
+                           users=users,
+                           next_cursor=next_cursor)
+
+
+@app.route("/users.json")
+@read_replica
+def user_list_json():
+    """Return a page of users as JSON, ordered by name."""
+
+    users, next_cursor = paginate_request(db.session.query(User), USER_SORT_KEY, request.args)
+
+    return jsonify(users=[{"user_id": user.user_id,
+                           "first_name": user.first_name,
+                           "last_name": user.last_name} for user in users],
+                   next_cursor=next_cursor)
 
 
 @app.route("/users/<int:user_id>")
 def user_profile(user_id):
     """Show user profile with map and list of visited restaurants."""
 
-    user = db.session.query(User).filter(User.user_id == user_id).one()
+    # Load the user's city with the user, as the profile shows its name
+    user = db.session.query(User).options(joinedload(User.city)).filter(User.user_id == user_id).one()
 
-    # Get user's breadcrumbs in descending order
-    breadcrumbs = db.session.query(Visit).filter(Visit.user_id == user_id).order_by(Visit.visit_id.desc())
+    # Get user's breadcrumbs in descending order, each with its restaurant in the same query
+    # and their photos in one more
+    breadcrumbs = db.session.query(Visit).options(joinedload(Visit.restaurant), subqueryload(Visit.images)).filter(
+        Visit.user_id == user_id).order_by(Visit.visit_id.desc())
 
-    total_breadcrumbs = len(breadcrumbs.all())
+    # Totals are read from the user's counters rather than counted row by row
+    total_breadcrumbs = user.num_visits
     recent_breadcrumbs = breadcrumbs.limit(5).all()
 
-    total_friends = len(get_friends(user.user_id).all())
+    total_friends = user.num_friends
 
     user_a_id = session["current_user"]["user_id"]
     user_b_id = user.user_id
@@ -171,29 +261,63 @@ def user_profile(user_id):
 
 @app.route("/users/<int:user_id>/visits.json")
 def user_restaurant_visits(user_id):
-    """Return info about a user's restaurant visits as JSON."""
-
-    user_visits = db.session.query(Visit).filter(Visit.user_id == user_id).all()
-
-    rest_visits = {}
-
-    for visit in user_visits:
-        image_url = visit.restaurant.image_url if visit.restaurant.image_url else "/static/img/restaurant-avatar.png"
-        phone = visit.restaurant.phone if visit.restaurant.phone else "Not Available"
-
-        rest_visits[visit.visit_id] = {
-            "restaurant": visit.restaurant.name,
-            "rest_id": visit.restaurant.restaurant_id,
-            "address": visit.restaurant.address,
-            "phone": phone,
-            "image_url": image_url,
-            # Need to convert latitude and longitude to floats
-            # Otherwise get a TypeError: Decimal is not JSON serializable
-            "latitude": float(visit.restaurant.latitude),
-            "longitude": float(visit.restaurant.longitude)
-        }
+    """Return info about a user's restaurant visits as JSON.
+
+    Visits are joined to their restaurants in a single query that only selects
+    the columns the map needs, and the JSON is streamed out as rows arrive from
+    a server-side cursor instead of being built in memory first.
+    """
+
+    user_visits = db.session.query(Visit.visit_id,
+                                   Restaurant.restaurant_id,
+                                   Restaurant.name,
+                                   Restaurant.address,
+                                   Restaurant.phone,
+                                   Restaurant.image_url,
+                                   RESTAURANT_LATITUDE.label("latitude"),
+                                   RESTAURANT_LONGITUDE.label("longitude")).join(Restaurant,
+                                                              Visit.restaurant_id == Restaurant.restaurant_id)
+
+    # yield_per turns on stream_results, so psycopg2 uses a named (server-side) cursor
+    user_visits = user_visits.filter(Visit.user_id == user_id).order_by(Visit.visit_id).yield_per(VISITS_BATCH_SIZE)
+
+    def generate():
+        yield "{"
+
+        for i, visit in enumerate(user_visits):
+            rest_visit = {
+                "restaurant": visit.name,
+                "rest_id": visit.restaurant_id,
+                "address": visit.address,
+                "phone": visit.phone or "Not Available",
+                "image_url": visit.image_url or "/static/img/restaurant-avatar.png",
+                # Cast to double precision in SQL, so psycopg2 returns floats instead of
+                # Decimals, which aren't JSON serializable
+                "latitude": visit.latitude,
+                "longitude": visit.longitude
+            }
+
+            # Keep the same shape as before: an object keyed by visit_id
+            yield '%s"%s": %s' % ("," if i else "", visit.visit_id, json.dumps(rest_visit))
 
-    return jsonify(rest_visits)
+        yield "}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@app.route("/users/<int:user_id>/visits/clusters.json")
+def user_visit_clusters(user_id):
+    """Return a user's restaurant visits grouped into map clusters as JSON.
+
+    Takes the map's zoom level and its bounds as "south,west,north,east", and
+    returns only the clusters inside them, so the payload stays small however
+    many visits the user has.
+    """
+
+    zoom = request.args.get("zoom", 13, type=int)
+    bounds = parse_bounds(request.args.get("bounds"))
+
+    return jsonify(clusters=get_clusters(user_id, zoom, bounds))
 
 
 @app.route("/add-friend", methods=["POST"])
@@ -201,27 +325,38 @@ def add_friend():
     """Send a friend request to another user."""
 
     user_a_id = session["current_user"]["user_id"]
-    user_b_id = request.form.get("user_b_id")
+    user_b_id = request.form.get("user_b_id", type=int)
 
-    # Check connection status between user_a and user_b
-    is_friends, is_pending = is_friends_or_pending(user_a_id, user_b_id)
+    # Check connection status between user_a and user_b in the database, as the friend graph
+    # may not have seen a request made through another server process yet
+    is_friends, is_pending = get_connection_status(user_a_id, user_b_id)
 
     if user_a_id == user_b_id:
         return "You cannot add yourself as a friend."
     elif is_friends:
         return "You are already friends."
-    elif is_pending:
+    elif is_pending or not send_friend_request(user_a_id, user_b_id):
         return "Your friend request is pending."
     else:
-        requested_connection = Connection(user_a_id=user_a_id,
-                                          user_b_id=user_b_id,
-                                          status="Requested")
-        db.session.add(requested_connection)
-        db.session.commit()
         print "User ID %s has sent a friend request to User ID %s" % (user_a_id, user_b_id)
         return "Request Sent"
 
 
+@app.route("/accept-friend", methods=["POST"])
+def accept_friend():
+    """Accept a friend request from another user."""
+
+    user_a_id = request.form.get("user_a_id", type=int)
+    user_b_id = session["current_user"]["user_id"]
+
+    if accept_friend_request(user_a_id, user_b_id):
+        flash("You are now friends.", "success")
+    else:
+        flash("This friend request is no longer pending.", "danger")
+
+    return redirect("/friends")
+
+
 @app.route("/friends")
 def show_friends_and_requests():
     """Show friend requests and list of all friends"""
@@ -238,7 +373,101 @@ def show_friends_and_requests():
                            friends=friends)
 
 
+@app.route("/feed")
+def show_feed():
+    """Show a page of the current user's friends' restaurant visits, newest first."""
+
+    items, next_cursor = paginate_feed_request(session["current_user"]["user_id"], request.args)
+
+    return render_template("feed.html",
+                           items=items,
+                           next_cursor=next_cursor)
+
+
+@app.route("/feed.json")
+def feed_json():
+    """Return a page of the current user's friends' restaurant visits as JSON, newest first."""
+
+    items, next_cursor = paginate_feed_request(session["current_user"]["user_id"], request.args)
+
+    return jsonify(items=[{"visit_id": item.visit_id,
+                           "visited_at": item.visited_At.isoformat() if item.visited_At else None,
+                           "user_id": item.user_id,
+                           "first_name": item.first_name,
+                           "last_name": item.last_name,
+                           "restaurant_id": item.restaurant_id,
+                           "restaurant": item.name,
+                           "image_url": item.image_url or "/static/img/restaurant-avatar.png"} for item in items],
+                   next_cursor=next_cursor)
+
+
+@app.route("/friends/requests/counts.json")
+def friend_request_counts():
+    """
+    Return the current user's number of pending friend requests as JSON, for the navbar badges.
+
+    Counts come from the user's counters. The response has an ETag, so polling with
+    If-None-Match gets an empty 304 Not Modified until the counts change.
+    """
+
+    counts = get_request_counts(session["current_user"]["user_id"])
+
+    response = jsonify(counts)
+    response.set_etag("%(received)s-%(sent)s" % counts)
+    # Browsers may keep the response, but must check it's still current before using it
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    return response.make_conditional(request)
+
+
+@app.route("/friends/requests/stream")
+def friend_request_stream():
+    """
+    Stream the current user's number of pending friend requests as Server-Sent Events.
+
+    An event is sent whenever the counts change. The stream ends after a while to free up the
+    worker, and the browser's EventSource reconnects on its own.
+    """
+
+    user_id = session["current_user"]["user_id"]
+
+    def generate():
+        last_counts = None
+        started_at = time.time()
+
+        while time.time() - started_at < REQUEST_STREAM_DURATION_SECONDS:
+            counts = get_request_counts(user_id)
+            # End the transaction, so the next check sees new requests and the connection goes back to the pool
+            db.session.close()
+
+            if counts != last_counts:
+                yield "retry: %d\ndata: %s\n\n" % (REQUEST_STREAM_INTERVAL_SECONDS * 1000, json.dumps(counts))
+                last_counts = counts
+
+            time.sleep(REQUEST_STREAM_INTERVAL_SECONDS)
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+
+    return response
+
+
+@app.route("/friends/suggestions.json")
+def friend_suggestions():
+    """Return "people you may know" for the current user as JSON, ranked by mutual friends."""
+
+    limit = min(request.args.get("limit", 10, type=int), 50)
+
+    suggestions = suggest_friends(session["current_user"]["user_id"], limit)
+
+    return jsonify(suggestions=[{"user_id": user.user_id,
+                                 "first_name": user.first_name,
+                                 "last_name": user.last_name,
+                                 "mutual_friends": mutual_friends} for user, mutual_friends in suggestions])
+
+
 @app.route("/friends/search", methods=["GET"])
+@read_replica
 def search_users():
     """Search for a user by email and return results."""
 
@@ -250,56 +479,177 @@ def search_users():
 
     user_input = request.args.get("q")
 
-    # Search user's query in users table of db and return all search results
-    search_results = search(db.session.query(User), user_input).all()
+    # Search user's query in users table of db a page at a time, cached by normalized query
+    search_results, next_cursor = find_users(user_input,
+                                             decode_cursor(request.args.get("cursor")),
+                                             get_page_size(request.args.get("per_page")))
+
+    # Current user's relationship with everyone on this page, in one lookup
+    relationships = get_relationship_statuses(session["current_user"]["user_id"],
+                                              [user["user_id"] for user in search_results])
 
     return render_template("friends_search_results.html",
                            received_friend_requests=received_friend_requests,
                            sent_friend_requests=sent_friend_requests,
                            friends=friends,
-                           search_results=search_results)
+                           search_results=search_results,
+                           relationships=relationships,
+                           user_input=user_input,
+                           next_cursor=next_cursor)
 
 
 @app.route("/restaurants")
+@read_replica
 def restaurant_list():
-    """Show list of restaurants."""
+    """Show a page of open restaurants, sorted alphabetically, with how many are in each category."""
+
+    category_ids, match_all = parse_category_filter(request.args)
 
-    # Returns all restaurants, sorted alphabetically
-    restaurants = db.session.query(Restaurant).order_by(Restaurant.name).all()
+    open_restaurants = db.session.query(Restaurant).filter(Restaurant.is_closed == False)
+
+    restaurants, next_cursor = paginate_request(filter_by_categories(open_restaurants,
+                                                                     category_ids,
+                                                                     match_all), RESTAURANT_SORT_KEY, request.args)
 
     return render_template("restaurant_list.html",
-                           restaurants=restaurants)
+                           restaurants=restaurants,
+                           next_cursor=next_cursor,
+                           facets=get_facets("restaurants", category_ids, match_all),
+                           category_ids=category_ids,
+                           match_all=match_all)
+
+
+@app.route("/restaurants.json")
+@read_replica
+def restaurant_list_json():
+    """Return a page of open restaurants as JSON, sorted alphabetically, with how many are in each category."""
+
+    category_ids, match_all = parse_category_filter(request.args)
+
+    # Only the columns in the JSON are selected, with coordinates cast to floats in SQL
+    restaurants, next_cursor = paginate_request(filter_by_categories(query_restaurants(),
+                                                                     category_ids,
+                                                                     match_all), RESTAURANT_SORT_KEY, request.args)
+
+    return jsonify(restaurants=[serialize_restaurant(restaurant) for restaurant in restaurants],
+                   facets=get_facets("restaurants", category_ids, match_all),
+                   next_cursor=next_cursor)
+
+
+@app.route("/restaurants/viewport.json")
+@read_replica
+def restaurants_in_viewport():
+    """Return the restaurants inside map bounds ("south,west,north,east") as JSON, nearest the center first."""
+
+    bounds = parse_bounds(request.args.get("bounds"))
+
+    if bounds is None:
+        raise InvalidBounds("Bounds must be south,west,north,east in degrees.")
+
+    return jsonify(restaurants=[serialize_restaurant(restaurant)
+                                for restaurant in find_restaurants_in_viewport(bounds)])
+
+
+@app.route("/restaurants/nearby.json")
+@read_replica
+def nearby_restaurants():
+    """Return the restaurants nearest a lat and lng as JSON, with their distance in meters."""
+
+    latitude, longitude = parse_location(request.args.get("lat"), request.args.get("lng"))
+    limit = get_nearby_limit(request.args.get("limit", type=int))
+
+    return jsonify(restaurants=[serialize_restaurant(restaurant)
+                                for restaurant in find_nearest_restaurants(latitude, longitude, limit)])
+
+
+@app.route("/popular.json")
+@app.route("/cities/<int:city_id>/popular.json")
+@read_replica
+def popular_restaurants(city_id=None):
+    """
+    Return a city's restaurants with the most breadcrumbs as JSON, or with order=trending the most recent.
+
+    Without a city, returns those of the city with the most breadcrumbs, for the homepage.
+    """
+
+    city = None
+
+    if city_id is None:
+        city = get_busiest_city()
+
+        if city is None:
+            return jsonify(city=None, restaurants=[])
+
+        city_id = city.city_id
+
+    limit = get_popular_limit(request.args.get("limit", type=int))
+
+    return jsonify(city=city._asdict() if city else {"city_id": city_id},
+                   restaurants=get_popular_restaurants(city_id, request.args.get("order") == "trending", limit))
 
 
 @app.route("/restaurants/search", methods=["GET"])
+@read_replica
 def search_restaurants():
-    """Search for a restaurant by name or address and return results."""
+    """Search for a restaurant by name or address and return results, with how many are in each category."""
 
     user_input = request.args.get("q")
+    category_ids, match_all = parse_category_filter(request.args)
+
+    # Search user's query in restaurant table of db, cached by normalized query and category filter
+    search_results = find_restaurants(user_input, category_ids, match_all)
+
+    return render_template("restaurants_search_results.html",
+                           search_results=search_results,
+                           facets=find_restaurant_facets(user_input, category_ids, match_all),
+                           category_ids=category_ids,
+                           match_all=match_all)
+
+
+@app.route("/search/stats.json")
+def search_cache_stats():
+    """Return hit/miss stats for the search result caches as JSON."""
+
+    return jsonify(get_search_cache_stats())
+
+
+@app.route("/metrics")
+def show_metrics():
+    """Return request, database pool and cache metrics in Prometheus text format."""
+
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 
-    # Search user's query in restaurant table of db and return all search results
-    search_results = search(db.session.query(Restaurant), user_input).all()
+@app.route("/autocomplete")
+def autocomplete_names():
+    """
+    Return restaurant and user names starting with what's been typed so far, most popular first.
 
-    return render_template("restaurants_search_results.html", search_results=search_results)
+    Pass type=restaurant or type=user to only complete one kind of name.
+    """
+
+    prefix = request.args.get("q")
+    limit = min(request.args.get("limit", 8, type=int), AUTOCOMPLETE_MAX_RESULTS)
+    kinds = [request.args["type"]] if request.args.get("type") else ["restaurant", "user"]
+
+    return jsonify(suggestions=autocomplete.complete(prefix, limit, kinds))
 
 
 @app.route("/restaurants/<int:restaurant_id>")
+@read_replica
 def restaurant_profile(restaurant_id):
     """Show restaurant information."""
 
-    restaurant = db.session.query(Restaurant).filter(Restaurant.restaurant_id == restaurant_id).one()
+    restaurant = db.session.query(Restaurant).options(joinedload(Restaurant.city)).filter(
+        Restaurant.restaurant_id == restaurant_id).one()
 
-    # Returns query for current user's friends, not User objects
-    friends = get_friends(session["current_user"]["user_id"])
-
-    # Pass friends into this query to filter by restaurant, and join visits table to
-    # see which of user's friends have visited this restaurant
-    friends_who_visited = friends.filter(Visit.restaurant_id == restaurant_id).join(Visit,
-                                                                                    Visit.user_id == Connection.user_b_id).all()
+    # Cached visitor ids for the restaurant, intersected with the current user's friends
+    friends_who_visited, num_visitors = get_friends_who_visited(session["current_user"]["user_id"], restaurant_id)
 
     return render_template("restaurant_profile.html",
                            restaurant=restaurant,
-                           friends_who_visited=friends_who_visited)
+                           friends_who_visited=friends_who_visited,
+                           num_visitors=num_visitors)
 
 
 @app.route("/add-visit", methods=["POST"])
@@ -316,8 +666,17 @@ def add_visit():
     except NoResultFound:
         visit = Visit(user_id=session["current_user"]["user_id"], restaurant_id=restaurant_id)
         db.session.add(visit)
+        increment_counters(visit.user_id, num_visits=1)
+        # Flushed first, so the visit has an id to fan out to friends' feeds
+        db.session.flush()
+        fan_out_visit(visit)
+        record_popular_visit(visit)
         db.session.commit()
 
+        autocomplete.record_visit(visit.user_id, visit.restaurant_id)
+        clear_user_clusters(visit.user_id)
+        record_visitor(visit.restaurant_id, visit.user_id)
+
         flash("You just left a breadcrumb for this restaurant.", "success")
         return redirect("/users/%s" % session["current_user"]["user_id"])
 
@@ -325,6 +684,31 @@ def add_visit():
     return redirect("/restaurants/%s" % restaurant_id)
 
 
+@app.route("/add-photo", methods=["POST"])
+def add_visit_photo():
+    """Upload a photo for one of the user's restaurant visits."""
+
+    visit_id = request.form.get("visit_id", type=int)
+    upload = request.files.get("photo")
+
+    visit = db.session.query(Visit).filter(Visit.visit_id == visit_id,
+                                           Visit.user_id == session["current_user"]["user_id"]).first()
+
+    if visit is None or not upload or not upload.filename:
+        flash("Choose one of your breadcrumbs and a photo to upload.", "danger")
+        return redirect("/users/%s" % session["current_user"]["user_id"])
+
+    # Thumbnails are made in the background, so this only saves the file
+    try:
+        add_photo(app, visit, upload, request.form.get("rating"))
+    except InvalidPhoto as error:
+        flash(str(error), "danger")
+        return redirect("/users/%s" % session["current_user"]["user_id"])
+
+    flash("Your photo has been added to your breadcrumb.", "success")
+    return redirect("/users/%s" % session["current_user"]["user_id"])
+
+
 @app.route("/error")
 def error():
     raise Exception("Error!")
@@ -335,9 +719,13 @@ if __name__ == "__main__":
     app.debug = True
 
     # connect_to_db(app)
-    connect_to_db(app, os.environ.get("DATABASE_URL"))
+    connect_to_db(app, os.environ.get("DATABASE_URL"), os.environ.get("DATABASE_REPLICA_URL"))
     db.create_all()
 
+    # Build the in-memory friend graph and autocomplete indexes up front rather than on the first request
+    friend_graph.load()
+    autocomplete.build()
+
     # Use the DebugToolbar
     # DebugToolbarExtension(app)
 
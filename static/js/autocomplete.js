@@ -0,0 +1,29 @@
+"use strict";
+
+// Suggest restaurant names in the navbar search box while the user types
+var suggestionsTimer = null;
+
+function showSuggestions(results) {
+    var datalist = $("#restaurant-suggestions").empty();
+
+    for (var i = 0; i < results.suggestions.length; i++) {
+        $("<option>").attr("value", results.suggestions[i].name).appendTo(datalist);
+    }
+}
+
+function getSuggestions() {
+    var prefix = $("#searchbox").val();
+
+    // Wait until the user stops typing for a moment before asking the server
+    clearTimeout(suggestionsTimer);
+
+    if (prefix.length < 2) {
+        return;
+    }
+
+    suggestionsTimer = setTimeout(function () {
+        $.get("/autocomplete", {"q": prefix, "type": "restaurant"}, showSuggestions);
+    }, 150);
+}
+
+$("#searchbox[list=restaurant-suggestions]").on("input", getSuggestions);
@@ -1,7 +1,7 @@
 "use strict";
 
-// URL (string) to pass into AJAX get request
-var user_visits_json = "/users/" + $("#user-info").data("userid") + "/visits.json";
+// URL (string) to pass into AJAX get request; the map's zoom and bounds are added to it
+var user_clusters_json = "/users/" + $("#user-info").data("userid") + "/visits/clusters.json";
 
 function initMap() {
   
@@ -35,36 +35,38 @@ function initMap() {
 
     var iconImage = '/static/img/restaurant-marker.png';
 
-    // Get JSON for user's restaurant visits with the response passed into the function
-    $.get(user_visits_json, function (visits) {
-
-        // For every restaurant that the user has visited, specify restaurant details and place markers
-        for (var key in visits) {
-            var visit = visits[key];
-
-            var restaurantDetails = '<div class="media">' +
-                    '<a href="/restaurants/' + visit.rest_id + '">' +
-                    '<div class="media-left">' +
-                    '<img class="media-object" src="' + visit.image_url + '" alt="Image for' + visit.restaurant + '">' +
-                    '</div>' +
-                    '<div class="media-body">' +
-                    '<h5 class="media-heading">' + visit.restaurant + '</h5>' +
-                    '<p>' +
-                    '<span class="glyphicon glyphicon-map-marker" aria-hidden="true"></span> ' + visit.address + '<br>' +
-                    '<span class="glyphicon glyphicon-earphone" aria-hidden="true"></span> ' + visit.phone +
-                    '</p>' +
-                    '</div>' +
-                    '</a>' +
-                    '</div>';
-
-            // Specify marker coordinates with the restaurant's coordinates
-            var markerLatLng = {lat: visit.latitude, lng: visit.longitude};
-
-            var marker = new google.maps.Marker({
+    // Markers on the map right now, replaced every time the map stops moving
+    var markers = [];
+    var latestRequest = 0;
+
+    function restaurantDetails(restaurant) {
+        return '<div class="media">' +
+                '<a href="/restaurants/' + restaurant.rest_id + '">' +
+                '<div class="media-left">' +
+                '<img class="media-object" src="' + restaurant.image_url + '" alt="Image for' + restaurant.restaurant + '">' +
+                '</div>' +
+                '<div class="media-body">' +
+                '<h5 class="media-heading">' + restaurant.restaurant + '</h5>' +
+                '<p>' +
+                '<span class="glyphicon glyphicon-map-marker" aria-hidden="true"></span> ' + restaurant.address + '<br>' +
+                '<span class="glyphicon glyphicon-earphone" aria-hidden="true"></span> ' + restaurant.phone +
+                '</p>' +
+                '</div>' +
+                '</a>' +
+                '</div>';
+    }
+
+    function addClusterMarker(cluster) {
+        // Specify marker coordinates with the cluster's centroid
+        var markerLatLng = {lat: cluster.latitude, lng: cluster.longitude};
+        var marker;
+
+        if (cluster.restaurant) {
+            marker = new google.maps.Marker({
                 position: markerLatLng,
                 map: map,
-                title: 'Restaurant: ' + visit.restaurant,
-                html: restaurantDetails,
+                title: 'Restaurant: ' + cluster.restaurant.restaurant,
+                html: restaurantDetails(cluster.restaurant),
                 icon: iconImage
             });
 
@@ -74,8 +76,50 @@ function initMap() {
                 infoWindow.open(map, this);
             });
 
+        } else {
+            marker = new google.maps.Marker({
+                position: markerLatLng,
+                map: map,
+                title: cluster.count + ' restaurants',
+                label: String(cluster.count)
+            });
+
+            // When a cluster is clicked, zoom in to the restaurants in it
+            var bounds = new google.maps.LatLngBounds(
+                {lat: cluster.bounds.south, lng: cluster.bounds.west},
+                {lat: cluster.bounds.north, lng: cluster.bounds.east});
+
+            marker.addListener('click', function() {
+                map.fitBounds(bounds);
+            });
         }
 
+        markers.push(marker);
+    }
+
+    // Get JSON for the clusters of the user's restaurant visits in view whenever the map stops moving
+    map.addListener('idle', function() {
+        var request = ++latestRequest;
+        var params = {zoom: map.getZoom(), bounds: map.getBounds().toUrlValue()};
+
+        $.get(user_clusters_json, params, function (response) {
+
+            // A newer request was sent while this one was on its way
+            if (request !== latestRequest) {
+                return;
+            }
+
+            for (var i = 0; i < markers.length; i++) {
+                markers[i].setMap(null);
+            }
+
+            markers = [];
+
+            for (var j = 0; j < response.clusters.length; j++) {
+                addClusterMarker(response.clusters[j]);
+            }
+
+        });
     });
   
 }
\ No newline at end of file
@@ -0,0 +1,28 @@
+"use strict";
+
+// Show the most breadcrumbed restaurants in the busiest city on the homepage
+var popularRestaurantsUrl = "/popular.json?limit=5";
+
+function showPopularRestaurants(results) {
+    if (!results.restaurants.length) {
+        return;
+    }
+
+    $("#popular-city").text(results.city.name);
+
+    var list = $("#popular-restaurants").empty();
+
+    results.restaurants.forEach(function (restaurant) {
+        var breadcrumbs = restaurant.num_visits + (restaurant.num_visits === 1 ? " breadcrumb" : " breadcrumbs");
+
+        $("<a class='list-group-item'>")
+            .attr("href", "/restaurants/" + restaurant.restaurant_id)
+            .text(restaurant.name)
+            .prepend($("<span class='badge'>").text(breadcrumbs))
+            .appendTo(list);
+    });
+
+    $("#popular-section").removeClass("hidden");
+}
+
+$.getJSON(popularRestaurantsUrl, showPopularRestaurants);
@@ -0,0 +1,28 @@
+"use strict";
+
+// Keep the friend request badges current without reloading the page
+var requestCountsUrl = "/friends/requests/counts.json";
+var requestStreamUrl = "/friends/requests/stream";
+
+function showRequestCounts(counts) {
+    $("[data-request-count]").each(function () {
+        $(this).text(counts[$(this).data("request-count")]);
+    });
+}
+
+// Streaming holds a server worker per open page, so it's only used when the server turns it on
+var useRequestStream = $("#request-counts-script").data("stream") === "on";
+
+if (useRequestStream && window.EventSource) {
+    // The server pushes new counts whenever they change
+    var requestStream = new EventSource(requestStreamUrl);
+
+    requestStream.onmessage = function (evt) {
+        showRequestCounts(JSON.parse(evt.data));
+    };
+} else {
+    // Otherwise poll; unchanged counts come back as a cheap 304 thanks to the ETag
+    setInterval(function () {
+        $.getJSON(requestCountsUrl, showRequestCounts);
+    }, 30000);
+}
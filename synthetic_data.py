@@ -0,0 +1,341 @@
+"""Deterministic synthetic dataset, for reproducing production-scale behaviour offline
+
+Generates cities, restaurants spread around each city's neighbourhoods with categories,
+users, visits and a friend graph. Visits and friendships are power-law distributed: a
+few restaurants and users account for most of them, as in real usage. The same seed
+always generates the same data.
+
+Everything is generated in memory, then bulk loaded with COPY, so a million visits
+load in a couple of minutes. Rows are added after whatever is already in the database.
+"""
+
+from sqlalchemy import func, text
+
+from model import User, Restaurant, Category, City
+from model import db
+
+from feed import rebuild_feeds
+from popular import rebuild_popular_restaurants
+
+from array import array
+from bisect import bisect
+from collections import Counter
+from cStringIO import StringIO
+from itertools import izip
+
+import datetime
+import random
+
+# Rows sent per COPY
+COPY_BATCH_SIZE = 100000
+
+# Real city centres to spread restaurants around, as (name, latitude, longitude)
+CITY_CENTRES = [("Vancouver", 49.2827, -123.1207), ("Sunnyvale", 37.3688, -122.0363),
+                ("San Francisco", 37.7749, -122.4194), ("Seattle", 47.6062, -122.3321),
+                ("Portland", 45.5152, -122.6784), ("Los Angeles", 34.0522, -118.2437),
+                ("New York", 40.7128, -74.0060), ("Chicago", 41.8781, -87.6298),
+                ("Toronto", 43.6532, -79.3832), ("Austin", 30.2672, -97.7431)]
+
+NEIGHBOURHOODS_PER_CITY = 12
+
+# Spread, in degrees, of neighbourhoods around a city centre and of restaurants around a neighbourhood
+NEIGHBOURHOOD_SPREAD = 0.05
+RESTAURANT_SPREAD = 0.008
+
+# Power-law exponents for how visits are spread over restaurants and users
+RESTAURANT_POPULARITY_EXPONENT = 1.0
+USER_ACTIVITY_EXPONENT = 0.8
+
+# Chance a visit or friendship stays within the user's own city
+SAME_CITY_CHANCE = 0.8
+
+# Chance a friendship is still a pending request
+PENDING_REQUEST_CHANCE = 0.1
+
+# Visits are spread evenly over the year before this, in the order they're loaded
+LAST_VISIT_AT = datetime.datetime(2016, 9, 1)
+VISITS_PERIOD = datetime.timedelta(days=365)
+
+CATEGORIES = ["Sushi", "Ramen", "Mexican", "Pizza", "French", "Chinese", "Dim Sum", "Cafes", "Bakeries",
+              "Burgers", "Thai", "Vietnamese", "Indian", "Korean", "Italian", "Seafood", "Vegan", "Bars"]
+FIRST_NAMES = ["Ashley", "Ben", "Chloe", "Daniel", "Emma", "Farah", "Grace", "Hiro", "Isabel", "Jun",
+               "Kate", "Liam", "Maya", "Noah", "Olivia", "Priya", "Quinn", "Ravi", "Sofia", "Tom"]
+LAST_NAMES = ["Hsia", "Smith", "Nguyen", "Garcia", "Chen", "Patel", "Kim", "Martin", "Lee", "Wong",
+              "Brown", "Singh", "Tanaka", "Lopez", "Cohen", "Ali", "Park", "Davis", "Silva", "Khan"]
+NAME_WORDS = ["Golden", "Little", "Blue", "Happy", "Royal", "Garden", "Corner", "Lucky", "Urban", "Old Town",
+              "Harbour", "Maple", "Red Door", "Twin", "Sunny", "Night Owl"]
+STREETS = ["Main St", "Granville St", "Broadway", "Oak St", "Market St", "1st Ave", "Pine St", "Elm St"]
+
+
+class PowerLawSampler(object):
+    """Draws items at random, the item at rank k being drawn in proportion to 1 / k ** exponent."""
+
+    def __init__(self, items, exponent, rng):
+        self.items = items
+        self.rng = rng
+        self.cumulative_weights = []
+
+        total = 0.0
+
+        for rank in xrange(1, len(items) + 1):
+            total += rank ** -exponent
+            self.cumulative_weights.append(total)
+
+    def sample(self):
+        """Draw one item."""
+
+        return self.items[bisect(self.cumulative_weights, self.rng.random() * self.cumulative_weights[-1])]
+
+
+def copy_value(value):
+    """Format a value for COPY's text format."""
+
+    if value is None:
+        return "\\N"
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+def copy_rows(table_name, columns, rows):
+    """
+    Bulk load an iterable of row tuples into a table with COPY, COPY_BATCH_SIZE rows at a time.
+
+    Note: This does not commit.
+    """
+
+    cursor = db.session.connection().connection.cursor()
+    statement = "COPY %s (%s) FROM STDIN" % (table_name, ", ".join(columns))
+
+    batch = StringIO()
+    num_rows = 0
+
+    for row in rows:
+        batch.write("\t".join(copy_value(value) for value in row))
+        batch.write("\n")
+        num_rows += 1
+
+        if num_rows % COPY_BATCH_SIZE == 0:
+            batch.seek(0)
+            cursor.copy_expert(statement, batch)
+            batch = StringIO()
+
+    if num_rows % COPY_BATCH_SIZE:
+        batch.seek(0)
+        cursor.copy_expert(statement, batch)
+
+
+def get_next_id(column):
+    """Return the first id after those already in column's table."""
+
+    return (db.session.query(func.max(column)).scalar() or 0) + 1
+
+
+def reset_sequence(table_name, column_name):
+    """Move a serial column's sequence past ids that were copied in explicitly."""
+
+    db.session.execute(text("SELECT setval(pg_get_serial_sequence(:table_name, :column_name), "
+                            "(SELECT max(%s) FROM %s))" % (column_name, table_name)),
+                       {"table_name": table_name, "column_name": column_name})
+
+
+def get_category_ids():
+    """Add any missing categories, returning their ids in order of CATEGORIES."""
+
+    existing = dict(db.session.query(Category.name, Category.category_id).filter(Category.name.in_(CATEGORIES)))
+
+    for name in CATEGORIES:
+        if name not in existing:
+            category = Category(name=name)
+            db.session.add(category)
+            db.session.flush()
+            existing[name] = category.category_id
+
+    return [existing[name] for name in CATEGORIES]
+
+
+def generate(num_cities=10, num_restaurants=20000, num_users=50000, num_visits=1000000, friends_per_user=20,
+             seed=0):
+    """
+    Generate and bulk load a synthetic dataset, then commit.
+
+    Returns a dictionary counting the rows loaded into each table.
+    """
+
+    rng = random.Random(seed)
+
+    # Cities
+    first_city_id = get_next_id(City.city_id)
+    city_ids = range(first_city_id, first_city_id + num_cities)
+    neighbourhoods = {}
+    cities = []
+
+    for i, city_id in enumerate(city_ids):
+        name, latitude, longitude = CITY_CENTRES[i % len(CITY_CENTRES)]
+
+        if i >= len(CITY_CENTRES):
+            name = "%s %s" % (name, i / len(CITY_CENTRES) + 1)
+
+        # Named apart from seeded cities, and left unsynced so seed.py --sync never sends them to Yelp
+        cities.append((city_id, "%s (synthetic)" % name, None))
+        neighbourhoods[city_id] = [(rng.gauss(latitude, NEIGHBOURHOOD_SPREAD), rng.gauss(longitude, NEIGHBOURHOOD_SPREAD))
+                                   for _ in xrange(NEIGHBOURHOODS_PER_CITY)]
+
+    # Bigger cities come first, with more restaurants and users
+    city_sampler = PowerLawSampler(city_ids, 1.0, rng)
+
+    # Restaurants and their categories
+    category_ids = get_category_ids()
+    category_sampler = PowerLawSampler(range(len(CATEGORIES)), 1.0, rng)
+
+    first_restaurant_id = get_next_id(Restaurant.restaurant_id)
+    restaurants = []
+    restaurant_categories = []
+    city_restaurant_ids = dict((city_id, []) for city_id in city_ids)
+
+    for restaurant_id in xrange(first_restaurant_id, first_restaurant_id + num_restaurants):
+        city_id = city_sampler.sample()
+        latitude, longitude = rng.choice(neighbourhoods[city_id])
+        categories = sorted(set(category_sampler.sample() for _ in xrange(rng.randint(1, 3))))
+
+        restaurants.append((restaurant_id,
+                            city_id,
+                            "%s %s" % (rng.choice(NAME_WORDS), CATEGORIES[categories[0]]),
+                            "%s %s" % (rng.randint(1, 9999), rng.choice(STREETS)),
+                            "(555) %03d-%04d" % (rng.randint(200, 999), rng.randint(0, 9999)),
+                            "%.6f" % rng.gauss(latitude, RESTAURANT_SPREAD),
+                            "%.6f" % rng.gauss(longitude, RESTAURANT_SPREAD)))
+        restaurant_categories.extend((restaurant_id, category_ids[category]) for category in categories)
+        city_restaurant_ids[city_id].append(restaurant_id)
+
+    # Shuffled so the most popular restaurants aren't simply the lowest ids
+    all_restaurant_ids = range(first_restaurant_id, first_restaurant_id + num_restaurants)
+    rng.shuffle(all_restaurant_ids)
+    restaurant_sampler = PowerLawSampler(all_restaurant_ids, RESTAURANT_POPULARITY_EXPONENT, rng)
+
+    city_restaurant_samplers = {}
+
+    for city_id, restaurant_ids in city_restaurant_ids.items():
+        if restaurant_ids:
+            rng.shuffle(restaurant_ids)
+            city_restaurant_samplers[city_id] = PowerLawSampler(restaurant_ids, RESTAURANT_POPULARITY_EXPONENT, rng)
+
+    # Users, each living in a city
+    first_user_id = get_next_id(User.user_id)
+    user_ids = range(first_user_id, first_user_id + num_users)
+    user_city_ids = dict((user_id, city_sampler.sample()) for user_id in user_ids)
+
+    city_user_ids = dict((city_id, []) for city_id in city_ids)
+
+    for user_id in user_ids:
+        city_user_ids[user_city_ids[user_id]].append(user_id)
+
+    active_users = list(user_ids)
+    rng.shuffle(active_users)
+    user_sampler = PowerLawSampler(active_users, USER_ACTIVITY_EXPONENT, rng)
+
+    # Visits, mostly to restaurants in the visitor's own city, at most one per user and restaurant.
+    # Pairs already visited are kept as single ints, as a million tuples take far more memory.
+    pair_base = first_restaurant_id + num_restaurants
+    visited = set()
+    visit_user_ids = array("l")
+    visit_restaurant_ids = array("l")
+    max_visits = min(num_visits, num_users * num_restaurants)
+
+    for _ in xrange(max_visits * 3):
+        if len(visit_user_ids) == max_visits:
+            break
+
+        user_id = user_sampler.sample()
+        city_sampler_for_user = city_restaurant_samplers.get(user_city_ids[user_id])
+
+        if city_sampler_for_user and rng.random() < SAME_CITY_CHANCE:
+            restaurant_id = city_sampler_for_user.sample()
+        else:
+            restaurant_id = restaurant_sampler.sample()
+
+        if user_id * pair_base + restaurant_id not in visited:
+            visited.add(user_id * pair_base + restaurant_id)
+            visit_user_ids.append(user_id)
+            visit_restaurant_ids.append(restaurant_id)
+
+    visited = None
+
+    # Friendships, mostly within a city and skewed towards the most active users. Each user starts
+    # friends_per_user / 2 friendships on average, so has about friends_per_user friends.
+    friendships = set()
+
+    for user_id in user_ids:
+        for _ in xrange(min(int(rng.paretovariate(1.5) * friends_per_user / 6.0), num_users)):
+            if rng.random() < SAME_CITY_CHANCE:
+                friend_id = rng.choice(city_user_ids[user_city_ids[user_id]])
+            else:
+                friend_id = user_sampler.sample()
+
+            if friend_id != user_id:
+                friendships.add((min(user_id, friend_id), max(user_id, friend_id)))
+
+    # Accepted friendships are stored in both directions, pending requests from sender to receiver
+    connections = []
+
+    for user_a_id, user_b_id in sorted(friendships):
+        if rng.random() < PENDING_REQUEST_CHANCE:
+            sender_id, receiver_id = (user_a_id, user_b_id) if rng.random() < 0.5 else (user_b_id, user_a_id)
+            connections.append((sender_id, receiver_id, "Requested"))
+        else:
+            connections.extend([(user_a_id, user_b_id, "Accepted"), (user_b_id, user_a_id, "Accepted")])
+
+    # Users' counters, computed up front rather than recomputed after loading
+    num_user_visits = Counter(visit_user_ids)
+    num_friends = Counter(user_a_id for user_a_id, _, status in connections if status == "Accepted")
+    num_sent_requests = Counter(user_a_id for user_a_id, _, status in connections if status == "Requested")
+    num_received_requests = Counter(user_b_id for _, user_b_id, status in connections if status == "Requested")
+
+    users = ((user_id,
+              user_city_ids[user_id],
+              "synthetic%s@example.com" % user_id,
+              "password",
+              rng.choice(FIRST_NAMES),
+              rng.choice(LAST_NAMES),
+              num_user_visits[user_id],
+              num_friends[user_id],
+              num_received_requests[user_id],
+              num_sent_requests[user_id]) for user_id in user_ids)
+
+    copy_rows("cities", ["city_id", "name", '"updated_At"'], cities)
+    copy_rows("restaurants", ["restaurant_id", "city_id", "name", "address", "phone", "latitude", "longitude"],
+              restaurants)
+    copy_rows("restaurantcategories", ["restaurant_id", "category_id"], restaurant_categories)
+    copy_rows("users", ["user_id", "city_id", "email", "password", "first_name", "last_name",
+                        "num_visits", "num_friends", "num_received_requests", "num_sent_requests"], users)
+    visit_interval = VISITS_PERIOD // max(len(visit_user_ids), 1)
+    visited_ats = (LAST_VISIT_AT - VISITS_PERIOD + i * visit_interval for i in xrange(len(visit_user_ids)))
+    copy_rows("visits", ["user_id", "restaurant_id", '"visited_At"'],
+              izip(visit_user_ids, visit_restaurant_ids, visited_ats))
+    copy_rows("connections", ["user_a_id", "user_b_id", "status"], connections)
+
+    for table_name, column_name in [("cities", "city_id"), ("restaurants", "restaurant_id"), ("users", "user_id")]:
+        reset_sequence(table_name, column_name)
+
+    db.session.commit()
+
+    # Friends' activity feeds, fanned out in bulk rather than visit by visit
+    num_feed_items = rebuild_feeds()
+
+    # Visit counts behind each city's popular restaurants
+    num_popular_restaurants = rebuild_popular_restaurants()
+
+    # Refresh the planner's statistics for the freshly loaded tables
+    for table_name in ["cities", "restaurants", "restaurantcategories", "users", "visits", "connections",
+                       "feed_items", "restaurant_popularity"]:
+        db.session.execute("ANALYZE %s" % table_name)
+
+    db.session.commit()
+
+    return {"cities": len(cities),
+            "restaurants": len(restaurants),
+            "restaurantcategories": len(restaurant_categories),
+            "users": num_users,
+            "visits": len(visit_user_ids),
+            "connections": len(connections),
+            "feed_items": num_feed_items,
+            "popular_restaurants": num_popular_restaurants}
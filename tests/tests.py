@@ -4,6 +4,7 @@
 # and import modules from parent directory, i.e. server
 import os
 import sys
+import json
 
 current_file_path = os.path.realpath(__file__)
 current_dir = os.path.dirname(current_file_path)
@@ -132,6 +133,65 @@ class FlaskTestsDatabase(TestCase):
         result = self.client.get("/restaurants")
         self.assertIn("Chambar", result.data)
 
+    def test_restaurants_json_pages(self):
+        """Test restaurants JSON is paginated by cursor in alphabetical order."""
+
+        first_page = json.loads(self.client.get("/restaurants.json?per_page=2").data)
+        self.assertEqual([r["name"] for r in first_page["restaurants"]], ["Chambar", "Fable"])
+        self.assertIsInstance(first_page["restaurants"][0]["latitude"], float)
+
+        second_page = json.loads(self.client.get("/restaurants.json?per_page=2&cursor=%s" % first_page["next_cursor"]).data)
+        self.assertEqual([r["name"] for r in second_page["restaurants"]], ["Miku"])
+        self.assertIsNone(second_page["next_cursor"])
+
+    def test_closed_restaurants_not_listed(self):
+        """Test closed restaurants are left out of listings, searches, maps and autocomplete."""
+
+        from searches import find_restaurants
+        from autocomplete import autocomplete
+
+        db.session.query(Restaurant).filter(Restaurant.name == "Miku").update({"is_closed": True})
+        db.session.commit()
+        autocomplete.clear()
+
+        result = json.loads(self.client.get("/restaurants.json").data)
+        self.assertEqual([r["name"] for r in result["restaurants"]], ["Chambar", "Fable"])
+
+        self.assertEqual(find_restaurants("miku"), [])
+
+        result = self.client.get("/restaurants/viewport.json?bounds=49.27,-123.12,49.29,-123.10")
+        self.assertEqual([r["name"] for r in json.loads(result.data)["restaurants"]], ["Chambar"])
+
+        self.assertEqual(autocomplete.complete("mik", kinds=["restaurant"]), [])
+
+    def test_restaurants_json_bad_cursor(self):
+        """Test a malformed cursor is rejected."""
+
+        result = self.client.get("/restaurants.json?cursor=not-a-cursor")
+        self.assertEqual(result.status_code, 400)
+
+    def test_restaurants_in_viewport(self):
+        """Test restaurants inside map bounds are returned nearest the center first."""
+
+        result = self.client.get("/restaurants/viewport.json?bounds=49.27,-123.12,49.29,-123.10")
+        restaurants = json.loads(result.data)["restaurants"]
+        self.assertEqual([r["name"] for r in restaurants], ["Chambar", "Miku"])
+        self.assertIsInstance(restaurants[0]["latitude"], float)
+
+        result = self.client.get("/restaurants/viewport.json")
+        self.assertEqual(result.status_code, 400)
+
+    def test_nearby_restaurants(self):
+        """Test the restaurants nearest a location are returned nearest first, with distances."""
+
+        result = self.client.get("/restaurants/nearby.json?lat=49.2868&lng=-123.1132&limit=2")
+        restaurants = json.loads(result.data)["restaurants"]
+        self.assertEqual([r["name"] for r in restaurants], ["Miku", "Chambar"])
+        self.assertLess(restaurants[0]["distance"], restaurants[1]["distance"])
+
+        result = self.client.get("/restaurants/nearby.json?lat=north&lng=-123.1132")
+        self.assertEqual(result.status_code, 400)
+
     def test_restaurants_search(self):
         """Test restaurant search results page."""
 
@@ -140,6 +200,69 @@ class FlaskTestsDatabase(TestCase):
                                  follow_redirects=True)
         self.assertIn("Chambar", result.data)
 
+    def test_restaurants_search_by_category(self):
+        """Test restaurants are found by their category names, ranked, with the match highlighted."""
+
+        from searches import find_restaurants
+
+        sushi = Category(name="Sushi")
+        db.session.add(sushi)
+        db.session.commit()
+        db.session.add(RestaurantCategory(restaurant_id=2, category_id=sushi.category_id))
+        db.session.commit()
+
+        results = find_restaurants("sushi")
+        self.assertEqual([r["name"] for r in results], ["Miku"])
+        self.assertIn("<mark>Sushi</mark>", results[0]["headline"])
+
+        # Prefixes of names still match
+        self.assertEqual([r["name"] for r in find_restaurants("cham")], ["Chambar"])
+
+        result = self.client.get("/restaurants/search?q=sushi")
+        self.assertIn("<mark>Sushi</mark>", result.data)
+
+    def test_restaurants_category_facets(self):
+        """Test restaurants are counted by category and filtered by any or all of them."""
+
+        japanese, sushi = Category(name="Japanese"), Category(name="Sushi")
+        db.session.add_all([japanese, sushi])
+        db.session.commit()
+        db.session.add_all([RestaurantCategory(restaurant_id=2, category_id=japanese.category_id),
+                            RestaurantCategory(restaurant_id=2, category_id=sushi.category_id),
+                            RestaurantCategory(restaurant_id=3, category_id=japanese.category_id)])
+        db.session.commit()
+
+        result = json.loads(self.client.get("/restaurants.json").data)
+        self.assertEqual([(f["name"], f["count"]) for f in result["facets"]], [("Japanese", 2), ("Sushi", 1)])
+
+        url = "/restaurants.json?category=%s&category=%s" % (japanese.category_id, sushi.category_id)
+        self.assertEqual([r["name"] for r in json.loads(self.client.get(url).data)["restaurants"]], ["Fable", "Miku"])
+
+        result = json.loads(self.client.get(url + "&match=all").data)
+        self.assertEqual([r["name"] for r in result["restaurants"]], ["Miku"])
+        self.assertEqual([(f["name"], f["count"], f["selected"]) for f in result["facets"]],
+                         [("Japanese", 1, True), ("Sushi", 1, True)])
+
+        result = self.client.get("/restaurants/search?q=japanese&category=%s" % sushi.category_id)
+        self.assertIn("Miku", result.data)
+        self.assertNotIn("Fable", result.data)
+
+        # Next page and facet links keep the filter and page size
+        result = self.client.get("/restaurants?per_page=1&category=%s" % japanese.category_id)
+        self.assertIn("cursor=", result.data)
+        self.assertIn("per_page=1&amp;category=%s" % japanese.category_id, result.data)
+
+        # A selected category nothing matches is still listed, so it can be unselected
+        tapas = Category(name="Tapas")
+        db.session.add(tapas)
+        db.session.commit()
+
+        url = "/restaurants.json?category=%s&category=%s&match=all" % (japanese.category_id, tapas.category_id)
+        result = json.loads(self.client.get(url).data)
+        self.assertEqual(result["restaurants"], [])
+        self.assertEqual([(f["name"], f["count"], f["selected"]) for f in result["facets"]],
+                         [("Japanese", 0, True), ("Tapas", 0, True)])
+
 
 class FlaskTestsLoggedIn(TestCase):
     """Flask tests with user logged into session."""
@@ -160,10 +283,7 @@ class FlaskTestsLoggedIn(TestCase):
             with c.session_transaction() as sess:
                 sess["current_user"] = {
                     "first_name": "Ashley",
-                    "user_id": 1,
-                    "num_received_requests": 2,
-                    "num_sent_requests": 1,
-                    "num_total_requests": 3
+                    "user_id": 1
                 }
 
     def tearDown(self):
@@ -194,8 +314,941 @@ class FlaskTestsLoggedIn(TestCase):
                                  data={"user_input": "Bob"})
         self.assertIn("Bob Test", result.data)
 
+    def test_user_visits_json(self):
+        """Test user's restaurant visits are streamed as JSON keyed by visit_id."""
+
+        result = self.client.get("/users/1/visits.json")
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, "application/json")
+
+        visits = json.loads(result.data)
+        self.assertEqual(visits.keys(), ["1"])
+        self.assertEqual(visits["1"]["restaurant"], "Chambar")
+        self.assertEqual(visits["1"]["image_url"], "/static/img/restaurant-avatar.png")
+        self.assertIsInstance(visits["1"]["latitude"], float)
+
+    def test_user_visit_clusters_json(self):
+        """Test user's restaurant visits are returned as clusters inside the map bounds."""
+
+        from clusters import visit_clusters_cache
+
+        visit_clusters_cache.clear()
+
+        result = self.client.get("/users/1/visits/clusters.json?zoom=13&bounds=-90,-180,90,180")
+        self.assertEqual(result.status_code, 200)
+
+        clusters = json.loads(result.data)["clusters"]
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]["count"], 1)
+        self.assertEqual(clusters[0]["restaurant"]["restaurant"], "Chambar")
+
+        result = self.client.get("/users/1/visits/clusters.json?zoom=13&bounds=0,0,1,1")
+        self.assertEqual(json.loads(result.data)["clusters"], [])
+
+        result = self.client.get("/users/1/visits/clusters.json?zoom=13&bounds=north")
+        self.assertEqual(result.status_code, 400)
+
+    def assertMaxQueries(self, url, max_queries):
+        """Assert GETting url succeeds with at most max_queries SQL statements."""
+
+        from query_stats import count_queries
+
+        with count_queries() as stats:
+            result = self.client.get(url)
+            # Read the body, so statements run by streamed responses are counted too
+            result.data
+
+        self.assertEqual(result.status_code, 200)
+        self.assertLessEqual(stats.count, max_queries,
+                             "GET %s ran %s statements: %s" % (url, stats.count, stats.shapes.most_common()))
+
+    def test_query_counts(self):
+        """Test pages run a fixed number of statements rather than one per row."""
+
+        self.assertMaxQueries("/users/1", 6)
+        self.assertMaxQueries("/users/1/visits.json", 3)
+        self.assertMaxQueries("/restaurants/1", 5)
+
+    def test_query_stats_headers(self):
+        """Test statement counts are added as response headers in test mode."""
+
+        result = self.client.get("/users/1")
+        self.assertGreater(int(result.headers["X-SQL-Queries"]), 0)
+        self.assertEqual(result.headers["X-SQL-Repeated"], "1")
+
+    def test_accept_friend_updates_counters(self):
+        """Test accepting a friend request keeps both users' counters current."""
+
+        from friends import send_friend_request
+
+        send_friend_request(2, 1)
+
+        result = self.client.post("/accept-friend",
+                                  data={"user_a_id": 2},
+                                  follow_redirects=True)
+        self.assertIn("You are now friends.", result.data)
+
+        ashley = User.query.get(1)
+        bob = User.query.get(2)
+        self.assertEqual((ashley.num_friends, ashley.num_received_requests), (1, 0))
+        self.assertEqual((bob.num_friends, bob.num_sent_requests), (1, 0))
+
+    def test_friends_who_visited(self):
+        """Test restaurant pages show friends who visited and the visitor count, kept current by new visits."""
+
+        from friends import send_friend_request, accept_friend_request
+
+        send_friend_request(2, 1)
+        accept_friend_request(2, 1)
+
+        result = self.client.get("/restaurants/2")
+        self.assertIn("0 people left breadcrumbs here.", result.data)
+        self.assertIn("None of your friends have left a breadcrumb", result.data)
+
+        with self.client.session_transaction() as sess:
+            sess["current_user"]["user_id"] = 2
+
+        self.client.post("/add-visit", data={"restaurant_id": 2})
+
+        with self.client.session_transaction() as sess:
+            sess["current_user"]["user_id"] = 1
+
+        result = self.client.get("/restaurants/2")
+        self.assertIn("1 person left breadcrumbs here.", result.data)
+        self.assertIn("Bob Test", result.data)
+
+    def test_feed(self):
+        """Test friends' visits are fanned out to the feed, newest first, and backfilled for new friends."""
+
+        from friends import send_friend_request, accept_friend_request
+
+        # Bob's feed gets Ashley's existing visit when they become friends
+        send_friend_request(2, 1)
+        accept_friend_request(2, 1)
+
+        with self.client.session_transaction() as sess:
+            sess["current_user"]["user_id"] = 2
+
+        self.client.post("/add-visit", data={"restaurant_id": 2})
+
+        with self.client.session_transaction() as sess:
+            sess["current_user"]["user_id"] = 1
+
+        # Ashley's visit to Miku is fanned out to Bob
+        self.client.post("/add-visit", data={"restaurant_id": 2})
+        self.assertEqual(FeedItem.query.filter_by(user_id=2).count(), 2)
+
+        with self.client.session_transaction() as sess:
+            sess["current_user"]["user_id"] = 2
+
+        first_page = json.loads(self.client.get("/feed.json?per_page=1").data)
+        self.assertEqual([item["restaurant"] for item in first_page["items"]], ["Miku"])
+
+        second_page = json.loads(self.client.get("/feed.json?per_page=1&cursor=%s" % first_page["next_cursor"]).data)
+        self.assertEqual([item["restaurant"] for item in second_page["items"]], ["Chambar"])
+        self.assertIsNone(second_page["next_cursor"])
+
+        result = self.client.get("/feed")
+        self.assertIn("Ashley Test", result.data)
+
+        # The link to older breadcrumbs keeps the page size
+        result = self.client.get("/feed?per_page=1")
+        self.assertIn("per_page=1", result.data)
+
+    def test_feed_pulls_popular_friends(self):
+        """Test visits by friends with too many friends to fan out are read from their visits instead."""
+
+        import feed
+        from friends import send_friend_request, accept_friend_request
+
+        send_friend_request(2, 1)
+        accept_friend_request(2, 1)
+        db.session.query(FeedItem).delete()
+        db.session.query(User).filter(User.user_id == 1).update({"num_friends": feed.FANOUT_MAX_FRIENDS})
+        db.session.commit()
+        feed.popular_users_cache.clear()
+
+        items, next_cursor = feed.get_feed(2)
+        self.assertEqual([item.name for item in items], ["Chambar"])
+
+        self.assertEqual(feed.trim_feeds(0), 0)
+
+    def test_is_friends_or_pending_either_direction(self):
+        """Test friendship status is found whichever user sent the request."""
+
+        from friends import is_friends_or_pending, send_friend_request, accept_friend_request
+
+        send_friend_request(2, 1)
+        self.assertEqual(is_friends_or_pending(1, 2), (False, True))
+
+        accept_friend_request(2, 1)
+        self.assertEqual(is_friends_or_pending(1, 2), (True, False))
+        self.assertEqual(is_friends_or_pending(2, 1), (True, False))
+
+    def test_friend_requests_checked_in_database(self):
+        """Test requests made while the friend graph was out of date are caught, whichever user sent them."""
+
+        from friends import send_friend_request
+        from friend_graph import friend_graph
+
+        send_friend_request(2, 1)
+        friend_graph.clear()
+        self.assertFalse(send_friend_request(2, 1))
+
+        result = self.client.post("/add-friend", data={"user_b_id": 2})
+        self.assertEqual(result.data, "Your friend request is pending.")
+
+        # Both users had sent a request, so accepting one accepts the other
+        send_friend_request(1, 2)
+        result = self.client.post("/accept-friend", data={"user_a_id": 2}, follow_redirects=True)
+        self.assertIn("You are now friends.", result.data)
+
+        ashley = User.query.get(1)
+        bob = User.query.get(2)
+        self.assertEqual((ashley.num_friends, ashley.num_received_requests, ashley.num_sent_requests), (1, 0, 0))
+        self.assertEqual((bob.num_friends, bob.num_received_requests, bob.num_sent_requests), (1, 0, 0))
+
+    def test_relationship_statuses(self):
+        """Test relationship statuses for a batch of users."""
+
+        from friends import get_relationship_statuses, send_friend_request, accept_friend_request
+
+        send_friend_request(2, 1)
+        accept_friend_request(2, 1)
+        send_friend_request(3, 1)
+
+        self.assertEqual(get_relationship_statuses(1, [2, 3]), {2: "accepted", 3: "pending_in"})
+        self.assertEqual(get_relationship_statuses(3, [1, 2]), {1: "pending_out", 2: "none"})
+
+    def test_popular_restaurants(self):
+        """Test visits are rolled up into each city's most breadcrumbed and trending restaurants."""
+
+        import datetime
+        from popular import rebuild_popular_restaurants
+
+        # Bob and Cat visited Fable long ago
+        db.session.add_all([Visit(user_id=2, restaurant_id=3, visited_At=datetime.datetime(2016, 1, 1)),
+                            Visit(user_id=3, restaurant_id=3, visited_At=datetime.datetime(2016, 1, 1))])
+        db.session.commit()
+        self.assertEqual(rebuild_popular_restaurants(), 2)
+
+        # Ashley's visit to Miku is counted as it's added
+        self.client.post("/add-visit", data={"restaurant_id": 2})
+
+        result = json.loads(self.client.get("/cities/1/popular.json").data)
+        self.assertEqual([(r["name"], r["num_visits"]) for r in result["restaurants"]],
+                         [("Fable", 2), ("Chambar", 1), ("Miku", 1)])
+
+        result = json.loads(self.client.get("/popular.json?order=trending&limit=2").data)
+        self.assertEqual(result["city"]["name"], "Vancouver")
+        self.assertNotIn("Fable", [r["name"] for r in result["restaurants"]])
+
+    def test_user_list_pages_keep_page_size(self):
+        """Test the link to the next page of users keeps the page size asked for."""
+
+        result = self.client.get("/users?per_page=1")
+        self.assertIn("per_page=1", result.data)
+
+    def test_friends_search_shows_relationship(self):
+        """Test friend search results show the current user's relationship with each result."""
+
+        from friends import send_friend_request
+
+        send_friend_request(1, 2)
+
+        result = self.client.get("/friends/search?q=bob")
+        self.assertIn("Bob Test", result.data)
+        self.assertIn("Request Sent", result.data)
+
+    def test_friends_search_pages_keep_page_size(self):
+        """Test the link to the next page of friend search results keeps the query and page size."""
+
+        result = self.client.get("/friends/search?q=test&per_page=1")
+        self.assertIn("q=test", result.data)
+        self.assertIn("per_page=1", result.data)
+
+    def test_friend_request_badges_are_live(self):
+        """Test pages render the friend request badges from the current counters, not the ones at login."""
+
+        from friends import send_friend_request
+
+        send_friend_request(2, 1)
+        send_friend_request(1, 3)
+
+        result = self.client.get("/friends")
+        self.assertIn('data-request-count="total">2<', result.data)
+        self.assertIn('data-request-count="received">1<', result.data)
+        self.assertIn('data-request-count="sent">1<', result.data)
+
+    def test_friend_request_counts(self):
+        """Test friend request counts are current and unchanged counts get a 304."""
+
+        from friends import send_friend_request
+
+        send_friend_request(2, 1)
+
+        result = self.client.get("/friends/requests/counts.json")
+        self.assertEqual(json.loads(result.data), {"received": 1, "sent": 0, "total": 1})
+
+        etag = result.headers["ETag"]
+        result = self.client.get("/friends/requests/counts.json", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 304)
+
+        send_friend_request(3, 1)
+        result = self.client.get("/friends/requests/counts.json", headers={"If-None-Match": etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(json.loads(result.data)["received"], 2)
+
     # TODO: Add to sample data for friend connections and restaurant visits to test routes where friend info shows up
 
+class YelpIngestionTests(TestCase):
+    """Tests for fetching restaurants from a local stub of the Yelp search endpoint."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        self.requested_offsets = []
+
+    def stub_search(self, city, term, offset):
+        """Stand-in for the Yelp search endpoint with 45 results for any city."""
+
+        self.requested_offsets.append(offset)
+
+        businesses = [type("Business", (object,), {"name": "Restaurant %s" % i})()
+                      for i in range(offset, min(offset + 20, 45))]
+
+        return type("SearchResponse", (object,), {"total": 45, "businesses": businesses})()
+
+    def test_fetch_businesses(self):
+        """Test every page is fetched exactly once and businesses keep their order."""
+
+        from yelp_api_call import fetch_businesses
+
+        businesses, total = fetch_businesses("Vancouver", self.stub_search, workers=4, requests_per_second=100)
+
+        self.assertEqual([b.name for b in businesses], ["Restaurant %s" % i for i in range(45)])
+        self.assertEqual(total, 45)
+        self.assertEqual(sorted(self.requested_offsets), [0, 20, 40])
+
+    def test_is_complete_listing(self):
+        """Test a listing is only complete if it has every business Yelp counted, once each."""
+
+        from yelp_api_call import is_complete_listing, YELP_MAX_RESULTS
+
+        def business(yelp_id):
+            return type("Business", (object,), {"id": yelp_id})()
+
+        self.assertTrue(is_complete_listing([business("a"), business("b")], 2))
+        # A short page, or a page repeating a business
+        self.assertFalse(is_complete_listing([business("a")], 2))
+        self.assertFalse(is_complete_listing([business("a"), business("a")], 2))
+        # An empty listing, and one capped by Yelp
+        self.assertFalse(is_complete_listing([], 0))
+        self.assertFalse(is_complete_listing([business(i) for i in range(YELP_MAX_RESULTS)], YELP_MAX_RESULTS + 1))
+
+
+class YelpSyncTests(TestCase):
+    """Tests for incrementally syncing a city with a stub of the Yelp search endpoint."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        connect_to_db(app, "postgresql:///testdb")
+        db.create_all()
+        example_data()
+
+        self.listing = [self.stub_business("yelp-1", "Chambar Two"),
+                        self.stub_business("yelp-2", "Miku Two")]
+        # What Yelp says the listing's total is, if not the number of businesses in it
+        self.total = None
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        db.session.close()
+        db.drop_all()
+
+    def stub_business(self, yelp_id, name, categories=()):
+        """Make a business with the attributes the Yelp client returns."""
+
+        coordinate = type("Coordinate", (object,), {"latitude": 49.28, "longitude": -123.11})()
+        location = type("Location", (object,), {"display_address": ["568 Beatty St", "Vancouver"],
+                                                "coordinate": coordinate})()
+
+        return type("Business", (object,), {"id": yelp_id,
+                                            "name": name,
+                                            "location": location,
+                                            "display_phone": None,
+                                            "image_url": None,
+                                            "is_closed": False,
+                                            "categories": [type("Category", (object,), {"name": category})()
+                                                           for category in categories]})()
+
+    def stub_search(self, city, term, offset):
+        """Stand-in for the Yelp search endpoint returning the current listing."""
+
+        total = len(self.listing) if self.total is None else self.total
+
+        return type("SearchResponse", (object,), {"total": total, "businesses": self.listing})()
+
+    def test_sync_city(self):
+        """Test only new and changed restaurants are written, and missing ones are closed."""
+
+        from yelp_api_call import sync_city
+
+        first_sync = sync_city("Vancouver", search=self.stub_search)
+        self.assertEqual(first_sync, {"inserted": 2, "updated": 0, "closed": 0})
+
+        self.listing = [self.stub_business("yelp-1", "Chambar Three")]
+        second_sync = sync_city("Vancouver", search=self.stub_search)
+        self.assertEqual(second_sync, {"inserted": 0, "updated": 1, "closed": 1})
+
+        miku = Restaurant.query.filter_by(yelp_id="yelp-2").one()
+        self.assertTrue(miku.is_closed)
+
+    def test_sync_city_updates_categories(self):
+        """Test a restaurant whose categories changed is updated, and unlinked from categories it's no longer in."""
+
+        from yelp_api_call import sync_city
+
+        self.listing = [self.stub_business("yelp-1", "Chambar Two", ["Belgian", "Bars"])]
+        sync_city("Vancouver", search=self.stub_search)
+
+        self.listing = [self.stub_business("yelp-1", "Chambar Two", ["Belgian", "Brunch"])]
+        self.assertEqual(sync_city("Vancouver", search=self.stub_search)["updated"], 1)
+
+        chambar = Restaurant.query.filter_by(yelp_id="yelp-1").one()
+        self.assertEqual(sorted(category.name for category in chambar.categories), ["Belgian", "Brunch"])
+
+    def test_sync_city_keeps_restaurants_missing_from_partial_listing(self):
+        """Test a short page or an empty listing doesn't close the restaurants missing from it."""
+
+        from yelp_api_call import sync_city
+
+        sync_city("Vancouver", search=self.stub_search)
+
+        # Yelp counts two businesses but only one came back
+        self.listing, self.total = [self.stub_business("yelp-1", "Chambar Two")], 2
+        self.assertEqual(sync_city("Vancouver", search=self.stub_search)["closed"], 0)
+
+        self.listing, self.total = [], 0
+        self.assertEqual(sync_city("Vancouver", search=self.stub_search)["closed"], 0)
+
+        self.assertEqual(Restaurant.query.filter_by(is_closed=True).count(), 0)
+
+
+class LRUCacheTests(TestCase):
+    """Unit tests for the LRU/TTL cache used for search results."""
+
+    def test_evicts_least_recently_used(self):
+        """Test the least recently used entry is evicted when the cache is full."""
+
+        from cache import LRUCache
+
+        lru = LRUCache(maxsize=2, ttl=60)
+        lru.set("sushi", 1)
+        lru.set("ramen", 2)
+        lru.get("sushi")
+        lru.set("tacos", 3)
+
+        self.assertIsNone(lru.get("ramen"))
+        self.assertEqual(lru.get("sushi"), 1)
+        self.assertEqual(lru.stats()["evictions"], 1)
+
+    def test_expires_after_ttl(self):
+        """Test entries expire once their TTL has passed."""
+
+        from cache import LRUCache
+
+        lru = LRUCache(maxsize=2, ttl=-1)
+        lru.set("sushi", 1)
+
+        self.assertIsNone(lru.get("sushi"))
+        self.assertEqual(lru.stats()["misses"], 1)
+
+    def test_update_keeps_expiry(self):
+        """Test updating an entry changes its value in place, and doesn't cache missing entries."""
+
+        from cache import LRUCache
+
+        lru = LRUCache()
+        lru.set("sushi", frozenset([1]))
+        lru.update("sushi", lambda ids: ids | frozenset([2]))
+        lru.update("ramen", lambda ids: ids | frozenset([2]))
+
+        self.assertEqual(lru.get("sushi"), frozenset([1, 2]))
+        self.assertIsNone(lru.get("ramen"))
+
+    def test_clear_discards_values_computed_before(self):
+        """Test a value computed before a clear isn't cached after it."""
+
+        from cache import LRUCache
+
+        lru = LRUCache()
+        self.assertEqual(lru.get_or_set("sushi", lambda: lru.clear() or ["Miku"]), ["Miku"])
+        self.assertIsNone(lru.get("sushi"))
+
+    def test_delete_discards_value_computed_before(self):
+        """Test a value computed before its key is deleted isn't cached, while other keys still are."""
+
+        from cache import LRUCache
+
+        lru = LRUCache(maxsize=2)
+        self.assertEqual(lru.get_or_set("sushi", lambda: lru.delete("sushi") or ["Miku"]), ["Miku"])
+        self.assertIsNone(lru.get("sushi"))
+
+        self.assertEqual(lru.get_or_set("tapas", lambda: lru.delete("sushi") or ["Fable"]), ["Fable"])
+        self.assertEqual(lru.get("tapas"), ["Fable"])
+
+        # Once old deletes are forgotten, values computed before them still aren't cached
+        self.assertEqual(lru.get_or_set("ramen", lambda: [lru.delete(key) for key in "abc"] and ["Ramen"]),
+                         ["Ramen"])
+        self.assertIsNone(lru.get("ramen"))
+
+
+class FriendGraphTests(TestCase):
+    """Unit tests for the in-memory friend graph."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        from friend_graph import FriendGraph
+
+        # Ashley (1) is friends with Bob (2) and Cat (3), who are both friends with Doug (4).
+        # Bob is also friends with Eve (5), and Ashley has sent Eve a friend request.
+        self.graph = FriendGraph()
+        for user_a_id, user_b_id in [(1, 2), (1, 3), (2, 4), (3, 4), (2, 5), (1, 5)]:
+            self.graph.add_request(user_a_id, user_b_id)
+        for user_a_id, user_b_id in [(1, 2), (1, 3), (2, 4), (3, 4), (2, 5)]:
+            self.graph.accept_request(user_a_id, user_b_id)
+
+    def test_is_friends_or_pending(self):
+        """Test friendships and pending requests are found whichever user sent the request."""
+
+        self.assertEqual(self.graph.is_friends_or_pending(2, 1), (True, False))
+        self.assertEqual(self.graph.is_friends_or_pending(1, 5), (False, True))
+        self.assertEqual(self.graph.is_friends_or_pending(5, 1), (False, True))
+
+    def test_suggest_friends(self):
+        """Test suggestions are ranked by mutual friends and skip friends and pending requests."""
+
+        self.assertEqual(self.graph.suggest_friends(1), [(4, 2)])
+        self.assertEqual(self.graph.suggest_friends(4), [(1, 2), (5, 1)])
+
+    def test_stale_graph_keeps_serving(self):
+        """Test a graph past its max age is due a rebuild but still answers reads and takes writes."""
+
+        import time
+        from friend_graph import MAX_AGE_SECONDS
+
+        self.graph.loaded_at = time.time() - MAX_AGE_SECONDS - 1
+        self.assertTrue(self.graph.loaded)
+        self.assertTrue(self.graph.stale)
+
+        self.graph.accept_request(1, 5)
+        self.assertIn(5, self.graph.get_friend_ids(1))
+
+    def test_is_current(self):
+        """Test only a built graph that isn't stale is current enough to answer reads instead of the database."""
+
+        import time
+        from friend_graph import MAX_AGE_SECONDS
+
+        # Held as if a build were already running, so none is started
+        self.graph.load_lock.acquire()
+
+        self.assertFalse(self.graph.is_current())
+
+        self.graph.loaded_at = time.time()
+        self.assertTrue(self.graph.is_current())
+
+        self.graph.loaded_at = time.time() - MAX_AGE_SECONDS - 1
+        self.assertFalse(self.graph.is_current())
+
+
+class PrefixIndexTests(TestCase):
+    """Unit tests for the autocomplete prefix index."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        from autocomplete import PrefixIndex
+
+        self.index = PrefixIndex()
+        self.index.add_entries([(1, "Chambar", 5), (2, "Chambar Cafe", 9), (3, "Miku Sushi", 3), (4, "Sushi Bar", 7)])
+
+    def test_complete_ranks_by_popularity(self):
+        """Test names starting with the prefix, or with a word starting with it, come back most popular first."""
+
+        self.assertEqual(self.index.complete("cha"), [(2, "Chambar Cafe"), (1, "Chambar")])
+        self.assertEqual(self.index.complete("SUSHI"), [(4, "Sushi Bar"), (3, "Miku Sushi")])
+        self.assertEqual(self.index.complete("chambar c"), [(2, "Chambar Cafe")])
+        self.assertEqual(self.index.complete("xyz"), [])
+
+    def test_updates_are_incremental(self):
+        """Test popularity changes and renames are reflected without a rebuild."""
+
+        self.index.add_popularity(1, 10)
+        self.assertEqual(self.index.complete("cha"), [(1, "Chambar"), (2, "Chambar Cafe")])
+
+        self.index.set_entry(2, "Fable")
+        self.assertEqual(self.index.complete("cha"), [(1, "Chambar")])
+        self.assertEqual(self.index.complete("fa"), [(2, "Fable")])
+
+    def test_updates_during_rebuild_reach_new_indexes(self):
+        """Test visits recorded while the indexes are rebuilt are applied to the ones swapped in."""
+
+        import time
+        from autocomplete import Autocomplete, PrefixIndex, MAX_AGE_SECONDS
+
+        autocomplete = Autocomplete()
+        autocomplete.restaurants = self.index
+        autocomplete.built_at = time.time() - MAX_AGE_SECONDS - 1
+        self.assertTrue(autocomplete.built)
+        self.assertTrue(autocomplete.stale)
+
+        def build_indexes():
+            autocomplete.record_visit(1, 1)
+            autocomplete.record_visit(2, 1)
+
+            restaurants = PrefixIndex()
+            restaurants.add_entries([(1, "Chambar", 0), (2, "Chambar Cafe", 1)])
+
+            return restaurants, PrefixIndex()
+
+        autocomplete.build_indexes = build_indexes
+        autocomplete.build()
+
+        self.assertFalse(autocomplete.stale)
+        self.assertEqual(autocomplete.restaurants.complete("cha"), [(1, "Chambar"), (2, "Chambar Cafe")])
+
+
+class ReadReplicaTests(TestCase):
+    """Unit tests for routing read-only views to the read replica."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        from flask import Flask
+        from database import REPLICA_BIND
+
+        # In-memory SQLite databases stand in for the primary and the replica
+        self.replica_app = Flask(__name__)
+        self.replica_app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        self.replica_app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: "sqlite://"}
+        self.replica_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(self.replica_app)
+
+        self.primary = db.get_engine(self.replica_app)
+        self.replica = db.get_engine(self.replica_app, bind=REPLICA_BIND)
+
+    def test_read_replica_views_read_from_replica(self):
+        """Test a @read_replica view's queries go to the replica, and flushes to the primary."""
+
+        from flask import request
+        from database import read_replica, RoutingSession
+
+        @read_replica
+        def view():
+            return request.use_read_replica
+
+        with self.replica_app.test_request_context():
+            routing_session = RoutingSession(db)
+            self.assertIs(routing_session.get_bind(User.__mapper__), self.primary)
+
+            self.assertTrue(view())
+            self.assertIs(routing_session.get_bind(User.__mapper__), self.replica)
+
+            routing_session._flushing = True
+            self.assertIs(routing_session.get_bind(User.__mapper__), self.primary)
+
+
+class BenchmarkTests(TestCase):
+    """Unit tests for the benchmark harness's reporting."""
+
+    def test_percentile(self):
+        """Test percentiles use the nearest-rank method."""
+
+        from benchmark import percentile
+
+        latencies = range(1, 101)
+
+        self.assertEqual(percentile(latencies, 50), 50)
+        self.assertEqual(percentile(latencies, 99), 99)
+        self.assertEqual(percentile(latencies, 100), 100)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+
+class QueryStatsTests(TestCase):
+    """Unit tests for grouping SQL statements by shape to find N+1 queries."""
+
+    def test_statement_shape(self):
+        """Test statements differing only by literals or IN lists share a shape."""
+
+        from query_stats import get_statement_shape
+
+        self.assertEqual(get_statement_shape("SELECT * FROM users WHERE user_id = 1"),
+                         get_statement_shape("SELECT * FROM users\n WHERE user_id = 42"))
+        self.assertEqual(get_statement_shape("SELECT * FROM users WHERE user_id IN (%(p_1)s, %(p_2)s)"),
+                         "SELECT * FROM users WHERE user_id IN (?)")
+        self.assertEqual(get_statement_shape("SELECT * FROM users WHERE email = 'ashley@test.com'"),
+                         "SELECT * FROM users WHERE email = ?")
+
+    def test_repeated_shapes(self):
+        """Test a statement run once per row is reported as repeated."""
+
+        from query_stats import QueryStats
+
+        stats = QueryStats()
+        stats.record("SELECT * FROM users", 0.001)
+
+        for restaurant_id in range(6):
+            stats.record("SELECT * FROM restaurants WHERE restaurant_id = %s" % restaurant_id, 0.001)
+
+        self.assertEqual(stats.count, 7)
+        self.assertEqual(stats.max_repeated, 6)
+        self.assertEqual(stats.get_repeated_shapes(), [("SELECT * FROM restaurants WHERE restaurant_id = ?", 6)])
+
+
+class MetricsTests(TestCase):
+    """Unit tests for the Prometheus metrics registry."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        from metrics import MetricsRegistry
+
+        self.metrics = MetricsRegistry()
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test histogram observations are rendered as cumulative buckets with a sum and count."""
+
+        labels = (("endpoint", "index"),)
+
+        for seconds in [0.001, 0.02, 0.02, 30]:
+            self.metrics.observe("breadcrumbs_http_request_duration_seconds", seconds, labels)
+
+        rendered = self.metrics.render()
+
+        self.assertIn('breadcrumbs_http_request_duration_seconds_bucket{endpoint="index",le="0.005"} 1.0', rendered)
+        self.assertIn('breadcrumbs_http_request_duration_seconds_bucket{endpoint="index",le="0.025"} 3.0', rendered)
+        self.assertIn('breadcrumbs_http_request_duration_seconds_bucket{endpoint="index",le="+Inf"} 4.0', rendered)
+        self.assertIn('breadcrumbs_http_request_duration_seconds_count{endpoint="index"} 4.0', rendered)
+
+    def test_counts_from_every_thread(self):
+        """Test samples recorded in other threads, including finished ones, are summed."""
+
+        import threading
+
+        threads = [threading.Thread(target=self.metrics.inc, args=("breadcrumbs_http_requests_total",))
+                   for _ in range(3)]
+
+        for thread in threads:
+            thread.start()
+            thread.join()
+
+        self.metrics.inc("breadcrumbs_http_requests_total")
+
+        self.assertIn("breadcrumbs_http_requests_total 4.0", self.metrics.render())
+
+    def test_sums_processes_through_metrics_dir(self):
+        """Test a scrape adds up every process' snapshot, dropping gauges from exited processes."""
+
+        import shutil
+        import tempfile
+
+        self.metrics.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics.metrics_dir)
+
+        # A snapshot left by a process that has exited
+        with open(self.metrics.get_snapshot_path(999999999), "w") as snapshot_file:
+            json.dump([["breadcrumbs_http_requests_total", [], None, 5],
+                       ["breadcrumbs_http_requests_in_progress", [], None, 2]], snapshot_file)
+
+        self.metrics.inc("breadcrumbs_http_requests_total")
+        self.metrics.inc("breadcrumbs_http_requests_in_progress")
+
+        rendered = self.metrics.render()
+
+        self.assertIn("breadcrumbs_http_requests_total 6.0", rendered)
+        self.assertIn("breadcrumbs_http_requests_in_progress 1.0", rendered)
+
+
+class PhotoStorageTests(TestCase):
+    """Unit tests for storing uploaded photos by content and making their thumbnails."""
+
+    def setUp(self):
+        """Stuff to do before every test."""
+
+        import photos
+        import shutil
+        import tempfile
+
+        self.photos = photos
+        self.upload_root = photos.UPLOAD_ROOT
+        photos.UPLOAD_ROOT = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, photos.UPLOAD_ROOT)
+
+    def tearDown(self):
+        """Do at end of every test."""
+
+        self.photos.UPLOAD_ROOT = self.upload_root
+
+    def make_upload(self, color="red", image_format="JPEG"):
+        """Return a FileStorage holding a small generated image."""
+
+        from io import BytesIO
+        from PIL import Image as PILImage
+        from werkzeug.datastructures import FileStorage
+
+        data = BytesIO()
+        PILImage.new("RGB", (640, 480), color).save(data, image_format)
+        data.seek(0)
+
+        return FileStorage(data, filename="photo.jpg")
+
+    def test_identical_uploads_are_stored_once(self):
+        """Test the same file uploaded twice is stored once, under the hash of its contents."""
+
+        content_hash, url = self.photos.store_original(self.make_upload())
+        same_hash, same_url = self.photos.store_original(self.make_upload())
+        other_hash, _ = self.photos.store_original(self.make_upload("blue"))
+
+        self.assertEqual((content_hash, url), (same_hash, same_url))
+        self.assertNotEqual(content_hash, other_hash)
+        self.assertTrue(url.endswith("/originals/%s/%s.jpg" % (content_hash[:2], content_hash)))
+        self.assertTrue(os.path.exists(self.photos.get_original_path(content_hash, "jpg")))
+
+    def test_rejects_files_that_are_not_images(self):
+        """Test uploads that aren't images are rejected and not kept."""
+
+        from io import BytesIO
+        from werkzeug.datastructures import FileStorage
+
+        with self.assertRaises(self.photos.InvalidPhoto):
+            self.photos.store_original(FileStorage(BytesIO(b"not a photo"), filename="photo.jpg"))
+
+        self.assertEqual(os.listdir(os.path.join(self.photos.UPLOAD_ROOT, "staging")), [])
+
+    def test_make_thumbnails(self):
+        """Test a thumbnail no larger than each size is made as a JPEG."""
+
+        from PIL import Image as PILImage
+
+        content_hash, _ = self.photos.store_original(self.make_upload(image_format="PNG"))
+        self.photos.make_thumbnails(content_hash, self.photos.get_original_path(content_hash, "png"))
+
+        for size, max_side in self.photos.THUMBNAIL_SIZES.items():
+            thumbnail = PILImage.open(self.photos.get_thumbnail_path(content_hash, size))
+            self.assertEqual(thumbnail.format, "JPEG")
+            self.assertLessEqual(max(thumbnail.size), max_side)
+
+
+class SyntheticDataTests(TestCase):
+    """Unit tests for the synthetic dataset generator's helpers."""
+
+    def test_power_law_sampler(self):
+        """Test the sampler is deterministic for a seed and favours the first items."""
+
+        import random
+        from synthetic_data import PowerLawSampler
+
+        def draw(seed):
+            sampler = PowerLawSampler(range(100), 1.0, random.Random(seed))
+            return [sampler.sample() for _ in xrange(1000)]
+
+        draws = draw(0)
+
+        self.assertEqual(draws, draw(0))
+        self.assertGreater(draws.count(0), draws.count(50))
+
+    def test_copy_value(self):
+        """Test values are escaped for COPY's text format."""
+
+        from synthetic_data import copy_value
+
+        self.assertEqual(copy_value(None), "\\N")
+        self.assertEqual(copy_value(42), "42")
+        self.assertEqual(copy_value("a\tb\\c"), "a\\tb\\\\c")
+
+
+class GeoTests(TestCase):
+    """Unit tests for parsing map bounds and locations for geo searches."""
+
+    def test_parse_bounds(self):
+        """Test map bounds are parsed from south,west,north,east."""
+
+        from geo import parse_bounds, InvalidBounds
+
+        self.assertEqual(parse_bounds("37.3,-122.1,37.4,-122.0"), (37.3, -122.1, 37.4, -122.0))
+        self.assertIsNone(parse_bounds(""))
+        self.assertRaises(InvalidBounds, parse_bounds, "37.3,-122.1")
+        self.assertRaises(InvalidBounds, parse_bounds, "37.4,-122.1,37.3,-122.0")
+
+    def test_parse_location(self):
+        """Test a location must be a latitude and longitude on the earth."""
+
+        from geo import parse_location, InvalidLocation
+
+        self.assertEqual(parse_location("49.28", "-123.11"), (49.28, -123.11))
+        self.assertRaises(InvalidLocation, parse_location, None, "-123.11")
+        self.assertRaises(InvalidLocation, parse_location, "91", "-123.11")
+
+    def test_viewport_center(self):
+        """Test the center of a viewport crossing the antimeridian is on the antimeridian side."""
+
+        from geo import get_viewport_center
+
+        self.assertEqual(get_viewport_center((0.0, -10.0, 10.0, 10.0)), (5.0, 0.0))
+        self.assertEqual(get_viewport_center((-20.0, 170.0, -10.0, -150.0)), (-15.0, -170.0))
+
+
+class FacetTests(TestCase):
+    """Tests for category filter links, which don't need a database."""
+
+    def test_filter_url_toggles_category(self):
+        """Test a facet link adds its category to the filter, or removes it if it's already in it."""
+
+        from facets import get_filter_url
+
+        self.assertEqual(get_filter_url("/restaurants/search", (3,), False, toggle=5, q=u"caf\xe9"),
+                         "/restaurants/search?q=caf%C3%A9&category=3&category=5")
+        self.assertEqual(get_filter_url("/restaurants", (3, 5), True, toggle=3, cursor=None),
+                         "/restaurants?category=5&match=all")
+
+
+class ClusterTests(TestCase):
+    """Unit tests for clustering visits on the map."""
+
+    def test_is_in_bounds(self):
+        """Test clusters are picked by their centroid, including across the antimeridian."""
+
+        from clusters import is_in_bounds
+
+        fiji = {"latitude": -17.7, "longitude": 178.0}
+        samoa = {"latitude": -13.8, "longitude": -172.1}
+        vancouver = {"latitude": 49.3, "longitude": -123.1}
+
+        self.assertTrue(is_in_bounds(vancouver, (49.0, -124.0, 50.0, -122.0)))
+        self.assertFalse(is_in_bounds(vancouver, (0.0, -124.0, 1.0, -122.0)))
+        self.assertTrue(is_in_bounds(fiji, (-20.0, 170.0, -10.0, -170.0)))
+        self.assertTrue(is_in_bounds(samoa, (-20.0, 170.0, -10.0, -170.0)))
+        self.assertFalse(is_in_bounds(vancouver, (-20.0, 170.0, 60.0, -170.0)))
+
+    def test_delete_only_clears_one_user(self):
+        """Test clearing a user's clusters leaves other users' cached."""
+
+        from clusters import visit_clusters_cache, clear_user_clusters
+
+        visit_clusters_cache.set((1, 13), [])
+        visit_clusters_cache.set((2, 13), [])
+        clear_user_clusters(1)
+
+        self.assertIsNone(visit_clusters_cache.get((1, 13)))
+        self.assertEqual(visit_clusters_cache.get((2, 13)), [])
+
+
 # TODO: Redirect or render an error page to user when they access a page they are not authorized to see until they login
 # class FlaskTestsLoggedOut(TestCase):
 #     """Flask tests with user logged out of session."""
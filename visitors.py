@@ -0,0 +1,59 @@
+"""Who has left a breadcrumb at each restaurant, for "friends who visited"
+
+Each restaurant's visitor ids are cached as a set, loaded with one index-only scan of
+visits and kept current as visits are added. A restaurant page then finds the viewer's
+friends who visited by intersecting the set with their friend ids, instead of joining
+connections to visits on every view, and gets the total number of visitors for free.
+"""
+
+from sqlalchemy import event
+
+from model import Visit
+from model import db
+from model import USER_SORT_KEY
+
+from cache import LRUCache
+from friends import get_friend_ids, get_users_by_id
+from metrics import metrics
+
+# Restaurants whose visitors are cached, and how long before they're reloaded to pick
+# up visits added by other server processes
+VISITORS_CACHE_SIZE = 2000
+VISITORS_TTL_SECONDS = 600
+
+restaurant_visitors_cache = LRUCache(maxsize=VISITORS_CACHE_SIZE, ttl=VISITORS_TTL_SECONDS)
+
+metrics.register_cache("restaurant_visitors", restaurant_visitors_cache)
+
+
+def get_visitor_ids(restaurant_id):
+    """Return the set of ids of users who have visited a restaurant."""
+
+    return restaurant_visitors_cache.get_or_set(restaurant_id, lambda: frozenset(
+        user_id for user_id, in db.session.query(Visit.user_id).filter(Visit.restaurant_id == restaurant_id)))
+
+
+def record_visitor(restaurant_id, user_id):
+    """Add a visitor to a restaurant's cached visitors, if they're cached. Call after the visit is committed."""
+
+    restaurant_visitors_cache.update(restaurant_id, lambda visitor_ids: visitor_ids | frozenset([user_id]))
+
+
+def get_friends_who_visited(user_id, restaurant_id):
+    """
+    Return the user's friends who have visited a restaurant, ordered by name, and how many people have visited it.
+
+    Users are only loaded for the friends who visited, so this is no queries at all when
+    the visitors and friend graph are cached and no friends have visited.
+    """
+
+    visitor_ids = get_visitor_ids(restaurant_id)
+    friend_ids = get_friend_ids(user_id) & visitor_ids
+
+    friends = get_users_by_id(friend_ids).order_by(*USER_SORT_KEY).all() if friend_ids else []
+
+    return friends, len(visitor_ids)
+
+
+# Freshly created tables (e.g. between tests) make the cached visitors stale
+event.listen(db.metadata, "after_create", lambda target, connection, **kw: restaurant_visitors_cache.clear())
@@ -1,15 +1,97 @@
 """Functions to make API call to Yelp for restaurants in a city"""
 
-from model import City, Restaurant
+from model import City, Restaurant, Category, RestaurantCategory
 from model import db
 
+from sqlalchemy import text
 from sqlalchemy.orm.exc import NoResultFound
 
 from yelp.client import Client
+from yelp.errors import YelpError
 from yelp.oauth1_authenticator import Oauth1Authenticator
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import datetime
 import io
 import json
+import threading
+import time
+
+# Yelp only returns 20 results each time, and only the first 1000 results are accessible
+YELP_PAGE_SIZE = 20
+YELP_MAX_RESULTS = 1000
+
+# Number of pages fetched at the same time, and the most requests sent to Yelp per second
+DEFAULT_WORKERS = 8
+DEFAULT_REQUESTS_PER_SECOND = 10
+
+# Retry failed requests this many times, doubling the wait each time
+MAX_RETRIES = 4
+RETRY_BACKOFF_SECONDS = 0.5
+
+# Rows per multi-row INSERT when upserting restaurants and their categories
+UPSERT_BATCH_SIZE = 500
+
+# Restaurant columns written from Yelp; everything after city_id and yelp_id is updated on conflict
+RESTAURANT_COLUMNS = ["city_id", "yelp_id", "name", "address", "phone", "image_url", "latitude", "longitude",
+                      "is_closed"]
+
+# Cities last synced longer ago than this are re-synced by sync_stale_cities
+DEFAULT_SYNC_MAX_AGE = datetime.timedelta(hours=24)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Rate limiter shared by the threads fetching from Yelp.
+
+    Tokens refill at `rate` per second up to `capacity`, and each request takes one,
+    so bursts are allowed up to capacity while the average rate stays under `rate`.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            # Sleep outside the lock so other threads can refill and check too
+            time.sleep(wait)
+
+
+def get_client():
+    """Return the Yelp client shared by all requests, reading the API keys only once."""
+
+    global _client
+
+    with _client_lock:
+        if _client is None:
+            # Read Yelp API keys
+            with io.open('config_secret.json') as cred:
+                creds = json.load(cred)
+                _client = Client(Oauth1Authenticator(**creds))
+
+    return _client
 
 
 def get_city_id(city):
@@ -28,19 +110,18 @@ def get_city_id(city):
 
 
 # Resource for how to offset Yelp API results from http://www.mfumagalli.com/wp/portfolio/nycbars/
-def get_restaurants(city, offset):
+def get_restaurants(city, offset, search=None):
     """
     Returns API response from Yelp API call to get restaurants for a city, with the results offset.
 
     Note that Yelp only returns 20 results each time, which is why we need to offset if we want
     the next Nth results.
+
+    search defaults to the shared client's search, but can be any function with the same
+    signature (e.g. a stub of the Yelp search endpoint for testing).
     """
 
-    # Read Yelp API keys
-    with io.open('config_secret.json') as cred:
-        creds = json.load(cred)
-        auth = Oauth1Authenticator(**creds)
-        client = Client(auth)
+    search = search or get_client().search
 
     # Set term as restaurant to get restaurants for results
     # Need to pass in offset, so Yelp knows how much to offset by
@@ -49,39 +130,337 @@ def get_restaurants(city, offset):
         'offset': offset
     }
 
-    return client.search(city, **params)
+    return search(city, **params)
 
 
-def load_restaurants(city):
-    """Get all restaurants for a city from Yelp and load restaurants into database."""
+def get_restaurants_with_retry(city, offset, search=None, rate_limiter=None):
+    """Get a page of restaurants from Yelp, waiting for the rate limiter and retrying failures with backoff."""
 
-    # Get city id, as city id is a required parameter when adding a restaurant to the database
-    city_id = get_city_id(city)
+    for attempt in range(MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+
+        try:
+            return get_restaurants(city, offset, search)
 
-    # Start offset at 0 to return the first 20 results from Yelp API request
-    offset = 0
+        # HTTP and connection errors from urllib are IOErrors
+        except (YelpError, IOError):
+            if attempt == MAX_RETRIES:
+                raise
+            time.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt)
 
-    # Get total number of restaurants for this city
-    total_results = get_restaurants(city, offset).total
 
-    # Get all restaurants for a city and load each restaurant into the database
+def fetch_businesses(city, search=None, workers=DEFAULT_WORKERS, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    """
+    Fetch all accessible businesses for a city from Yelp, in page order.
+
+    The first page tells us the total, then the remaining pages are fetched by a
+    bounded pool of threads that share one client and one rate limiter. Returns the
+    businesses and the total Yelp reported for the listing.
+    """
+
+    rate_limiter = TokenBucket(requests_per_second)
+
+    first_page = get_restaurants_with_retry(city, 0, search, rate_limiter)
+    businesses = list(first_page.businesses)
+
     # Note: Yelp has a limitation of 1000 for accessible results, so get total results
     # if less than 1000 or get only 1000 results back even if there should be more
-    while 1000 > offset < total_results:
-
-        # API response returns a SearchResponse object with accessible attributes
-        # response.businesses returns a list of business objects with further attributes
-        for business in get_restaurants(city, offset).businesses:
-            restaurant = Restaurant(city_id=city_id,
-                                    name=business.name,
-                                    address=" ".join(business.location.display_address),
-                                    phone=business.display_phone,
-                                    image_url=business.image_url,
-                                    latitude=business.location.coordinate.latitude,
-                                    longitude=business.location.coordinate.longitude)
-            db.session.add(restaurant)
-
-        # Yelp returns only 20 results each time, so need to offset by 20 while iterating
-        offset += 20
+    offsets = range(YELP_PAGE_SIZE, min(first_page.total, YELP_MAX_RESULTS), YELP_PAGE_SIZE)
+
+    if not offsets:
+        return businesses, first_page.total
+
+    def fetch_page(offset):
+        return get_restaurants_with_retry(city, offset, search, rate_limiter).businesses
+
+    pool = ThreadPool(max(1, min(workers, len(offsets))))
+
+    try:
+        for page in pool.imap(fetch_page, offsets):
+            businesses.extend(page)
+    finally:
+        pool.terminate()
+
+    return businesses, first_page.total
+
+
+def is_complete_listing(businesses, total):
+    """
+    Check if businesses is a city's whole listing, so restaurants missing from it can be closed.
+
+    Yelp only gives us the first YELP_MAX_RESULTS results, and a page can come back short or
+    repeat businesses, so the listing is only complete if it has exactly total distinct
+    businesses. An empty listing is never trusted.
+    """
+
+    if not businesses or total > YELP_MAX_RESULTS:
+        return False
+
+    return len(set(business.id for business in businesses)) == total
+
+
+def build_values_clause(rows, columns):
+    """
+    Build a multi-row VALUES clause for rows (dicts) and its bind parameters.
+
+    Returns a string like "(:name_0, :phone_0), (:name_1, :phone_1)" and the matching params.
+    """
+
+    values = []
+    params = {}
+
+    for i, row in enumerate(rows):
+        values.append("(%s)" % ", ".join(":%s_%d" % (column, i) for column in columns))
+        params.update(("%s_%d" % (column, i), row[column]) for column in columns)
+
+    return ", ".join(values), params
+
+
+def get_restaurant_row(city_id, business):
+    """Return the restaurants row (as a dict of RESTAURANT_COLUMNS) for a Yelp business."""
+
+    return {
+        "city_id": city_id,
+        "yelp_id": business.id,
+        "name": business.name,
+        "address": " ".join(business.location.display_address),
+        "phone": business.display_phone,
+        "image_url": business.image_url,
+        "latitude": business.location.coordinate.latitude,
+        "longitude": business.location.coordinate.longitude,
+        "is_closed": bool(business.is_closed)
+    }
+
+
+def upsert_restaurants(city_id, businesses):
+    """
+    Insert or update Yelp businesses as restaurants, keyed by Yelp business id.
+
+    Businesses are written in multi-row INSERT ... ON CONFLICT DO UPDATE statements, so a whole
+    city takes a handful of statements and re-running it updates rows instead of duplicating them.
+
+    Note: This does not commit.
+    """
+
+    # A business can show up on two pages if Yelp's results shift while we page through them,
+    # and one statement can't update the same row twice, so keep only the last copy
+    restaurants = OrderedDict()
+
+    for business in businesses:
+        restaurants[business.id] = get_restaurant_row(city_id, business)
+
+    rows = restaurants.values()
+
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        values, params = build_values_clause(rows[start:start + UPSERT_BATCH_SIZE], RESTAURANT_COLUMNS)
+
+        db.session.execute(text("""
+            INSERT INTO restaurants (%s)
+            VALUES %s
+            ON CONFLICT (yelp_id) DO UPDATE SET %s
+            """ % (", ".join(RESTAURANT_COLUMNS),
+                   values,
+                   ", ".join("%s = EXCLUDED.%s" % (column, column) for column in RESTAURANT_COLUMNS[2:]))),
+            params)
+
+
+def upsert_categories(businesses):
+    """
+    Add any new categories for Yelp businesses and link them to their restaurants.
+
+    Restaurants must already be upserted, as they are looked up by Yelp business id.
+
+    Note: This does not commit.
+    """
+
+    links = OrderedDict()
+
+    for business in businesses:
+        for category in business.categories or []:
+            links[(business.id, category.name)] = {"yelp_id": business.id, "category": category.name}
+
+    if not links:
+        return
+
+    categories = [{"name": name} for name in set(link["category"] for link in links.values())]
+    values, params = build_values_clause(categories, ["name"])
+
+    db.session.execute(text("""
+        INSERT INTO categories (name)
+        VALUES %s
+        ON CONFLICT (name) DO NOTHING
+        """ % values), params)
+
+    rows = links.values()
+
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        values, params = build_values_clause(rows[start:start + UPSERT_BATCH_SIZE], ["yelp_id", "category"])
+
+        db.session.execute(text("""
+            INSERT INTO restaurantcategories (restaurant_id, category_id)
+            SELECT restaurants.restaurant_id, categories.category_id
+            FROM (VALUES %s) AS links (yelp_id, category)
+            JOIN restaurants ON restaurants.yelp_id = links.yelp_id
+            JOIN categories ON categories.name = links.category
+            ON CONFLICT (restaurant_id, category_id) DO NOTHING
+            """ % values), params)
+
+
+def get_category_names(business):
+    """Return the set of a Yelp business's category names."""
+
+    return set(category.name for category in business.categories or [])
+
+
+def get_stored_categories(city_id):
+    """Return a dictionary of the Yelp business id of each of a city's restaurants to its set of category names."""
+
+    links = db.session.query(Restaurant.yelp_id, Category.name).join(
+        RestaurantCategory, RestaurantCategory.restaurant_id == Restaurant.restaurant_id).join(
+        Category, Category.category_id == RestaurantCategory.category_id).filter(
+        Restaurant.city_id == city_id, Restaurant.yelp_id != None)
+
+    categories = {}
+
+    for yelp_id, name in links:
+        categories.setdefault(yelp_id, set()).add(name)
+
+    return categories
+
+
+def delete_stale_categories(businesses, stored_categories):
+    """
+    Unlink restaurants from the categories their Yelp businesses are no longer listed in.
+
+    stored_categories is from get_stored_categories.
+
+    Note: This does not commit.
+    """
+
+    rows = [{"yelp_id": business.id, "category": name} for business in businesses
+            for name in stored_categories.get(business.id, set()) - get_category_names(business)]
+
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        values, params = build_values_clause(rows[start:start + UPSERT_BATCH_SIZE], ["yelp_id", "category"])
+
+        db.session.execute(text("""
+            DELETE FROM restaurantcategories
+            USING (VALUES %s) AS links (yelp_id, category), restaurants, categories
+            WHERE restaurants.yelp_id = links.yelp_id
+            AND categories.name = links.category
+            AND restaurantcategories.restaurant_id = restaurants.restaurant_id
+            AND restaurantcategories.category_id = categories.category_id
+            """ % values), params)
+
+
+def load_restaurants(city, workers=DEFAULT_WORKERS, search=None):
+    """
+    Get all restaurants for a city from Yelp and load restaurants into database.
+
+    Pages are fetched concurrently by `workers` threads; pass workers=1 to fetch them one at a time.
+    Restaurants are upserted by Yelp business id, so loading a city again is safe.
+    """
+
+    # Get city id, as city id is a required parameter when adding a restaurant to the database
+    city_id = get_city_id(city)
+    synced_at = datetime.datetime.utcnow()
+
+    # API response returns a SearchResponse object with accessible attributes
+    # response.businesses returns a list of business objects with further attributes
+    businesses, _ = fetch_businesses(city, search, workers)
+
+    upsert_restaurants(city_id, businesses)
+    upsert_categories(businesses)
+
+    # Record when this city was last synced with Yelp
+    db.session.query(City).filter(City.city_id == city_id).update({"updated_At": synced_at})
+
+    db.session.commit()
+
+
+def is_changed(stored, row):
+    """Check if a stored restaurant differs from its row from Yelp."""
+
+    for column in RESTAURANT_COLUMNS:
+        stored_value, value = getattr(stored, column), row[column]
+
+        # Latitude and longitude are stored as Numeric, so compare them as floats
+        if column in ("latitude", "longitude"):
+            stored_value, value = float(stored_value), float(value)
+
+        if stored_value != value:
+            return True
+
+    return False
+
+
+def sync_city(city, workers=DEFAULT_WORKERS, search=None):
+    """
+    Bring a city's restaurants up to date with Yelp, writing only what changed.
+
+    Yelp's search API has no way to ask for changes since a date, so the city's listing is
+    fetched (concurrently) and diffed against the stored rows and categories by Yelp business
+    id. Only new and changed restaurants are upserted, changed ones are unlinked from
+    categories they're no longer listed in, and restaurants that are gone from a complete
+    listing are marked as closed. The sync time is recorded in City.updated_At.
+
+    Returns a dictionary counting the restaurants inserted, updated and closed.
+    """
+
+    city_id = get_city_id(city)
+    synced_at = datetime.datetime.utcnow()
+
+    businesses, total = fetch_businesses(city, search, workers)
+
+    stored_restaurants = db.session.query(*[getattr(Restaurant, column) for column in RESTAURANT_COLUMNS])
+    stored_restaurants = stored_restaurants.filter(Restaurant.city_id == city_id, Restaurant.yelp_id != None)
+    stored = dict((restaurant.yelp_id, restaurant) for restaurant in stored_restaurants)
+    stored_categories = get_stored_categories(city_id)
+
+    new_businesses = []
+    changed_businesses = []
+
+    for business in businesses:
+        if business.id not in stored:
+            new_businesses.append(business)
+        elif (is_changed(stored[business.id], get_restaurant_row(city_id, business)) or
+              get_category_names(business) != stored_categories.get(business.id, set())):
+            changed_businesses.append(business)
+
+    upsert_restaurants(city_id, new_businesses + changed_businesses)
+    upsert_categories(new_businesses + changed_businesses)
+    delete_stale_categories(changed_businesses, stored_categories)
+
+    # A restaurant missing from a capped or partly fetched listing may just have dropped out
+    # of it, so only close restaurants missing from a complete listing
+    missing = []
+
+    if is_complete_listing(businesses, total):
+        listed = set(business.id for business in businesses)
+        missing = [yelp_id for yelp_id, restaurant in stored.items()
+                   if yelp_id not in listed and not restaurant.is_closed]
+
+    if missing:
+        db.session.query(Restaurant).filter(Restaurant.yelp_id.in_(missing)).update({"is_closed": True},
+                                                                                    synchronize_session=False)
+
+    db.session.query(City).filter(City.city_id == city_id).update({"updated_At": synced_at})
 
     db.session.commit()
+
+    return {"inserted": len(new_businesses), "updated": len(changed_businesses), "closed": len(missing)}
+
+
+def sync_stale_cities(max_age=DEFAULT_SYNC_MAX_AGE, workers=DEFAULT_WORKERS, search=None):
+    """
+    Sync every city that was last synced longer than max_age ago, oldest first.
+
+    Returns a dictionary of each synced city's name to its sync counts.
+    """
+
+    watermark = datetime.datetime.utcnow() - max_age
+
+    stale_cities = db.session.query(City.name).filter(City.updated_At < watermark).order_by(City.updated_At).all()
+
+    return dict((city.name, sync_city(city.name, workers, search)) for city in stale_cities)